@@ -17,6 +17,7 @@ from .molecule import *
 from .forcefield import *
 from .conductivity import *
 from .operation import *
+from .kernel import ForceFieldKernel
 from ._minimize import minimize
 from .antechamber.atomtype.atomtype import main as atomtype
 from . import plot
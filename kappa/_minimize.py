@@ -19,7 +19,7 @@ GR = 1.618
                                   
 def minimize(mol, n=2500, descent="cg", search="backtrack", numgrad=False,
              eprec=1e-2, fprec=1e-2,
-             efreq=1000, nbnfreq=15, print_=True):
+             efreq=1000, nbnfreq=1, print_=True):
     """Minimize the energy of the inputted molecule.
     
     Args:
@@ -36,28 +36,36 @@ def minimize(mol, n=2500, descent="cg", search="backtrack", numgrad=False,
         fprec (float): Precision for force magnitude signaling
             convergence has occurred.
         efreq (int): Iteration period in which information is printed to the user;
-            called frequency despite being inverse frequency."""
+            called frequency despite being inverse frequency.
+        nbnfreq (int): Iteration period in which the atoms' displacements are checked
+            against the nonbonded skin; the neighbor lists are rebuilt only when needed."""
+    
+    calc_e = mol.define_energy_routine()
     
     if numgrad:
-        grad_routine = mol.define_gradient_routine_numerical()
+        calc_grad = mol.define_gradient_routine_numerical()
+        def egrad_routine():
+            return (calc_e(),) + calc_grad()
     else:
-        grad_routine = mol.define_gradient_routine_analytical()
+        egrad_routine = mol.define_energy_gradient_routine()
         
-    return descentDict[descent](mol, n, searchDict[search], mol.define_energy_routine(), grad_routine,
+    return descentDict[descent](mol, n, searchDict[search], calc_e, egrad_routine,
                          efreq, nbnfreq, eprec*mol.ff.eunits, fprec*mol.ff.eunits/mol.ff.lunits,
                          print_=print_)
         
-def steepest_descent(mol, n, search, calc_e, calc_grad, efreq, nbn, eprec, fprec):
-    """Minimize the energy of the inputted molecule via the steepest descent approach."""
+def steepest_descent(mol, n, search, calc_e, calc_egrad, efreq, nbn, eprec, fprec,
+                     print_=True):
+    """Minimize the energy of the inputted molecule via the steepest descent approach.
+    calc_egrad returns the energy along with the gradient, see Molecule.define_energy_gradient_routine."""
     
     #initial guess for stepsize
     stepSize = 1e-1
     
-    energy = calc_e()
-    gradient, maxForce, totalMag, = calc_grad()
+    energy, gradient, maxForce, totalMag = calc_egrad()
     eList = [energy]
-    print('energy:   %s' % energy)
-    print('maxforce: %s' % maxForce)
+    if print_:
+        print('energy:   %s' % energy)
+        print('maxforce: %s' % maxForce)
     
     for step in range(1, n+1):
         
@@ -67,17 +75,16 @@ def steepest_descent(mol, n, search, calc_e, calc_grad, efreq, nbn, eprec, fprec
         #take the step
         mol.posList += stepSize*(-gradient/totalMag)
         
-        #reset nonbonded neighbors
-        if mol.ff.lj:
+        #reset nonbonded neighbors once an atom has moved half the skin
+        if mol.ff.lj or mol.ff.es:
             if step % nbn == 0:
-                mol._configure_nonbonded_neighbors()
+                mol._update_nonbonded_neighbors()
         
         #reset quantities
-        energy = calc_e()
-        gradient, maxForce, totalMag = calc_grad()
+        energy, gradient, maxForce, totalMag = calc_egrad()
         
         #for every multiple of efreq, print the status
-        if step % efreq == 0:
+        if (step % efreq == 0) & print_:
             print('step:     %s' % step)
             print('energy:   %s' % energy)
             print('maxforce: %s' % maxForce)
@@ -85,24 +92,25 @@ def steepest_descent(mol, n, search, calc_e, calc_grad, efreq, nbn, eprec, fprec
             
         #break the iteration if our forces are small enough
         if maxForce < fprec:
-            print('###########\n Finished! \n###########')
-            print('step:     %s' % step)
-            print('energy:   %s' % energy)
-            print('maxforce: %s' % maxForce)
+            if print_:
+                print('###########\n Finished! \n###########')
+                print('step:     %s' % step)
+                print('energy:   %s' % energy)
+                print('maxforce: %s' % maxForce)
             break
     
     return mol, eList
     
-def conjugate_gradient(mol, n, search, calc_e, calc_grad, efreq, nbn, eprec, fprec,
+def conjugate_gradient(mol, n, search, calc_e, calc_egrad, efreq, nbn, eprec, fprec,
                        print_=True):
-    """Minimize the energy of the inputted molecule via the conjugate gradient approach."""
+    """Minimize the energy of the inputted molecule via the conjugate gradient approach.
+    calc_egrad returns the energy along with the gradient, see Molecule.define_energy_gradient_routine."""
     
     #initial guess for stepsize
     stepSize = 1e-1
     
     #starting values
-    energy = calc_e()
-    gradient, maxForce, totalMag, = calc_grad()
+    energy, gradient, maxForce, totalMag = calc_egrad()
     eList = [energy]
     if print_:
         print('energy:   %s' % energy)
@@ -123,16 +131,15 @@ def conjugate_gradient(mol, n, search, calc_e, calc_grad, efreq, nbn, eprec, fpr
         #take the step
         mol.posList += stepSize*(normH)
         
-        #reset nonbonded neighbors
-        if mol.ff.lj:
+        #reset nonbonded neighbors once an atom has moved half the skin
+        if mol.ff.lj or mol.ff.es:
             if step % nbn == 0:
-                mol._configure_nonbonded_neighbors()
+                mol._update_nonbonded_neighbors()
         
         #reset quantities
         prevH = h
         prevGrad = gradient
-        energy = calc_e()
-        gradient, maxForce, totalMag = calc_grad()
+        energy, gradient, maxForce, totalMag = calc_egrad()
         gamma = calculate_gamma(gradient, prevGrad)
         
         #for every multiple of efreq, print the status
@@ -153,20 +160,17 @@ def conjugate_gradient(mol, n, search, calc_e, calc_grad, efreq, nbn, eprec, fpr
     
     return mol, eList
 
-def scipy_method(mol, n, search, calc_e, calc_grad, efreq, nbn, eprec, fprec,
+def scipy_method(mol, n, search, calc_e, calc_egrad, efreq, nbn, eprec, fprec,
                  print_=True):
     
     def func(pos):
         pos = pos.reshape(pos.shape[0]//3, 3)
         mol.posList = pos
-        return calc_e()
+        energy, gradient = calc_egrad()[:2]
+        return energy, np.hstack(gradient)
     
-    def grad(pos):
-        pos = pos.reshape(pos.shape[0]//3, 3)
-        mol.posList = pos
-        return np.hstack(calc_grad()[0])
-    
-    op_result = scipy.optimize.minimize(func, np.hstack(mol.posList), method='BFGS', jac=grad,
+    #jac=True, func returns the energy and gradient together
+    op_result = scipy.optimize.minimize(func, np.hstack(mol.posList), method='BFGS', jac=True,
                                         options={'gtol':fprec})
 #    print(op_result)
     pos = op_result.x
@@ -180,17 +184,20 @@ def parabolic_interpolation(a,b,c,fa,fb,fc):
     n = (b-c)*(fb-fa)
     return b - ((b-c)*n - (b-a)*m)/(2.*copysign(max(abs(n-m), EP), n-m))
 
-def line_search_backtrack(mol, stepList, e, grad, calc_e, alpha=None):
+def line_search_backtrack(mol, stepList, e, grad, calc_e, alpha=None, ladder=2):
     """Return the stepsize determined by the backtracking strategies of
-    Armijo and Goldstein.
+    Armijo and Goldstein.  The step sizes are tried a ladder at a time, with the
+    candidate configurations evaluated in one batch.
     
     Args:
         mol (Molecule): Molecule to be minimized.  mol.posList is the coordinate array of the atoms
         stepList (ndarray):  A N x 3 array of the step direction.
         e (float): The energy of the molecule before the step is taken.
         grad (ndarray): A N x 3 array of the forces on the atoms before the step is taken.
-        calc_e (function): Callable function that returns the energy of the molecule
-        alpha (float): An initial guess for the step size"""
+        calc_e (function): Callable function that returns the energy of the molecule,
+            or the energies of a K x N x 3 stack of configurations
+        alpha (float): An initial guess for the step size
+        ladder (int): Number of successive step sizes evaluated together"""
     
     tau = 0.5
     c = 0.33
@@ -203,20 +210,19 @@ def line_search_backtrack(mol, stepList, e, grad, calc_e, alpha=None):
         
     t = -c*m
     
-    counter = 0
+    pos = mol.posList
+    rungs = tau**np.arange(ladder)
     while alpha > EP:
         
-        mol.posList += alpha*stepList
-        newE = calc_e()
-        mol.posList += -alpha*stepList
-        if e - newE >= alpha*t:
-#            print('counter:  %s' % counter)
-            return alpha
-        else:
-            alpha *= tau
-            counter += 1
+        alphas = alpha*rungs
+        alphas = alphas[alphas > EP]
+        #the trial positions are built from the unshifted ones, so no drift accumulates
+        newE = calc_e(pos + alphas[:,None,None]*stepList)
+        accepted = np.where(e - newE >= alphas*t)[0]
+        if len(accepted) > 0:
+            return alphas[accepted[0]]
+        alpha = alphas[-1]*tau
     
-#    print('counter:  %s' % counter)        
     return EP
     
 def line_search_brent(mol, stepList, e, grad, calc_e, alpha=None):
@@ -243,19 +249,15 @@ def bracket_minimum(mol, stepList, ea, calc_e):
     
     #b will be some small distance away (we assume our step direction will minimize the energy within a finite range)
     b = a + SQRTEP
-    mol.posList += b*stepList
-    eb = calc_e()
-    mol.posList += -b*stepList
+    pos = mol.posList
+    eb = calc_e(pos + b*stepList)
     
     if eb > ea:
         raise ValueError("There was an error in bracketing the minimum!")
     
     #c will be found through an iterative process
     def ef(c):
-        mol.posList += c*stepList
-        e = calc_e()
-        mol.posList += -c*stepList
-        return e
+        return calc_e(pos + c*stepList)
         
     c = b + GR*(b-a)
     ec = ef(c)
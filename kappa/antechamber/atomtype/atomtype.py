@@ -4,12 +4,18 @@ Created on Fri Apr 29 13:38:20 2016
 
 @author: Alex Kerr
 
-Define functions used to parse Forcefield atomtype files.
+Define functions used to parse Forcefield atomtype files, compiled once into rules
+whose cheap integer predicates are tested on all atoms at once, and only on one atom
+of each class of atoms with the same chemical environment.
 Rules are defined by 'ANTECHAMBER, AN ACCESSORY SOFTWARE PACKAGE FOR MOLECULE MECHANICAL CALCULATIONS' by Wang et al. (2000)
 """
 
 import csv
+import functools
 import re
+
+import numpy as np
+
 from ... import package_dir
 
 nums = ["1", "2", "3", "4"]
@@ -18,170 +24,241 @@ atomicSymDict = {"H":[1], "C":[6], "N":[7], "O":[8], "F":[9], "P":[15], "S":[16]
 inv_atomicSymDict = {1: "H", 6:"C", 7:"N", 8:"O", 9:"F", 15:"P", 16:"S", 17:"Cl", 35:"Br", 53:"I"}
 
 
+#compiled rules by atomtype file, shared by every forcefield of the process
+_ruleCache = {}
+
 def main(molecule):
     """Main module execution."""
     
-    file_ = molecule.ff.atomtype_file
+    rules = molecule.ff.atomtype_rules
+    size = len(molecule)
+    z = np.asarray(molecule.zList)
+    degree, hcount, wcount = neighbor_counts(molecule)
+    ints = (z, degree, hcount, wcount)
+    props = atom_properties(molecule)
+    atomData = (z, degree, props)
+    caches = ({}, {})
     
-    reader = csv.reader(open("%s/antechamber/atomtype/%s" % (package_dir,file_)), delimiter=" ", skipinitialspace=True)
-    lines = []
-    for line in reader:
-        #populate lineList
-        #this is because reader object cycles only once; was a surprising bug!
-        #reader is a generator
-        if line:
-            if line[0] == "ATD":
-                lines.append(line)
-                
-    typeList = []
-    for atom in range(len(molecule)):
-        
-        for line in lines:
-            
-            check,type_ = parse_line(line, atom, molecule)
-            
-            if check:
-                break
-            else:
-                continue
+    #the rules see as far as their longest path, and the neighbors of its last atom
+    depth = max([len(path) for rule in rules if rule.paths for path in rule.paths] + [1]) + 1
+    classes = environment_classes(molecule, props, depth)
+    representatives = np.unique(classes, return_index=True)[1]
+    
+    typeList = np.full(size, 'dummy', dtype=object)
+    untyped = np.zeros(size, dtype=bool)
+    untyped[representatives] = True
+    for rule in rules:
+        if not rule.complete:
+            continue
+        #integer predicates and properties first, on every atom still untyped
+        match = untyped.copy()
+        for value, count in zip(rule.ints, ints):
+            if value is not None:
+                match &= count == value
+        if rule.props is not None:
+            match &= entry_mask((None, None, rule.props), atomData, caches[1])
+        if rule.paths is not None and match.any():
+            match[match] = [chem_env(rule.paths, molecule, atom, atomData, caches)
+                            for atom in np.nonzero(match)[0]]
+        typeList[match] = rule.atomtype
+        untyped &= ~match
+        if not untyped.any():
+            break
         
-        typeList.append(type_)
+    #broadcast the type of each class's representative
+    return typeList[representatives][classes].tolist()
+    
+def compiled_rules(file_):
+    """Return the list of Rules of an ATOMTYPE .DEF file, compiling it on first use."""
+    if file_ not in _ruleCache:
+        with open("%s/antechamber/atomtype/%s" % (package_dir,file_)) as f:
+            reader = csv.reader(f, delimiter=" ", skipinitialspace=True)
+            _ruleCache[file_] = [Rule(line) for line in reader if line and line[0] == "ATD"]
+    return _ruleCache[file_]
+    
+class Rule:
+    """An ATD line of an atomtype file with its entries parsed into predicates
+    
+    Args:
+        line (list): The whitespace separated fields of the line.
         
-    return typeList
+    The fields after the type, up to the '&' that ends the definition, become:
+        ints (list): Atomic number, number of neighbors, of hydrogen neighbors and of electron
+            withdrawing next nearest neighbors, None where any ('*').
+        props (tuple): The F5 atomic property conditions, see property_match, or None.
+        paths (list): The F6 chemical environment paths, longest first, of (symbol, number of
+            neighbors or None, property conditions or None) entries, or None."""
     
-def compare_int(entry, num):
-    """Return True if the integer matches the line entry, False otherwise."""
-    if int(entry) == num:
-        return True
-    else:
-        return False
-
-def atomic_prop(entry, molTuple):
-    """Return true if atom fits F5 (atomic property) entry, False otherwise"""
-    molecule, atomIndex = molTuple
+    __slots__ = ('atomtype', 'complete', 'ints', 'props', 'paths')
+    
+    def __init__(self, line):
+        line = [field for field in line if field]
+        self.atomtype = line[1]
+        #a definition may end before the residue field, like that of the catch-all dummy
+        entries = ['&'] if line[2:3] == ['&'] else line[3:]
+        self.complete = '&' in entries
+        if self.complete:
+            entries = entries[:entries.index('&')]
+        entries = entries + ['*']*(6 - len(entries))
+        self.ints = [None if entry == '*' else int(entry) for entry in entries[:4]]
+        self.props = None if entries[4] == '*' else property_conditions(entries[4])
+        self.paths = None
+        if entries[5] != '*':
+            #try to confirm all matches, starting with bigger ones (more 'specific' paths)
+            #so as not to get false negatives
+            pathList = []
+            path_parser(entries[5][1:-1], pathList, [])
+            pathList.sort(key=len)
+            pathList.reverse()
+            self.paths = [tuple(path_entry(pathEntry) for pathEntry in path) for path in pathList]
+    
+def neighbor_counts(molecule):
+    """Return the arrays of each atom's number of neighbors, of hydrogen neighbors, and of
+    electron withdrawing (N, O, F, Cl, Br) next nearest neighbors through each neighbor,
+    counted from the CSR adjacency."""
+    
+    degree = molecule.degree()
+    rows = np.repeat(np.arange(len(degree)), degree)
+    z = np.asarray(molecule.zList)[molecule.nIndices]
+    hcount = np.bincount(rows, z == 1, minlength=len(degree)).astype(int)
+    withdrawing = np.isin(molecule.zList, [7,8,9,17,35])
+    #withdrawing neighbors of each neighbor, less the atom itself
+    wneighbors = np.bincount(rows, withdrawing[molecule.nIndices], minlength=len(degree))
+    wcount = np.bincount(rows, wneighbors[molecule.nIndices], minlength=len(degree)) - degree*withdrawing
+    return degree, hcount, wcount.astype(int)
+    
+def atom_properties(molecule):
+    """Return the tuple of atomic properties of each atom: ring sizes and aromaticity
+    of its rings, or 'NR' if it is in none."""
     
-    #determine atom properties
     propList = []
-    nonRing = True
-    for count, ring in enumerate(molecule.ringList):
-        if atomIndex in ring:
-            nonRing = False
-            propList.append('RG%s' % (str(len(ring))))
-            propList.append(molecule.aromaticList[count])
+    for atomIndex in range(len(molecule)):
+        props = []
+        for count in molecule.rings(atomIndex):
+            props.append('RG%s' % (str(len(molecule.ringList[count]))))
+            props.append(molecule.aromaticList[count])
+        if not props:
+            props.append('NR')
+        propList.append(tuple(props))
+    return propList
+    
+def environment_classes(molecule, props, depth):
+    """Return the array of each atom's class of chemical environment, atoms of a class having
+    the same atomic numbers, atom_properties and connectivity within depth bonds.
+    
+    The classes are a Weisfeiler-Lehman refinement: atoms start labeled by atomic number and
+    properties, and each round relabels them by their label and the sorted labels of their
+    neighbors, so after depth rounds a label stands for the atom's depth-bond environment."""
     
-    if nonRing:
-        propList.append('NR')
+    z = np.asarray(molecule.zList)
+    propIds = {}
+    labels = np.unique(np.column_stack((z, [propIds.setdefault(prop, len(propIds)) for prop in props])),
+                       axis=0, return_inverse=True)[1].reshape(-1)
+    degree = molecule.degree()
+    rows = np.repeat(np.arange(len(degree)), degree)
+    #position of each neighbor in its atom's row
+    offset = np.arange(len(rows)) - np.repeat(np.cumsum(degree) - degree, degree)
+    for _ in range(depth):
+        neighborLabels = labels[molecule.nIndices]
+        order = np.lexsort((neighborLabels, rows))
+        table = np.full((len(degree), 1 + np.amax(degree, initial=0)), -1)
+        table[:,0] = labels
+        table[rows, 1 + offset] = neighborLabels[order]
+        newLabels = np.unique(table, axis=0, return_inverse=True)[1].reshape(-1)
+        if len(np.unique(newLabels)) == len(np.unique(labels)):
+            #stable, no further refinement
+            break
+        labels = newLabels
+    return labels
     
-    #separate properties by comma
-    entry = entry[1:-1].split(',')
-    propList = propList[:]
-    for index in range(len(entry)):
-        entry[index] = entry[index].split('.')
+def property_conditions(entry):
+    """Return the conditions of an F5 (atomic property) entry: separated by commas,
+    each a tuple of the properties separated by periods that would satisfy it."""
+    return tuple(tuple(condition.split('.')) for condition in entry[1:-1].split(','))
+
+@functools.lru_cache(maxsize=None)
+def property_match(conditions, props):
+    """Return True if atomic properties satisfy each F5 condition with a different property."""
+    propList = list(props)
     matchCount = 0
-    for condition in entry:
+    for condition in conditions:
         for count, prop in enumerate(propList):
             if prop in condition:
                 matchCount += 1
                 del propList[count]
                 break
-    if matchCount == len(entry):
-        return True
-    else:
-        return False
-        
-def chem_env(entry, molTuple):
-    """Return True if the atom matches the F6 (subtle chemical environment) entry, False otherwise"""
+    return matchCount == len(conditions)
     
-    mol, atomIndex = molTuple
-    
-    #turn text entry into list of paths
-    pathList = []
-    path_parser(entry[1:-1], pathList, [])
+def path_entry(pathEntry):
+    """Return the (atomic symbol, number of neighbors or None, property conditions or None)
+    of an F6 path entry such as 'C3', 'N' or 'C3[AR1.AR2.AR3]'."""
+    conditions = None
+    if "[" in pathEntry:
+        conditions = property_conditions(pathEntry[pathEntry.find("[")+1:pathEntry.find("]")])
+        pathEntry = pathEntry[:pathEntry.find("[")]
+    elif "<" in pathEntry:
+        pathEntry = pathEntry[:pathEntry.find("<")]
+    #if the last character (before special characters) is 1 2 3 or 4, it is the number of neighbors
+    if pathEntry[-1] in nums:
+        return pathEntry[:-1], int(pathEntry[-1]), conditions
+    return pathEntry, None, conditions
+        
+def entry_mask(entry, atomData, cache):
+    """Return the boolean array of the atoms that fit a compiled path entry (symbol, number of
+    neighbors, property conditions), None being any; atomData are the atomic numbers, numbers
+    of neighbors and atom_properties of the molecule."""
+    if entry not in cache:
+        symbol, count, conditions = entry
+        z, degree, props = atomData
+        mask = np.ones(len(z), dtype=bool) if symbol is None else np.isin(z, atomicSymDict[symbol])
+        if count is not None:
+            mask &= degree == count
+        if conditions is not None:
+            mask &= np.array([property_match(conditions, prop) for prop in props], dtype=bool)
+        cache[entry] = mask
+    return cache[entry]
     
-    #try to confirm all matches, starting with bigger ones (more 'specific' paths)
-    #so as not to get false negatives
-    pathList.sort(key=len)
-    pathList.reverse()
-    #find all paths of the molecule with lengths specified in pathList
-    pathLengths = set([len(x) for x in pathList])
+def true_paths(mol, atomIndex, length, cache):
+    """Return the array of the molecule's paths of length atoms starting from the atom's
+    neighbors, which may turn back on themselves, in depth-first order."""
+    key = (atomIndex, length)
+    if key not in cache:
+        if length == 1:
+            paths = mol.neighbors(atomIndex).astype(int)[:,None]
+        else:
+            #extend each shorter path by each neighbor of its last atom
+            paths = true_paths(mol, atomIndex, length-1, cache)
+            last = paths[:,-1]
+            degree = mol.degree()[last]
+            rows = np.repeat(np.arange(len(paths)), degree)
+            offset = np.arange(len(rows)) - np.repeat(np.cumsum(degree) - degree, degree)
+            paths = np.column_stack((paths[rows], mol.nIndices[mol.nIndptr[last[rows]] + offset]))
+        cache[key] = paths
+    return cache[key]
+        
+def chem_env(paths, mol, atomIndex, atomData, caches):
+    """Return True if the atom matches the compiled F6 (subtle chemical environment) paths, False otherwise.
+    atomData are as in entry_mask; caches are the dicts of true_paths and of entry_mask."""
     
-    truePathList = []
-    def dfs(index, innerList, size):
-        newList = innerList[:]
-        newList.append(index)
-        if len(newList) < size:
-            for neighbor in mol.nList[index]:
-                dfs(neighbor, newList, size)
-        elif len(newList) == size:
-            truePathList.append(newList)
+    pathCache, maskCache = caches
+    #paths of the molecule with the lengths of those of the entry, and which are still unconsidered
+    alive = {len(path):np.ones(len(true_paths(mol, atomIndex, len(path), pathCache)), dtype=bool) for path in paths}
     
-    for length in pathLengths:
-        #find all the paths of said length, starting from atom
-        #recursive algorithm ala Molecule._configure_ring_lists
-        for neighbor in mol.nList[atomIndex]:
-            dfs(neighbor, [], length)
-        
-    #find conformance with pathList from entry and the true path list
-    #need to "unconsider" subpaths of longer paths that are chosen
-        
-    pathCount = 0
-    for path in pathList:
-        #search through each actual path to find matches
-        for truePath in truePathList:
-            
-            if len(truePath) != len(path):
-                continue
-            
-            #go through each path entry
-            entryCount = 0
-            for count, pathEntry in enumerate(path):
-                
-                if "[" in pathEntry:
-                    if atomic_prop(pathEntry[pathEntry.find("[")+1:pathEntry.find("]")], (mol, truePath[count])):
-                        #if atomic property match, go on to check atomic number and # neighbors
-                        pass
-                    else:
-                        #we already know it isn't a match, go to next path
-                        break
-                    charLoc = path.find("[")-1
-                elif "<" in pathEntry:
-                    charLoc = path.find("<")-1
-                else:
-                    charLoc = len(pathEntry)-1
-                    
-                #if the last character (before special characters) is 1 2 3 or 4, check number of neighbors
-                if pathEntry[charLoc] in nums:
-                    
-                    if len(mol.nList[truePath[count]]) == int(pathEntry[charLoc]):
-                        #go on to next check
-                        pass
-                    else:
-                        #we know this true path doesn't match the proposed match, so go to next true path
-                        break
-                    
-                    charLoc += -1   
+    for path in paths:
+        #find the first unconsidered actual path that matches
+        truePaths = true_paths(mol, atomIndex, len(path), pathCache)
+        match = alive[len(path)].copy()
+        for column, entry in enumerate(path):
+            match &= entry_mask(entry, atomData, maskCache)[truePaths[:,column]]
+        if not match.any():
+            return False
+        truePath = truePaths[np.argmax(match)]
+        #"unconsider" truePath and all of its subpaths
+        for length in alive:
+            if length <= len(path):
+                alive[length] &= np.any(true_paths(mol, atomIndex, length, pathCache) != truePath[:length], axis=1)
                 
-                #finally check atomic number
-                atomicNum = atomicSymDict[pathEntry[0:charLoc+1]]
-                
-                if mol.zList[truePath[count]] in atomicNum:
-                    entryCount += 1
-                else:
-                    break
-                
-            if entryCount == len(path):
-                #then we have a match for truePath and path
-                #delete truePath and all of its subpaths from truePathList
-                pathCount += 1
-                break
-        
-        truePathList = eliminate_subpaths(truePathList,truePath)
-                
-    if pathCount == len(pathList):
-        #then our atom matches the environment
-        return True
-    else:
-        return False
+    return True
 
 def path_parser(pathString, masterList, pathList):
     """A recursive function to parse F6 path entries."""
@@ -202,82 +279,3 @@ def path_parser(pathString, masterList, pathList):
             newList = pathList[:]
             newList.append(path)
             masterList.append(newList)
-
-
-funcList = [compare_int, compare_int, compare_int, compare_int, atomic_prop, chem_env]
-        
-def parse_line(line, atom, molecule):
-    """Return True and atomtype if atom matches a line entry, False otherwise."""
-
-    for entryIndex, entry in enumerate(line[3:]):
-        
-        atype = 'dummy'
-        
-        if entry == '&':
-            match = True
-            atype = line[1]
-            break
-        elif entry == '*':
-            continue
-        else:
-            input_ = find_input(molecule, atom, entryIndex)
-            entryMatch = funcList[entryIndex](entry, input_)
-            if entryMatch:
-                continue
-            else:
-                match = False
-                break
-            
-    return match, atype
-
-def find_input(molecule, atomIndex, funcIndex):
-    """Return the corresponding input for given entry checking function index."""
-    
-    if funcIndex == 0:
-        #return the atomic number
-        return molecule.zList[atomIndex]
-    elif funcIndex == 1:
-        #return the neighbor list
-        return len(molecule.nList[atomIndex])
-    elif funcIndex == 2:
-        #find how many of these neighbors are hydrogens and return that number
-        neighbors = molecule.nList[atomIndex]
-        hcount = 0
-        for neighbor in neighbors:
-            z = molecule.zList[neighbor]
-            if z == 1:
-                hcount += 1
-        return hcount
-    elif funcIndex == 3:
-        #find how many next nearest neighbors are `electron withdrawl` (N, O, F, Cl, Br), should be a single direct neighbor
-        neighbors = molecule.nList[atomIndex]
-        wcount = 0
-        for neighbor in neighbors:
-            nneighbors = [x for x in molecule.nList[neighbor] if x != atomIndex]
-            for nneighbor in nneighbors:
-                z = molecule.zList[nneighbor]
-                if z in [7,8,9,17,35]:
-                    wcount += 1
-        return wcount
-    elif funcIndex == 4:
-        #just return the whole molecule and atom we're working with
-        return (molecule, atomIndex)
-    elif funcIndex == 5:
-        #just return the whole molecule
-        return (molecule, atomIndex)
-    else:
-        #have yet to implement F7
-        return None
-        
-def eliminate_subpaths(masterList, path):
-    """Return a path list with the sub paths removed."""
-    
-    subPaths = [path[0:i] for i in range(len(path)+1)]
-    listCopy = masterList[:]
-    
-    for list_ in masterList:
-        for subPath in subPaths:
-            if list_ == subPath:
-                listCopy.remove(subPath)
-                
-    return listCopy     
\ No newline at end of file
@@ -256,7 +256,7 @@ def find_atomic_valences(mol):
     av = []
     
     #for each atom in the molecule search through the APS file and add all possible valence values
-    for z, nList in zip(mol.zList, mol.nList):
+    for z, degree in zip(mol.zList, mol.degree()):
         for line in [line for line in lines if line[0]=="APS"]:
             if int(line[2]) == z:
                 #check to see if con is specified
@@ -264,7 +264,7 @@ def find_atomic_valences(mol):
                     #then we have a match
                     av.append(parse_line(line))
                     break
-                elif int(line[3]) == len(nList):
+                elif int(line[3]) == degree:
                     #then we have a match
                     av.append(parse_line(line))
                     break
@@ -12,11 +12,12 @@ import time
 import pprint
 
 import numpy as np
+import scipy.sparse
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
 
 from .molecule import build, chains
-from .operation import _calculate_hessian
+from .operation import analytical_hessian, incremental_hessian
 import ballnspring
 
 amuDict = {1:1.008, 6:12.01, 7:14.01, 8:16.00, 9:19.00,
@@ -25,8 +26,15 @@ amuDict = {1:1.008, 6:12.01, 7:14.01, 8:16.00, 9:19.00,
 stapled_index = 30
            
 class Calculation:
+    """A set of trial molecules built by attaching chains to a common base molecule.
     
-    def __init__(self, base, gamma=10., **minkwargs):
+    Keywords:
+        gamma (float): Damping applied to the driven atoms.
+        hdepth (int): Number of bonds from the attached chains within which the base's
+            Hessian blocks are recalculated for a trial; farther ones are reused from the
+            cached base Hessian (see operation.incremental_hessian)."""
+    
+    def __init__(self, base, gamma=10., hdepth=3, **minkwargs):
         if len(base.faces) == 2:
             self.base = base
         else:
@@ -37,10 +45,14 @@ class Calculation:
         minimize(self.base, **minkwargs)
         #assign minimization attributes
         self.minkwargs = minkwargs
+        #the base Hessian is shared by every trial, see trial_hessian
+        self.hdepth = hdepth
+        self.base_hessian = analytical_hessian(self.base)
         #other attributes
         self.trialcount = 0
         self.trialList = []
         self.driverList = []
+        self.siteList = []
             
     def add(self, molList, indexList):
         """Append a trial molecule to self.trialList with enhancements 
@@ -64,6 +76,7 @@ class Calculation:
 #                dList[face1].append(hindex + sizetrial - 1)
         newTrial._configure()
         self.driverList.append(dList)
+        self.siteList.append(list(indexList))
         self.trialList.append(newTrial)
         from ._minimize import minimize
         minimize(newTrial, **self.minkwargs)
@@ -71,10 +84,17 @@ class Calculation:
         self.trialcount += 1
         return newTrial
         
+    def trial_hessian(self, trial):
+        """Return the sparse Hessian of a trial molecule, recalculating only the blocks
+        of the attached chains and of the interactions near the attachment sites."""
+        return incremental_hessian(self.base, self.base_hessian, self.trialList[trial],
+                                   self.siteList[trial], stapled_index, depth=self.hdepth)
+        
     def calculate_kappa(self, trial):
         from .plot import bonds
         bonds(self.trialList[trial])
-        return calculate_thermal_conductivity(self.trialList[trial], self.driverList[trial], len(self.base), self.gamma)
+        return calculate_thermal_conductivity(self.trialList[trial], self.driverList[trial], len(self.base), self.gamma,
+                                              kmat=self.trial_hessian(trial))
         
 class ParamSpaceExplorer(Calculation):
     
@@ -119,7 +139,7 @@ class ModeInspector(Calculation):
         super().__init__(base, gamma=gamma, **minkwargs)
         super().add(molList, indices)
         self.mol = self.trialList[0]
-        self.k = _calculate_hessian(self.mol, stapled_index, numgrad=False)
+        self.k = self.trial_hessian(0).toarray()
         self.N = len(self.k)
         self.dim = self.N//len(self.mol.mass)
         self.evec = ballnspring.calculate_thermal_evec(self.k, self.g, self.m)
@@ -267,10 +287,11 @@ def internal2interactions(internals):
 def find_interface_crossings(mol, baseSize):
     """Return the interactions that cross the molecular interfaces."""
     
-    crossings = []
+    crossings = [np.zeros((0,2), dtype=int)]
     atoms0 = mol.faces[0].attached
     atoms1 = mol.faces[1].attached
     
+    interactions = None
     if mol.ff.dihs:
         interactions = mol.dihList
     elif mol.ff.angles:
@@ -278,40 +299,28 @@ def find_interface_crossings(mol, baseSize):
     elif mol.ff.lengths:
         interactions = mol.bondList
     
-    try:
-        for it in interactions:
-            for atom in atoms0:
-                if atom in it:
-                    #find elements that are part of the base molecule
-                    #if there are any, then add them to interactions
-                    elements = [x for x in it if x < baseSize]
-                    for element in elements:
-                        crossings.append([atom, element])
-            for atom in atoms1:
-                if atom in it:
-                    elements = [x for x in it if x < baseSize]
-                    for element in elements:
-                        crossings.append([element, atom])
-    except UnboundLocalError:
-        pass
+    if interactions is not None and len(interactions) > 0:
+        interactions = np.asarray(interactions, dtype=int)
+        base = interactions < baseSize
+        for atoms, flip in ((atoms0, False), (atoms1, True)):
+            #every (attached atom, base atom) pair within an interaction
+            attached = np.isin(interactions, atoms)
+            rows, a, b = np.nonzero(attached[:,:,None] & base[:,None,:])
+            pairs = np.column_stack((interactions[rows,a], interactions[rows,b]))
+            crossings.append(pairs[:,::-1] if flip else pairs)
     
     # add nonbonded interactions
     # NOTE: this method only works if the interfacial atoms are indexed
     #   smaller than the side chains
     if mol.ff.lj or mol.ff.es:
-        for atom in atoms0:
-            x = np.intersect1d(np.where(mol.nbnList[:,1]==atom)[0], np.where(mol.nbnList[:,0] < baseSize)[0])
-            for nbn in mol.nbnList[x]:
-                crossings.append([atom, nbn[0]])
-        for atom in atoms1:
-            x = np.intersect1d(np.where(mol.nbnList[:,1]==atom)[0], np.where(mol.nbnList[:,0] < baseSize)[0])
-            for nbn in mol.nbnList[x]:
-                crossings.append([nbn[0], atom])
-    
+        nbnList = np.asarray(mol.nbnList, dtype=int).reshape(-1,2)
+        base = nbnList[:,0] < baseSize
+        for atoms, flip in ((atoms0, False), (atoms1, True)):
+            pairs = nbnList[base & np.isin(nbnList[:,1], atoms)]
+            crossings.append(pairs if flip else pairs[:,::-1])
                     
     # remove duplicate interactions
-    crossings.sort()
-    return list(k for k,_ in itertools.groupby(crossings))
+    return np.unique(np.concatenate(crossings), axis=0).tolist()
 
 def find_interface_crossings_old(mol, baseSize):
     """Return the interactions that cross the molecular interfaces."""
@@ -350,11 +359,22 @@ def find_interface_crossings_old(mol, baseSize):
     crossings.sort()
     return list(k for k,_ in itertools.groupby(crossings))
 
-def calculate_thermal_conductivity(mol, driverList, baseSize, gamma):
+def calculate_thermal_conductivity(mol, driverList, baseSize, gamma, kmat=None):
+    """Return the thermal conductivity of the molecule across its base's interfaces.
+    
+    The Hessian is assembled sparse, but ballnspring.kappa takes a dense matrix, so it
+    is still densified (3N by 3N) for that last step.
+    
+    Keywords:
+        kmat (ndarray or sparse matrix): Hessian of the molecule, e.g. from
+            Calculation.trial_hessian or operation.hessian; default is its analytical_hessian."""
     
     crossings = find_interface_crossings(mol, baseSize)
     
-    kmat = _calculate_hessian(mol, stapled_index, numgrad=False)
+    if kmat is None:
+        kmat = analytical_hessian(mol, stapled_index)
+    if scipy.sparse.issparse(kmat):
+        kmat = kmat.toarray()
     
     return ballnspring.kappa(mol.mass, kmat, driverList, crossings, gamma)
         
\ No newline at end of file
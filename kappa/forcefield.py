@@ -8,10 +8,16 @@ Define general Forcefield class, and specific forcefields (AMBER, etc.) that inh
 the general one.
 """
 
+import os
+
 import numpy as np
 
+from . import package_dir
+
 #forcefield class definitions
-global_cutoff = 5.0 #angstroms
+global_cutoff = 10.0 #angstroms, default non-bonded cutoff
+global_skin = 2.0    #angstroms, default Verlet skin of the non-bonded neighbor lists
+global_switch = 8.0  #angstroms, default distance the non-bonded energy starts switching off
 
 class Forcefield:
     """A classical forcefield that determines how atoms interact
@@ -28,10 +34,24 @@ class Forcefield:
             energy is an effective Fourier series of the angle(s).
         lj (bool): Determines Lennard-Jones non-bonded interactions.
         es (bool): Determines electrostatic point charge interactions.
-        tersoff (bool): Determines Tersoff-type interactions."""
+        tersoff (bool): Determines Tersoff-type interactions.
+    Keywords:
+        cutoff (float): Distance, in angstroms, beyond which non-bonded pairs don't interact.
+        skin (float): Extra distance, in angstroms, kept in the non-bonded neighbor lists so they
+            stay valid until an atom moves half of it.
+        switch (float): Distance, in angstroms, from which the Lennard-Jones energy is smoothly
+            switched off, reaching zero at the cutoff.  None for the plain, unswitched potential.
+        ljtable (bool): True to evaluate the switched Lennard-Jones energy and forces from
+            interpolated tables rather than analytically; needs a switch distance.
+        esmethod (str): How the electrostatics are summed, 'dsf' for the real-space damped
+            shifted force sum or 'mesh' for the particle-mesh (FFT) sum of isolated molecules;
+            the mesh has no analytical (sparse) or local finite difference Hessian.
+        esalpha (float): Electrostatic damping (splitting) parameter, in inverse angstroms;
+            None for the method's default."""
     
     def __init__(self, name, eunits, lunits,
-                 lengths, angles, dihs, imptors, lj, es, tersoff):
+                 lengths, angles, dihs, imptors, lj, es, tersoff, cutoff=global_cutoff, skin=global_skin,
+                 switch=global_switch, ljtable=False, esmethod="dsf", esalpha=None):
         self.name = name
         self.eunits = eunits    #relative to kcal/mol
         self.lunits = lunits    #relative to angstroms
@@ -43,109 +63,172 @@ class Forcefield:
         self.lj = lj                 #lennard-jones, non-bonded interaction
         self.es = es                 #electrostatic (point charge), non-bonded interaction
         self.tersoff = tersoff       #tersoff interaction
+        self.cutoff = cutoff         #non-bonded cutoff, angstroms
+        self.skin = skin             #non-bonded neighbor list skin, angstroms
+        self.switch = switch         #start of the non-bonded switching region, angstroms
+        self.ljtable = ljtable       #tabulated lennard-jones
+        self.esmethod = esmethod     #electrostatic summation, 'dsf' or 'mesh'
+        self.esalpha = esalpha       #electrostatic damping, inverse angstroms
+        
+    @property
+    def params(self):
+        """The process-wide ParameterTables of the forcefield's param_dir."""
+        return parameter_tables(self.param_dir)
+        
+    @property
+    def atomtype_rules(self):
+        """The process-wide compiled rules of the forcefield's atomtype_file."""
+        from .antechamber.atomtype.atomtype import compiled_rules
+        return compiled_rules(self.atomtype_file)
         
 class Amber(Forcefield):
     """Amber forcefield inheriting from Forcefield,
     as presented by Cornell et al. (1994)"""
     
-    def __init__(self, lengths=True, angles=False, dihs=False, imptors=False, lj=False):
+    def __init__(self, lengths=True, angles=False, dihs=False, imptors=False, lj=False, es=False,
+                 cutoff=global_cutoff, skin=global_skin, switch=global_switch, ljtable=False,
+                 esmethod="dsf", esalpha=None):
         super().__init__("amber", 1.0, 1.0,
-                         lengths, angles, dihs, imptors, lj, False, False)
+                         lengths, angles, dihs, imptors, lj, es, False, cutoff, skin,
+                         switch, ljtable, esmethod, esalpha)
         self.atomtype_file = "ATOMTYPE_AMBER_KERR.DEF"
         self.param_dir = "amber99"
 
 class Gaff(Forcefield):
     """General Amber Forcefield"""
     
-    def __init__(self, lengths=True, angles=False, dihs=False, imptors=False, lj=False):
+    def __init__(self, lengths=True, angles=False, dihs=False, imptors=False, lj=False, es=False,
+                 cutoff=global_cutoff, skin=global_skin, switch=global_switch, ljtable=False,
+                 esmethod="dsf", esalpha=None):
         super().__init__("amber", 1.0, 1.0,
-                         lengths, angles, dihs, imptors, lj, False, False)
+                         lengths, angles, dihs, imptors, lj, es, False, cutoff, skin,
+                         switch, ljtable, esmethod, esalpha)
         self.atomtype_file = "ATOMTYPE_GFF_KERR.DEF"
         self.param_dir = "gaff"
             
 class Tersoff(Forcefield):
-    """Under construction, a remnant of code past."""
+    """Tersoff's (1988) many-body forcefield of carbon, for pure-carbon bases like
+    graphene and nanotubes.  Each atom's bonds are those of its neighbor list, and
+    energies are in eV (see tersoff)."""
+    
+    def __init__(self, name="tersoff", energyUnits=0.0433634, lengthUnits=1.0):
+        super().__init__(name, energyUnits, lengthUnits,
+                         False, False, False, False, False, False, True)
+        #atom types are still assigned, from Amber's tables
+        self.atomtype_file = "ATOMTYPE_AMBER_KERR.DEF"
+        self.param_dir = "amber99"
+        
+#parameter tables by param_dir, shared by every forcefield (and molecule) of the process
+_parameterTables = {}
+
+def parameter_tables(param_dir):
+    """Return the ParameterTables of a parameter directory, creating them on first use."""
+    if param_dir not in _parameterTables:
+        _parameterTables[param_dir] = ParameterTables(os.path.join(package_dir, 'param', param_dir))
+    return _parameterTables[param_dir]
+        
+class ParameterTables:
+    """The parameter tables written by a param/*/parser.py, each loaded on first use
+    (numeric ones memory-mapped) and then kept.
+    
+    Bond and angle parameters are compact tables: the sorted keys of the atom type index
+    tuples that have parameters, in both orientations and encoded in the base of the
+    number of types, and the rows of (k, equilibrium value) of those keys.
     
-    def __init__(self, name="tersoff", energyUnits=0.043, lengthUnits=1.0):
-        super().__init__(self, "tersoff", 0.0433634, 1.0)
+    Args:
+        directory (str): Path of the parameter directory."""
+    
+    def __init__(self, directory):
+        self.directory = directory
+        self._tables = {}
         
-    def configure_parameters(self, molecule):
-        pass
+    def table(self, name):
+        """Return the array of the named table, e.g. 'rvdw0'."""
+        if name not in self._tables:
+            filename = os.path.join(self.directory, name + '.npy')
+            try:
+                self._tables[name] = np.load(filename, mmap_mode='r')
+            except ValueError:
+                #object arrays (the torsion types, with None for wildcards) can't be mapped
+                self._tables[name] = np.load(filename, allow_pickle=True)
+        return self._tables[name]
         
-    def define_energy_routine(self,molecule,grad=True):
+    @property
+    def atomtypes(self):
+        """Array of the names of the atom types, indexed by type id."""
+        return self.table('atomtypes')
         
-        atomList = molecule.atomList        
+    @property
+    def typeIds(self):
+        """Dict of the type id of each atom type name."""
+        if 'typeIds' not in self._tables:
+            self._tables['typeIds'] = {str(atomtype):count for count, atomtype in enumerate(self.atomtypes)}
+        return self._tables['typeIds']
         
-        #Tersoff potential terms
-        #define some constants, specific to carbon
-        A = 1.3936e3                 #eV
-        B = 3.467e2                  #eV
-        LAMBDA1 = 3.4879             #angstrom^-1
-        LAMBDA2 = 2.2119             #angstrom^-1
-        BETA = 1.5724e-7
-        N = 0.72751
-        C = 3.8049e4
-        D = 4.384
-        H = -5.7058e-1
+    def type_ids(self, atomtypes):
+        """Return the array of the type ids of atom type names, 0 for unknown types."""
+        typeIds = self.typeIds
+        return np.array([typeIds.get(atomtype, 0) for atomtype in atomtypes], dtype=int)
         
-        #values for calculating g(theta) terms
-        c2 = C*C
-        d2 = D*D
-        g1 = 1 + (c2/d2)
+    def _compact(self, name, dense):
+        """Return the (keys, rows) of a compact table, made from the dense table of
+        parameter directories written before compact tables."""
+        if name not in self._tables:
+            try:
+                self._tables[name] = self.table(name + '_keys'), self.table(name + '_params')
+            except FileNotFoundError:
+                denseArr = np.load(os.path.join(self.directory, dense + '.npy'))
+                nonzero = np.nonzero(np.any(denseArr != 0., axis=-1))
+                self._tables[name] = np.ravel_multi_index(nonzero, denseArr.shape[:-1]), denseArr[nonzero]
+        return self._tables[name]
         
-        #values for calculating bij terms
-        bijPower = -1/2/N
+    def _lookup(self, name, dense, types):
+        """Return the rows of a compact table for M by W type ids, zeros where there are none."""
+        keys, rows = self._compact(name, dense)
+        types = np.asarray(types, dtype=int)
+        code = np.ravel_multi_index(tuple(types.T), (len(self.atomtypes),)*types.shape[1])
+        found = np.searchsorted(keys, code)
+        exists = found < len(keys)
+        exists[exists] = keys[found[exists]] == code[exists]
+        params = np.zeros((len(code), rows.shape[1]))
+        params[exists] = rows[found[exists]]
+        return params
         
-        def calculate_e(index):
-            
-            e = 0.0
-            
-            if index is None:
-                eList = range(len(atomList))
-            else:
-                eList = atomList[index].nList[:]
-                eList.append(index)
-            
-            for i in eList:
+    def bond_params(self, types):
+        """Return the M by 2 array of (kb, b0) of the M by 2 type ids of bonds, zeros
+        for those without parameters."""
+        return self._lookup('bond', 'blengths', np.reshape(types, (-1,2)))
         
-                atomi = atomList[i]
-                posi = atomi.pos
-                ineighbors = atomi.nList
-                
-                for j in ineighbors:
-                    
-                    atomj = atomList[j]
-                    posj = atomj.pos
-                    posij = posi - posj
-                    rij = np.sqrt(posij.dot(posij))
-                    #initialize zetaij
-                    zetaij = 0.0
-                    
-                    for j2 in [x for x in ineighbors if x != j]:
-                        
-                        atomj2 = atomList[j2]
-                        posj2 = atomj2.pos
-                        
-                        posij2 = posi - posj2
-                        rij2 = np.sqrt(posij2.dot(posij2))       
-                        cosTheta = posij.dot(posij2)/rij/rij2
-                        gTerm = (H - cosTheta)*(H - cosTheta)
-                        g = g1 - c2/(d2 + gTerm)
-                        #increment zetaij by g
-                        zetaij += g
-                        
-                    fR = A*np.exp(-LAMBDA1*rij)
-                    fA = B*np.exp(-LAMBDA2*rij)
-                    
-                    #aij term
-        #            aij = 1
-                    
-                    #bond angle term
-                    bijTerm = 1 + np.power(BETA*zetaij, N)
-                    bij = np.power(bijTerm, bijPower)
-                    
-                    e += fR - (bij*fA)
-                
-            e *= 0.5
-            
-            return e
+    def angle_params(self, types):
+        """Return the M by 2 array of (kt, t0) of the M by 3 type ids of angles, zeros
+        for those without parameters."""
+        return self._lookup('angle', 'bangles', np.reshape(types, (-1,3)))
+        
+    def torsions(self, typeFile, vnFile):
+        """Return the dicts of the Fourier parameters ((2,4) arrays of vn and gn by periodicity)
+        of a dihedral (typeFile 'dih') or improper ('imp') table, keyed on the type ids of its
+        full definitions and of its wildcard definitions less the wildcards.  Dihedrals are
+        keyed as listed, impropers by center and then sorted outer types."""
+        #cached apart from the raw table of the same name
+        name = 'torsions:' + typeFile
+        if name not in self._tables:
+            typeArr, vnArr = self.table(typeFile), self.table(vnFile)
+            full, wild = {}, {}
+            for row, types in enumerate(typeArr):
+                if row > 0 and vnArr[row-1][2] < 0.:
+                    #continuation of the previous entry's Fourier series
+                    continue
+                values = np.zeros((2,4))
+                for vn, gn, pn in vnArr[row:]:
+                    values[:,abs(int(pn))-1] = vn, gn
+                    if pn >= 0.:
+                        break
+                known = [t for t in types if t is not None]
+                if typeFile == 'dih':
+                    key = tuple(known) if len(known) == 4 else tuple(types[1:3])
+                else:
+                    key = (known[-2],) + tuple(sorted(known[:-2] + known[-1:]))
+                #the first definition wins
+                (full if len(known) == 4 else wild).setdefault(key, values)
+            self._tables[name] = full, wild
+        return self._tables[name]
@@ -0,0 +1,480 @@
+# -*- coding: utf-8 -*-
+"""
+Define the ForceFieldKernel class, which evaluates the energy and gradient of a
+configured Molecule from contiguous index arrays, precomputed constants and
+reusable work buffers.
+"""
+
+import time
+
+import numpy as np
+import scipy.sparse
+
+from .nonbonded import Electrostatics, LennardJones
+from .tersoff import bond_energies
+
+#multiplicities of the dihedral Fourier series
+nfourier = np.array([1.,2.,3.,4.])
+
+class ForceFieldKernel:
+    """Energy and gradient evaluator of a configured molecule.  The index arrays and
+    parameters are copied once, angles and phases are kept in radians, and every
+    intermediate of the hot path is written into a preallocated buffer.
+
+    Args:
+        molecule (Molecule): Molecule whose forcefield terms are evaluated; its current
+            posList is read on each call."""
+
+    __slots__ = ('molecule', 'size', 'box', 'lengths', 'angles', 'dihs', 'imptors', 'lj', 'es',
+                 'tersoff', 'ljEngine', 'esEngine')
+
+    def __init__(self, molecule):
+        self.molecule = molecule
+        self.size = len(molecule)
+        cell = getattr(molecule, 'cell', None)
+        #periodic cell and its (pseudo)inverse, for minimum-image separations
+        self.box = None if cell is None else (cell, np.linalg.pinv(cell))
+        ff = molecule.ff
+        self.lengths = self.angles = self.dihs = self.imptors = self.lj = self.es = self.tersoff = None
+        self.ljEngine = self.esEngine = None
+
+        if ff.lengths:
+            self.lengths = _Term(molecule.bondList, self.size, self.box,
+                                 kb=molecule.kb, b0=molecule.b0)
+        if ff.angles:
+            #degrees to radians, folded into the spring constant
+            self.angles = _Term(molecule.angleList, self.size, self.box,
+                                kt=molecule.kt*(180./np.pi)**2, t0=np.radians(molecule.t0))
+        if ff.dihs:
+            self.dihs = _Term(molecule.dihList, self.size, self.box,
+                              vn=molecule.vn, gn=np.radians(molecule.gn), mvn=nfourier*molecule.vn)
+        if ff.imptors:
+            self.imptors = _Term(molecule.imptorsList, self.size, self.box,
+                                 vn=molecule.vni, gn=np.radians(molecule.gni), mvn=nfourier*molecule.vni)
+        if ff.tersoff:
+            clusters = molecule.tersoffList
+            self.tersoff = _Term(clusters, self.size, self.box,
+                                 mask=clusters[:,2:] != clusters[:,:1])
+            self.tersoff.neighbors = np.ascontiguousarray(clusters[:,2:])
+        if ff.lj:
+            self.ljEngine = LennardJones(molecule)
+        if ff.es:
+            self.esEngine = Electrostatics(molecule)
+        self._configure_pairs()
+
+    def _configure_pairs(self):
+        """(Re)build the pair terms (Lennard-Jones, electrostatics) for the molecule's
+        current pair list."""
+        molecule = self.molecule
+        pairs = np.asarray(molecule.nbnList, dtype=int).reshape(-1,2)
+        for name, engine in (('lj', self.ljEngine), ('es', self.esEngine)):
+            if engine is not None:
+                term = _Term(pairs, self.size, self.box, source=molecule.nbnList)
+                term.engine = engine
+                term.types = engine.pair_types(pairs[:,0], pairs[:,1])
+                setattr(self, name, term)
+                
+    def _stale_pairs(self):
+        #the minimizers rebuild the pair list
+        term = self.lj if self.lj is not None else self.es
+        return term is not None and term.source is not self.molecule.nbnList
+
+    def energy(self, positions=None):
+        """Return the energy of the molecule, or the K energies of a K x N x 3 stack
+        of candidate configurations evaluated together (posList is left untouched)."""
+        if positions is None:
+            return self._evaluate(None)
+        positions = np.asarray(positions, dtype=float)
+        if positions.ndim == 2:
+            return self._evaluate_batch(positions[None])[0]
+        return self._evaluate_batch(positions)
+
+    def energy_gradient(self, out=None):
+        """Return the energy of the molecule and its N x 3 gradient, written into
+        `out' if given (the minimizers keep past gradients, so a new array by default)."""
+        if out is None:
+            out = np.zeros((self.size,3))
+        else:
+            out.fill(0.)
+        return self._evaluate(out), out
+
+    def _evaluate(self, grad):
+        pos = self.molecule.posList
+        e = 0.0 #base energy level
+        if self._stale_pairs():
+            self._configure_pairs()
+        profile = getattr(self.molecule, 'termProfile', None)
+
+        for name, func, _ in _term_funcs:
+            term = getattr(self, name)
+            if term is None:
+                continue
+            if profile is None:
+                e += func(term, pos, grad)
+            else:
+                e += _record(profile, name, func, term, pos, grad)
+
+        return e
+        
+    def _evaluate_batch(self, positions):
+        e = np.zeros(len(positions)) #base energy level
+        if self._stale_pairs():
+            self._configure_pairs()
+        profile = getattr(self.molecule, 'termProfile', None)
+
+        for name, _, func in _term_funcs:
+            term = getattr(self, name)
+            if term is None:
+                continue
+            if profile is None:
+                e += func(term, positions)
+            else:
+                e += _record(profile, name, func, term, positions, batch=True)
+
+        return e
+
+class _Term:
+    """Index arrays, parameters and work buffers of one forcefield term."""
+
+    __slots__ = ('index', 'params', 'scatter', 'stack', 'vec', 'norm', 'cross', 'scalar',
+                 'phase', 'sine', 'source', 'box', 'engine', 'types', 'neighbors')
+
+    def __init__(self, interactions, size, box=None, source=None, **params):
+        interactions = np.asarray(interactions, dtype=int)
+        m, k = interactions.shape
+        self.index = [np.ascontiguousarray(column) for column in interactions.T]
+        self.params = {key:np.ascontiguousarray(val, dtype=float) for key, val in params.items()}
+        self.scatter = scatter_operator(interactions, size)
+        #per-atom contributions, stacked by position in the interaction
+        self.stack = np.zeros((k*m,3))
+        self.vec = np.zeros((4,m,3))
+        self.norm = np.zeros((4,m))
+        self.cross = np.zeros((3,m,3))
+        self.scalar = np.zeros((4,m))
+        self.phase = np.zeros((m,len(nfourier)))
+        self.sine = np.zeros((m,len(nfourier)))
+        self.source = source
+        self.box = box
+        self.engine = self.types = self.neighbors = None
+
+    def block(self, position):
+        """Return the rows of the stack that belong to the atom at this position."""
+        m = len(self.index[0])
+        return self.stack[position*m:(position+1)*m]
+
+def _difference(pos, i, j, out, tmp, box=None):
+    """out = pos[i] - pos[j], taken to the nearest periodic image if a box is given,
+    with tmp an M x 3 array of scratch."""
+    np.take(pos, i, axis=0, out=out)
+    out -= np.take(pos, j, axis=0, out=tmp)
+    if box is not None:
+        cell, icell = box
+        np.matmul(out, icell, out=tmp)
+        np.rint(tmp, out=tmp)
+        out -= tmp @ cell
+    return out
+
+def _norm(vec, out):
+    np.einsum('ij,ij->i', vec, vec, out=out)
+    return np.sqrt(out, out=out)
+
+def _cross(a, b, out, tmp):
+    """out = a x b, row-wise, with tmp an M array of scratch."""
+    for q, (r, s) in enumerate(((1,2), (2,0), (0,1))):
+        np.multiply(a[:,r], b[:,s], out=out[:,q])
+        np.multiply(a[:,s], b[:,r], out=tmp)
+        out[:,q] -= tmp
+    return out
+
+def _scatter(term, grad):
+    grad += term.scatter @ term.stack
+
+def _lengths(term, pos, grad):
+    i, j = term.index
+    kb, b0 = term.params['kb'], term.params['b0']
+    posij, rij, dr = term.vec[0], term.norm[0], term.scalar[0]
+    _difference(pos, i, j, posij, term.vec[1], term.box)
+    _norm(posij, rij)
+    np.subtract(rij, b0, out=dr)
+    e = np.einsum('i,i,i->', kb, dr, dr)
+    if grad is not None:
+        #2 kb (r - b0)/r
+        dr *= kb
+        dr *= 2.
+        dr /= rij
+        np.multiply(dr[:,None], posij, out=term.block(0))
+        np.negative(term.block(0), out=term.block(1))
+        _scatter(term, grad)
+    return e
+
+def _angles(term, pos, grad):
+    i, j, k = term.index
+    kt, t0 = term.params['kt'], term.params['t0']
+    posij, poskj = term.vec[0], term.vec[1]
+    rij, rkj, cosTheta, dt = term.norm[0], term.norm[1], term.norm[2], term.norm[3]
+    _difference(pos, i, j, posij, term.vec[2], term.box)
+    _difference(pos, k, j, poskj, term.vec[2], term.box)
+    _norm(posij, rij)
+    _norm(poskj, rkj)
+    np.einsum('ij,ij->i', posij, poskj, out=cosTheta)
+    cosTheta /= rij
+    cosTheta /= rkj
+    np.arccos(cosTheta, out=dt)
+    dt -= t0
+    e = np.einsum('i,i,i->', kt, dt, dt)
+    if grad is not None:
+        uTerm, sinTheta = term.scalar[0], term.scalar[1]
+        #u = 2 kt (theta - t0)/sin(theta)
+        np.multiply(cosTheta, cosTheta, out=sinTheta)
+        np.subtract(1., sinTheta, out=sinTheta)
+        np.sqrt(sinTheta, out=sinTheta)
+        np.multiply(kt, dt, out=uTerm)
+        uTerm *= 2.
+        uTerm /= sinTheta
+        dtdri, dtdrk = term.block(0), term.block(2)
+        #dtheta/dri = (cos posij/rij - poskj/rkj)/(rij sin), and likewise for k
+        np.divide(cosTheta, rij, out=term.scalar[2])
+        np.multiply(term.scalar[2][:,None], posij, out=dtdri)
+        np.divide(poskj, rkj[:,None], out=term.vec[2])
+        dtdri -= term.vec[2]
+        np.divide(uTerm, rij, out=term.scalar[2])
+        dtdri *= term.scalar[2][:,None]
+        np.divide(cosTheta, rkj, out=term.scalar[2])
+        np.multiply(term.scalar[2][:,None], poskj, out=dtdrk)
+        np.divide(posij, rij[:,None], out=term.vec[2])
+        dtdrk -= term.vec[2]
+        np.divide(uTerm, rkj, out=term.scalar[2])
+        dtdrk *= term.scalar[2][:,None]
+        np.add(dtdri, dtdrk, out=term.block(1))
+        np.negative(term.block(1), out=term.block(1))
+        _scatter(term, grad)
+    return e
+
+def _torsions(term, pos, grad):
+    i, j, k, l = term.index
+    vn, gn, mvn = term.params['vn'], term.params['gn'], term.params['mvn']
+    posij, poskj, poskl, tmp = term.vec
+    cross12, cross23, m1 = term.cross
+    rkj, c12, c23, scratch = term.norm
+    _difference(pos, i, j, posij, tmp, term.box)
+    _difference(pos, k, j, poskj, tmp, term.box)
+    _difference(pos, k, l, poskl, tmp, term.box)
+    _norm(poskj, rkj)
+    #cross12 = (rj - ri) x rkj, cross23 = rkj x (rl - rk)
+    _cross(poskj, posij, cross12, scratch)
+    _cross(poskl, poskj, cross23, scratch)
+    _norm(cross12, c12)
+    _norm(cross23, c23)
+    #omega = atan2(m1.n2, n1.n2), with m1 = n1 x rkj/|rkj|
+    _cross(cross12, poskj, m1, scratch)
+    x, y = term.scalar[0], term.scalar[1]
+    np.einsum('ij,ij->i', cross12, cross23, out=x)
+    np.einsum('ij,ij->i', m1, cross23, out=y)
+    y /= rkj
+    omega = term.scalar[2]
+    np.arctan2(y, x, out=omega)
+    phase = term.phase
+    np.multiply(omega[:,None], nfourier, out=phase)
+    phase -= gn
+    if grad is not None:
+        uTerm = term.scalar[3]
+        np.sin(phase, out=term.sine)
+        np.einsum('ij,ij->i', mvn, term.sine, out=uTerm)
+    np.cos(phase, out=phase)
+    phase += 1.
+    e = np.einsum('ij,ij->', vn, phase)
+    if grad is not None:
+        dwdri, dwdrj, dwdrk, dwdrl = term.block(0), term.block(1), term.block(2), term.block(3)
+        #dw/dri = -rkj cross12/|cross12|^2, dw/drl = rkj cross23/|cross23|^2
+        np.multiply(c12, c12, out=scratch)
+        np.divide(rkj, scratch, out=scratch)
+        np.multiply(cross12, -scratch[:,None], out=dwdri)
+        np.multiply(c23, c23, out=scratch)
+        np.divide(rkj, scratch, out=scratch)
+        np.multiply(cross23, scratch[:,None], out=dwdrl)
+        dotijkj, dotklkj = x, y
+        np.multiply(rkj, rkj, out=scratch)
+        np.einsum('ij,ij->i', posij, poskj, out=dotijkj)
+        dotijkj /= scratch
+        np.einsum('ij,ij->i', poskl, poskj, out=dotklkj)
+        dotklkj /= scratch
+        #dw/drj = (dotijkj - 1) dw/dri - dotklkj dw/drl
+        np.subtract(dotijkj, 1., out=scratch)
+        np.multiply(scratch[:,None], dwdri, out=dwdrj)
+        np.multiply(dotklkj[:,None], dwdrl, out=tmp)
+        dwdrj -= tmp
+        #dw/drk = (dotklkj - 1) dw/drl - dotijkj dw/dri
+        np.subtract(dotklkj, 1., out=scratch)
+        np.multiply(scratch[:,None], dwdrl, out=dwdrk)
+        np.multiply(dotijkj[:,None], dwdri, out=tmp)
+        dwdrk -= tmp
+        for dwdr in (dwdri, dwdrj, dwdrk, dwdrl):
+            dwdr *= uTerm[:,None]
+        _scatter(term, grad)
+    return e
+
+def _pairs(term, pos, grad):
+    #the pair energies come from the term's shared engine (Lennard-Jones or electrostatics)
+    i, j = term.index
+    posij, s = term.vec[0], term.norm[0]
+    _difference(pos, i, j, posij, term.vec[1], term.box)
+    np.einsum('ij,ij->i', posij, posij, out=s)
+    if grad is None:
+        return np.sum(term.engine.energy(s, term.types))
+    u, du = term.engine.derivatives(s, term.types)
+    np.multiply(du[:,None], posij, out=term.block(0))
+    np.negative(term.block(0), out=term.block(1))
+    _scatter(term, grad)
+    return np.sum(u)
+
+#batched energies, positions is a K x N x 3 stack; these allocate K-fold temporaries
+
+def _batch_difference(positions, i, j, box=None):
+    posij = positions[:,i]
+    posij -= positions[:,j]
+    if box is not None:
+        cell, icell = box
+        posij -= np.rint(posij @ icell) @ cell
+    return posij
+
+def _batch_norm(vec):
+    return np.sqrt(np.einsum('kmi,kmi->km', vec, vec))
+
+def _batch_lengths(term, positions):
+    i, j = term.index
+    rij = _batch_norm(_batch_difference(positions, i, j, term.box))
+    return np.einsum('j,kj->k', term.params['kb'], (rij - term.params['b0'])**2)
+
+def _batch_angles(term, positions):
+    i, j, k = term.index
+    posij = _batch_difference(positions, i, j, term.box)
+    poskj = _batch_difference(positions, k, j, term.box)
+    cosTheta = np.einsum('kmi,kmi->km', posij, poskj)
+    cosTheta /= _batch_norm(posij)*_batch_norm(poskj)
+    dt = np.arccos(cosTheta) - term.params['t0']
+    return np.einsum('j,kj->k', term.params['kt'], dt*dt)
+
+def _batch_torsions(term, positions):
+    i, j, k, l = term.index
+    posji = _batch_difference(positions, j, i, term.box)
+    poskj = _batch_difference(positions, k, j, term.box)
+    poslk = _batch_difference(positions, l, k, term.box)
+    cross12 = np.cross(posji, poskj)
+    cross23 = np.cross(poskj, poslk)
+    #unnormalized n1.n2 and m1.n2 have the same common positive factor, which atan2 ignores
+    x = np.einsum('kmi,kmi->km', cross12, cross23)
+    y = np.einsum('kmi,kmi->km', np.cross(cross12, poskj), cross23)/_batch_norm(poskj)
+    omega = np.arctan2(y, x)
+    phase = omega[:,:,None]*nfourier - term.params['gn']
+    return np.einsum('mn,kmn->k', term.params['vn'], 1. + np.cos(phase))
+
+def _tersoff(term, pos, grad):
+    #bond clusters: the directed bond (i,j), then the other neighbors of i
+    i, j = term.index[0], term.index[1]
+    vij = _batch_difference(pos[None], j, i, term.box)[0]
+    vik = _batch_difference(pos[None], term.neighbors, i[:,None], term.box)[0]
+    if grad is None:
+        return np.sum(bond_energies(vij, vik, term.params['mask']))
+    e, gij, gik = bond_energies(vij, vik, term.params['mask'], order=1)
+    np.sum(gik, axis=1, out=term.block(0))
+    term.block(0)[:] += gij
+    np.negative(term.block(0), out=term.block(0))
+    term.block(1)[:] = gij
+    for q in range(gik.shape[1]):
+        term.block(q+2)[:] = gik[:,q]
+    _scatter(term, grad)
+    return np.sum(e)
+
+def _electrostatics(term, pos, grad):
+    #the pairs within the cutoff, then the self energy and any long-range remainder
+    return _pairs(term, pos, grad) + term.engine.remainder(pos, grad)
+
+def _batch_pairs(term, positions):
+    i, j = term.index
+    posij = _batch_difference(positions, i, j, term.box)
+    s = np.einsum('kmi,kmi->km', posij, posij)
+    return np.sum(term.engine.energy(s, term.types), axis=1)
+
+def _batch_tersoff(term, positions):
+    i, j = term.index[0], term.index[1]
+    vij = _batch_difference(positions, j, i, term.box)
+    vik = _batch_difference(positions, term.neighbors, i[:,None], term.box)
+    return np.sum(bond_energies(vij, vik, term.params['mask']), axis=1)
+
+def _batch_electrostatics(term, positions):
+    return _batch_pairs(term, positions) + np.array([term.engine.remainder(pos) for pos in positions])
+
+#(kernel attribute, single evaluation, batched energy) of each term, in evaluation order
+_term_funcs = (('lengths', _lengths, _batch_lengths),
+               ('angles', _angles, _batch_angles),
+               ('dihs', _torsions, _batch_torsions),
+               ('imptors', _torsions, _batch_torsions),
+               ('lj', _pairs, _batch_pairs),
+               ('es', _electrostatics, _batch_electrostatics),
+               ('tersoff', _tersoff, _batch_tersoff))
+
+def _record(profile, name, func, term, pos, grad=None, batch=False):
+    """Evaluate one term and record its call count, wall time, energy and largest
+    gradient component in profile[name]; see Molecule.profile_terms.  Batched
+    functions take a stack of positions and no gradient."""
+    stats = profile.setdefault(name, {'calls':0, 'time':0., 'energy':None, 'maxForce':None})
+    start = time.perf_counter()
+    if batch:
+        e = func(term, pos)
+    elif grad is None:
+        e = func(term, pos, None)
+    else:
+        #the term's own gradient, to measure its forces alone
+        termGrad = np.zeros_like(grad)
+        e = func(term, pos, termGrad)
+        grad += termGrad
+    stats['time'] += time.perf_counter() - start
+    stats['calls'] += 1
+    stats['energy'] = e
+    if grad is None:
+        stats['maxForce'] = None
+    else:
+        stats['maxForce'] = np.amax(np.abs(termGrad)) if termGrad.size else 0.
+    return e
+
+def minimum_image(vec, cell, icell=None):
+    """Return the separation vectors (rows of vec) taken to their nearest periodic images.
+    Rounding the fractional coordinates finds the nearest image only for orthogonal cell
+    vectors (see cell_widths), which Molecule enforces.
+    
+    Args:
+        vec (ndarray): M by 3 array of separations.
+        cell (ndarray): 3 by 3 array whose rows are the orthogonal periodic cell vectors; a row
+            of zeros leaves that direction non-periodic.  None for no periodicity.
+    Keywords:
+        icell (ndarray): Precomputed pseudoinverse of cell."""
+    if cell is None:
+        return vec
+    if icell is None:
+        icell = np.linalg.pinv(cell)
+    return vec - np.rint(vec @ icell) @ cell
+
+def cell_widths(cell):
+    """Return the perpendicular widths of the periodic directions (nonzero rows) of cell,
+    the distances between its opposite faces.  A separation is its own nearest image only
+    while it is under half the smallest width.
+    
+    Args:
+        cell (ndarray): 3 by 3 array whose rows are the periodic cell vectors."""
+    periodic = np.any(cell, axis=1)
+    #the columns of the pseudoinverse are the reciprocal vectors of the periodic rows
+    return 1./np.linalg.norm(np.linalg.pinv(cell)[:,periodic], axis=0)
+
+def scatter_operator(interactions, size):
+    """Return the sparse size by k*M incidence matrix that sums per-interaction contributions,
+    stacked by position in the interaction (all the first atoms' rows, then the second's, ...),
+    onto the atoms they act on.
+
+    Args:
+        interactions (ndarray): M by k array of atom indices, like bondList or dihList.
+        size (int): Number of atoms in the molecule."""
+
+    interactions = np.asarray(interactions, dtype=int)
+    atoms = interactions.T.ravel()
+    return scipy.sparse.csr_matrix((np.ones(len(atoms)), (atoms, np.arange(len(atoms)))),
+                                   shape=(size, len(atoms)))
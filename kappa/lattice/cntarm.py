@@ -213,3 +213,38 @@ def resize(rmin, honeyLattice):
         
     return finalSheet    
     
+def main_periodic(radius, length):
+    '''Return the positions, nearest neighbors and cell of a tube that is periodic along its axis (y);
+    length is its number of lattice rows, and must be even.'''
+    
+    if length % 2:
+        raise ValueError("A periodic tube needs an even number of rows")
+    
+    a = 1
+    rmin = 1.40
+    triList = triangular_lattice(a, radius, length)
+    hexList = hexagonal_lattice(a, triList)
+    finalSheet = curl(resize(rmin, hexList), a, rmin)
+    
+    #rows are a/2 apart before resizing
+    cell = np.array([[0.,0.,0.], [0.,length*(a/2.)*rmin*np.sqrt(3),0.], [0.,0.,0.]])
+    
+    nList = find_neighbors_periodic(a, rmin, finalSheet, cell)
+    
+    return finalSheet, nList, cell
+    
+def find_neighbors_periodic(a, rmin, posList, cell):
+    '''Create the list of nearest neighbor lists, with separations taken to the nearest periodic image.'''
+    
+    posList = np.array(posList)
+    icell = np.linalg.pinv(cell)
+    
+    neighList = []
+    for i, ipos in enumerate(posList):
+        sep = posList - ipos
+        sep -= np.rint(sep.dot(icell)).dot(cell)
+        rij = np.linalg.norm(sep, axis=1)
+        neighbors = [int(j) for j in np.where(rij < (a*rmin + 0.1))[0] if j != i]
+        neighList.append(neighbors)
+        
+    return neighList
@@ -203,4 +203,43 @@ def resize(rmin, honeyLattice):
         finalSheet.append(rescaledPoint)
         
     return finalSheet
-        
\ No newline at end of file
+        
+def main_periodic(width, length):
+    """Return the positions, nearest neighbors and cell of a rectangular, periodic graphene sheet
+    of width by length rectangular unit cells (4 atoms each), armchair edges along x."""
+    
+    #bond length, as in the finite flake
+    rmin = 1.45
+    
+    #rectangular unit cell and its basis
+    ax, ay = 3.*rmin, np.sqrt(3)*rmin
+    basis = [[0.,0.], [rmin,0.], [1.5*rmin,ay/2.], [2.5*rmin,ay/2.]]
+    
+    finalSheet = []
+    for i in range(width):
+        for j in range(length):
+            for bx,by in basis:
+                finalSheet.append([i*ax + bx, j*ay + by, 0.0])
+                
+    #periodic in the plane of the sheet only
+    cell = np.array([[width*ax,0.,0.], [0.,length*ay,0.], [0.,0.,0.]])
+    
+    nList = find_neighbors_periodic(rmin, finalSheet, cell)
+    
+    return finalSheet, nList, cell
+    
+def find_neighbors_periodic(rmin, posList, cell):
+    """Create the list of nearest neighbor lists, with separations taken to the nearest periodic image."""
+    
+    posList = np.array(posList)
+    icell = np.linalg.pinv(cell)
+    
+    neighList = []
+    for i, ipos in enumerate(posList):
+        sep = posList - ipos
+        sep -= np.rint(sep.dot(icell)).dot(cell)
+        rij = np.linalg.norm(sep, axis=1)
+        neighbors = [int(j) for j in np.where(rij < (rmin + 0.1))[0] if j != i]
+        neighList.append(neighbors)
+        
+    return neighList
@@ -7,13 +7,20 @@ Created on Mon Mar 21 13:09:30 2016
 Define the Molecule class and a set of functions that `build' preset molecules.
 """
 
+import itertools
 import random
 import warnings
+from contextlib import contextmanager
 from copy import deepcopy
 
 import numpy as np
+import scipy.sparse
+import scipy.spatial
 
-from . import package_dir
+from .forcefield import global_cutoff, global_skin
+from .kernel import ForceFieldKernel, cell_widths, minimum_image, scatter_operator
+from .nonbonded import Electrostatics, LennardJones
+from .tersoff import bond_clusters, cluster_gradient
 
 #change in position for the finite difference equations
 ds = 1e-5
@@ -32,6 +39,18 @@ vdz = np.array([0.0,0.0,dz])
 
 amuDict = {1:1.008, 6:12.01, 7:14.01, 8:16.00, 9:19.00,
            15:30.79, 16:32.065, 17:35.45, 35:79.904}
+
+#Gasteiger-Marsili electronegativity parameters (a, b, c), volts, chi = a + b q + c q^2,
+#by atomic number and then number of neighbors (standing in for the hybridization)
+gasteigerDict = {1:{1:(7.17, 6.24, -0.56)},
+                 6:{4:(7.98, 9.18, 1.88), 3:(8.79, 9.32, 1.51), 2:(10.39, 9.45, 0.73)},
+                 7:{3:(11.54, 10.82, 1.36), 2:(12.87, 11.15, 0.85), 1:(15.68, 11.70, -0.27)},
+                 8:{2:(14.18, 12.92, 1.39), 1:(17.07, 13.79, 0.47)},
+                 9:{1:(14.66, 13.85, 2.31)},
+                 15:{4:(8.90, 8.24, 0.96)},
+                 16:{2:(10.14, 9.13, 1.38), 1:(10.88, 9.49, 1.33)},
+                 17:{1:(11.00, 9.69, 1.35)},
+                 35:{1:(10.08, 8.47, 1.16)}}
         
 class Molecule:
     """A molecule, representing a collection of interacting atoms
@@ -47,14 +66,31 @@ class Molecule:
         cbase (bool):  True if instantiated Molecule is to be designated as a carbon base structure, basically
             one of the few canonical, 2-interface, macromolecules we're trying to calculate thermal conductivity of
             like graphene, cnts, etc.
+        cell (ndarray): 3 by 3 array whose rows are the vectors of a periodic cell; interactions
+            are then taken between nearest periodic images.  A row of zeros leaves that direction
+            non-periodic (e.g. a tube periodic along its axis only).  The periodic vectors must be
+            orthogonal, and with non-bonded terms the forcefield's cutoff plus skin must be under half
+            the cell's smallest periodic width.  Default is no periodicity.
+            
+    Connectivity:
+        nIndptr, nIndices (ndarray): The bonding as a compressed sparse row (CSR) adjacency of
+            int32 arrays, the neighbors of atom i being nIndices[nIndptr[i]:nIndptr[i+1]].
+            nList is derived from these on demand; assign a new nested list to nList to change them.
+        ringList (list): Sorted lists of the atoms of each relevant ring (up to 9 atoms), after configuration.
+        ringIndptr, ringIndices (ndarray): The rings of each atom as a CSR index into ringList, see rings().
             
     Forcefield Parameters (if applicable):
         kb (ndarray): Array of harmonic bond stretching spring constants indexed like bondList.
         b0 (ndarray): Array of harmonic bond stretching equilibrium displacements indexed like bondList.
         kt (ndarray): Array of harmonic bond bending spring constants indexed like angleList.
-        t0 (ndarray): Array of harmonic bond bending equilibirum displacements indexed like angleList."""
-    
-    def __init__(self, ff, name, posList, nList, zList, cbase=False):
+        t0 (ndarray): Array of harmonic bond bending equilibirum displacements indexed like angleList.
+        vn, gn (ndarray): Arrays of the dihedral Fourier amplitudes and phases (degrees) by
+            periodicity 1 to 4, indexed like dihList.
+        vni, gni (ndarray): The same for the improper torsionals, indexed like imptorsList.
+        charges (ndarray): Array of partial charges (e), indexed like posList; may be overwritten
+            with other charges after configuration."""
+    
+    def __init__(self, ff, name, posList, nList, zList, cbase=False, cell=None):
         self.ff = ff
         self.name = name
         self.posList = np.array(posList)
@@ -62,10 +98,53 @@ class Molecule:
         self.zList = np.array(zList)
         self.faces = []
         self.cbase = cbase
+        self.cell = None if cell is None else np.array(cell, dtype=float)
+        if self.cell is not None:
+            #nearest images are found by rounding fractional coordinates, see minimum_image
+            vectors = self.cell[np.any(self.cell, axis=1)]
+            gram = vectors @ vectors.T
+            if np.any(np.abs(gram - np.diag(np.diag(gram))) > 1e-8*np.amax(gram)):
+                raise ValueError("The periodic cell vectors must be orthogonal")
+        self.termProfile = None
         
     def __len__(self):
         return self.posList.shape[0]
         
+    def __setstate__(self, state):
+        #molecules saved before the CSR adjacency kept the nested list
+        nList = state.pop('nList', None)
+        self.__dict__.update(state)
+        if nList is not None:
+            self.nList = nList
+        
+    @property
+    def nList(self):
+        """List of lists of each atom's neighbors, a view derived from the CSR adjacency."""
+        view = self.__dict__.get('_nListView')
+        if view is None or view[0] is not self.nIndptr or view[1] is not self.nIndices:
+            nList = [row.tolist() for row in np.split(self.nIndices, self.nIndptr[1:-1])]
+            view = (self.nIndptr, self.nIndices, nList)
+            self._nListView = view
+        return view[2]
+        
+    @nList.setter
+    def nList(self, nList):
+        self.nIndptr, self.nIndices = _csr_adjacency(nList)
+        
+    def neighbors(self, index):
+        """Return the array of the neighbors of an atom."""
+        return self.nIndices[self.nIndptr[index]:self.nIndptr[index+1]]
+        
+    def degree(self):
+        """Return the array of the number of neighbors of each atom."""
+        return np.diff(self.nIndptr)
+        
+    def adjacency(self):
+        """Return the adjacency of the atoms as a sparse N by N CSR matrix."""
+        size = len(self.nIndptr) - 1
+        return scipy.sparse.csr_matrix((np.ones(len(self.nIndices), dtype=np.int8), self.nIndices, self.nIndptr),
+                                       shape=(size,size))
+        
     def __str__(self):
         return self.name
         
@@ -91,6 +170,8 @@ class Molecule:
                            [uz*ux*(1.-cos)-uy*sin, uz*uy*(1.-cos)+ux*sin, cos+uz*uz*(1.-cos)]])
         #rotate points & interfaces
         self.posList = np.transpose(np.dot(rotMat,np.transpose(self.posList)))
+        if getattr(self, 'cell', None) is not None:
+            self.cell = np.transpose(np.dot(rotMat, np.transpose(self.cell)))
         for face in self.faces:
             face.pos = np.transpose(np.dot(rotMat, np.transpose(face.pos)))
             face.norm = np.transpose(np.dot(rotMat, np.transpose(face.norm)))
@@ -129,12 +210,40 @@ class Molecule:
         self.hcap = np.arange(size1, size2, dtype=int)
         return self
         
+    @contextmanager
+    def profile_terms(self):
+        """Context manager that records, while open, the cost of each forcefield term
+        in every energy and gradient evaluation of the molecule, e.g.
+        
+            with mol.profile_terms() as profile:
+                kappa.minimize(mol)
+            profile['lj']['time']
+            
+        The yielded dict maps each term name ('lengths', 'angles', 'dihs', 'imptors', 'lj', 'es',
+        'tersoff')
+        to its 'calls', cumulative wall 'time' (s), last 'energy' contribution (an array
+        after a batched evaluation) and last 'maxForce', the largest gradient component
+        (None after energy-only and batched calls).  Evaluations in worker processes are not recorded."""
+        
+        profile = {}
+        self.termProfile = profile
+        try:
+            yield profile
+        finally:
+            self.termProfile = None
+            
+    def _separation(self, i, j):
+        """Return the separation vectors posList[i] - posList[j], taken to the nearest
+        periodic images if the molecule has a cell."""
+        return minimum_image(self.posList[i] - self.posList[j], getattr(self, 'cell', None))
+        
     def _check_neighbors(self):
         """Raise an error if Molecule's neighbor list is not symmetric."""
-        for index, nList in enumerate(self.nList):
-            for neighbor in nList:
-                if index not in self.nList[neighbor]:
-                    raise ValueError("Molecule's neighbor list needs to be symmetric")
+        size = len(self.nIndptr) - 1
+        rows = np.repeat(np.arange(size, dtype=np.int64), self.degree())
+        cols = self.nIndices.astype(np.int64)
+        if not np.array_equal(np.sort(rows*size + cols), np.sort(cols*size + rows)):
+            raise ValueError("Molecule's neighbor list needs to be symmetric")
 
     def _configure_mass(self):
         """Assign the mass array to the instance, indexed like posList."""
@@ -145,70 +254,113 @@ class Molecule:
             
     def _configure_topology_lists(self):
         """Assign lists of the unique bonds, bond angles, dihedral angles, and improper torsionals 
-        to the molecule instance."""
-        bondList = []
-        for i,iNList in enumerate(self.nList):
-            ineighbors = [j for j in iNList if j > i]
-            for j in ineighbors:
-                bondList.append([i,j])
-        angleList = []
-        for bond in bondList:
-            i,j = bond
-            for k in [k for k in self.nList[j] if k > i]:
-                angleList.append([i,j,k])
-            for k in [k for k in self.nList[i] if k > j]:
-                angleList.append([j,i,k])
-        dihedralList = []
-        imptorsList = []
-        for angle in angleList:
-            i,j,k = angle
-            for l in [l for l in self.nList[k] if l != j and l > i]:
-                dihedralList.append([i,j,k,l])
-            for l in [l for l in self.nList[i] if l != j and l > k]:
-                dihedralList.append([l,i,j,k])
-            for l in [l for l in self.nList[j] if l > k]:
-                imptorsList.append([i,k,j,l])
-        self.bondList = np.array(bondList)
-        self.angleList = np.array(angleList)
-        self.dihList = np.array(dihedralList)
-        self.imptorsList = np.array(imptorsList)
+        to the molecule instance.  Each list is enumerated from the one before by expanding
+        its end atoms' rows of the CSR adjacency, keeping the canonical ordering of its
+        members: bonds (i,j) with j > i, and angles and dihedrals with last > first."""
+        indptr, indices = self.nIndptr, self.nIndices
+        
+        rows = np.repeat(np.arange(len(indptr) - 1), self.degree())
+        upper = indices > rows
+        bonds = np.column_stack((rows[upper], indices[upper])).astype(int)
+        i, j = bonds.T
+        
+        #angles (i,j,k) about j, then (j,i,k) about i
+        b1, k1 = _expand(indptr, indices, j)
+        b2, k2 = _expand(indptr, indices, i)
+        keep1, keep2 = k1 > i[b1], k2 > j[b2]
+        angles = _interleave((b1[keep1], b2[keep2]),
+                             (np.column_stack((i[b1], j[b1], k1))[keep1],
+                              np.column_stack((j[b2], i[b2], k2))[keep2]), 3)
+        i, j, k = angles.T
+        
+        #dihedrals (i,j,k,l) past k, then (l,i,j,k) before i
+        a1, l1 = _expand(indptr, indices, k)
+        a2, l2 = _expand(indptr, indices, i)
+        keep1 = (l1 != j[a1]) & (l1 > i[a1])
+        keep2 = (l2 != j[a2]) & (l2 > k[a2])
+        dihedrals = _interleave((a1[keep1], a2[keep2]),
+                                (np.column_stack((i[a1], j[a1], k[a1], l1))[keep1],
+                                 np.column_stack((l2, i[a2], j[a2], k[a2]))[keep2]), 4)
+        
+        #impropers (i,k,j,l) about the angle's center j
+        a3, l3 = _expand(indptr, indices, j)
+        keep3 = l3 > k[a3]
+        impropers = np.column_stack((i[a3], k[a3], j[a3], l3))[keep3]
+        
+        self.bondList = bonds
+        self.angleList = angles
+        self.dihList = dihedrals
+        self.imptorsList = impropers
+        
+    def _configure_bond_clusters(self):
+        """Assign the bond clusters of the Tersoff potential, each directed bond (i,j) followed
+        by the other neighbors of i, padded with i (see tersoff.bond_clusters)."""
+        if np.any(self.zList != 6):
+            raise ValueError("The Tersoff forcefield is parameterized for carbon only")
+        self.tersoffList = bond_clusters(self.bondList, len(self))
         
     def _configure_nonbonded_neighbors(self):
-        """Assign lists of non-bonded neighbor pairings; construct the Verlet neighbor lists"""
-        cutoff = 100.*self.ff.lunits
-        nbnList = []
-        for i, ipos in enumerate(self.posList):
-            for j in [j for j in range(len(self)) if j > i]:
-                if np.linalg.norm(ipos-self.posList[j]) < (cutoff + 2.) and j not in self.nList[i]:
-                    nbnList.append([i,j])
-        self.nbnList = np.array(nbnList)
+        """Assign lists of non-bonded neighbor pairings; construct the Verlet neighbor lists.
+        Pairs within the forcefield's cutoff plus skin are found with a k-d tree, and bonded
+        pairs are excluded by their pair keys."""
+        cutoff = (getattr(self.ff, 'cutoff', global_cutoff) + getattr(self.ff, 'skin', global_skin))*self.ff.lunits
+        size = len(self)
+        tree = scipy.spatial.cKDTree(self.posList)
+        pairs = [tree.query_pairs(cutoff, output_type='ndarray').reshape(-1,2)]
+        cell = getattr(self, 'cell', None)
+        if cell is not None:
+            #beyond half a width a pair has several images in range, only the nearest is kept
+            width = np.amin(cell_widths(cell), initial=np.inf)
+            if (self.ff.lj or self.ff.es) and cutoff > .5*width:
+                raise ValueError("The cutoff plus skin (%.3g) exceeds half the smallest periodic width "
+                                 "of the cell (%.3g), enlarge the cell or reduce the cutoff" % (cutoff, width))
+            #pairs with the atoms of the neighboring periodic images
+            periodic = [q for q in range(3) if np.any(cell[q])]
+            for shift in np.array(np.meshgrid(*[[-1,0,1]]*len(periodic))).reshape(len(periodic),-1).T:
+                if np.any(shift):
+                    image = scipy.spatial.cKDTree(self.posList + shift @ cell[periodic])
+                    found = tree.sparse_distance_matrix(image, cutoff, output_type='ndarray')
+                    pairs.append(np.column_stack((found['i'], found['j'])))
+        pairs = np.sort(np.concatenate(pairs), axis=1)
+        pairs = pairs[pairs[:,0] != pairs[:,1]]
+        keys = np.unique(pairs[:,0]*size + pairs[:,1])
+        pairs = np.column_stack((keys//size, keys % size))
+        bonds = np.sort(np.asarray(self.bondList, dtype=int).reshape(-1,2), axis=1)
+        nonbonded = ~np.isin(keys, bonds[:,0]*size + bonds[:,1])
+        pairs, keys = pairs[nonbonded], keys[nonbonded]
+        self.nbnList = pairs[np.argsort(keys)]
+        #positions the list was built at, see _update_nonbonded_neighbors
+        self.nbnPos = self.posList.copy()
+        
+    def _update_nonbonded_neighbors(self):
+        """Rebuild the non-bonded neighbor lists if any atom has moved more than half
+        the skin since they were built, so no pair can have come within the cutoff
+        unlisted.  Return True if the lists were rebuilt."""
+        skin = getattr(self.ff, 'skin', global_skin)*self.ff.lunits
+        nbnPos = getattr(self, 'nbnPos', None)
+        if nbnPos is not None and nbnPos.shape == self.posList.shape:
+            disp = self.posList - nbnPos
+            if np.amax(np.einsum('ij,ij->i', disp, disp), initial=0.) <= .25*skin*skin:
+                return False
+        self._configure_nonbonded_neighbors()
+        return True
         
     def _configure_ring_lists(self):
-        """Assign all of the unique rings to the molecule instance, 
-        between sizes minSize and maxSize."""
+        """Assign the relevant rings (those that are not the sum of smaller rings) of up to
+        maxSize atoms to the molecule instance, as sorted lists of atoms, along with the
+        CSR index of the rings each atom belongs to."""
         maxSize = 9
-        minSize = 3
-        pathList = []
-        def dfs(index, discoverList, start):
-            disList = list(discoverList)
-            disList.append(index)
-            if len(disList) <= maxSize:
-                for neighbor in self.nList[index]:
-                    if neighbor not in disList:
-                        dfs(neighbor, disList, start)
-                    elif neighbor == start:
-                        if len(disList) >= minSize:
-                            pathList.append(disList)
-        
-        for i in range(len(self)):
-            disList = []
-            dfs(i, disList, i) 
-        #now reduce to unique rings
-        #sort each path so they can be compared
-        pathList = [sorted(x) for x in pathList]
-        #get unique paths (rings)
-        ringList =  [list(x) for x in set(tuple(x) for x in pathList)]
-        self.ringList = np.array(ringList)
+        self.ringList = _relevant_rings(self.nIndptr, self.nIndices, maxSize)
+        size = len(self)
+        members = np.fromiter(itertools.chain.from_iterable(self.ringList), dtype=int)
+        owners = np.repeat(np.arange(len(self.ringList)), [len(ring) for ring in self.ringList])
+        self.ringIndptr = np.zeros(size+1, dtype=np.int32)
+        np.cumsum(np.bincount(members, minlength=size), out=self.ringIndptr[1:])
+        self.ringIndices = owners[np.argsort(members, kind='stable')].astype(np.int32)
+        
+    def rings(self, index):
+        """Return the array of the indices in ringList of the rings containing an atom."""
+        return self.ringIndices[self.ringIndptr[index]:self.ringIndptr[index+1]]
         
     def _configure_aromaticity(self):
         """Assign the aromaticity of each ring in the molecule instance, 
@@ -227,7 +379,7 @@ class Molecule:
         """Assign the bondtypes to the molecule instance."""
         if self.cbase is True:
             #assign valence state based on connectivity
-            vstate = np.array([4 if len(x) == 3 else 3 for x in self.nList], dtype=int)
+            vstate = np.where(self.degree() == 3, 4, 3)
             from .antechamber.bondtype.bondtype import boaf
             match, bondorder = boaf(vstate, self.bondList)
             if match is True:
@@ -245,175 +397,91 @@ class Molecule:
         if "DU" in self.atomtypes:
             warnings.warn("A dummy atom type was assigned.", stacklevel=2)
         #from these atomtypes, get their ID numbers
-        idList = []
-        ffatypes = list(np.load("{0}/param/{1}/atomtypes.npy".format(package_dir, self.ff.param_dir)))
-        for atomtype in self.atomtypes:
-            try:
-                idList.append(ffatypes.index(atomtype))
-            except ValueError:
-                idList.append(0)
-        self.idList = np.array(idList)
+        self.idList = self.ff.params.type_ids(self.atomtypes)
         
     def _configure_imptors(self):
         """
         Correctly arrange the improper torsional index lists such that the
         center atom is the third element and the rest are in alphabetical
-        order.
+        order (ties keep their order), all impropers in one pass.
         """
         
-        nimptorsList = []
-            
-        for imptors in self.imptorsList:
-            
-            nimptors = []
-            # rearrange indices 0,1,3 alphabetically
-            a,b,c = self.atomtypes[imptors[0]], self.atomtypes[imptors[1]], self.atomtypes[imptors[3]]
-            sort = np.argsort([a,b,c])
-            sort[np.where(sort==2)[0]] += 1
-#            print(imptors)
-#            print(np.array(self.atomtypes)[imptors])
-#            print(sort)
-            nimptors.extend([imptors[sort[0]], imptors[sort[1]], imptors[2], imptors[sort[2]]])
-            nimptorsList.append(nimptors)
-        
-        self.imptorsList = np.array(nimptorsList)
+        imptors = np.asarray(self.imptorsList, dtype=int).reshape(-1,4)
+        outer = np.array([0,1,3])
+        # rearrange indices 0,1,3 alphabetically
+        types = np.asarray(self.atomtypes)[imptors[:,outer]]
+        sort = outer[np.argsort(types, axis=1, kind='stable')]
+        rows = np.arange(len(imptors))[:,None]
+        self.imptorsList = np.column_stack((imptors[rows,sort[:,:2]], imptors[:,2], imptors[rows[:,0],sort[:,2]]))
         
     def _configure_parameters(self):
         """Assign the force parameters to the molecule instance."""
         idList = self.idList
-        filename = '{0}/param/{1}'.format(package_dir, self.ff.param_dir)
+        params = self.ff.params
         
         if self.ff.lengths:
             #assign kr, r0 parameters
-            try:
-                lengthArr = np.load(filename+"/blengths.npy")
-                self.kb = lengthArr[idList[self.bondList[:,0]],idList[self.bondList[:,1]],0]
-                self.b0 = lengthArr[idList[self.bondList[:,0]],idList[self.bondList[:,1]],1]
-            except IndexError:
-                self.kb, self.b0 = [], []
+            self.kb, self.b0 = params.bond_params(idList[self.bondList]).T
             
         if self.ff.angles:
             #assign kt,t0 parameters
-            try:
-                angleArr = np.load(filename+"/bangles.npy")
-                self.kt = angleArr[idList[self.angleList[:,0]], idList[self.angleList[:,1]],
-                                   idList[self.angleList[:,2]],0]
-                self.t0 = angleArr[idList[self.angleList[:,0]], idList[self.angleList[:,1]],
-                                   idList[self.angleList[:,2]],1]
-            except IndexError:
-                self.kt, self.t0 = [],[]
+            self.kt, self.t0 = params.angle_params(idList[self.angleList]).T
                                 
         if self.ff.dihs:
-            #assign, vn, gn parameters
-            try:
-                dihArr, vnArr = np.load(filename+'/dih.npy'), np.load(filename+'/vn.npy')
-                dihedrals = np.transpose([idList[self.dihList[:,0]], idList[self.dihList[:,1]],
-                                          idList[self.dihList[:,2]], idList[self.dihList[:,3]]])
-            
-                def store_dih_param(index, paramList, vnList):
-                    vns = vnList[index]
-                    paramList[0][abs(int(vns[2]))-1] = vns[0]
-                    paramList[1][abs(int(vns[2]))-1] = vns[1]
-                    if vns[2] >= 0.:
-                        return paramList
-                    else:
-                        store_dih_param(index+1, paramList, vnList)
-                        
-                valuesList = []
-                #find indices of wildcards in dihArr
-                first_num = np.nonzero(dihArr[:,0])[0][0]
-                for dihedral in dihedrals:
-                    #check full definitions
-                    values = np.zeros((2,4))
-                    combo = np.where(np.all(dihedral==dihArr[first_num:], axis=1))[0]
-                    if combo:
-                        #assign values
-                        values = store_dih_param(combo[0], values, vnArr[first_num:])
-                        valuesList.append(values)
-                        continue
-                    #consider inversion symmetry
-                    combo = np.where(np.all(dihedral[::-1]==dihArr[first_num:], axis=1))[0]
-                    if combo:
-                        values = store_dih_param(combo[0], values, vnArr[first_num:])
-                        valuesList.append(values)
-                        continue
-                    #check with wildcards
-                    combo = np.where(np.all(dihedral[1:3]==dihArr[:first_num][:,1:3], axis=1))[0]
-                    if combo:
-                        values = store_dih_param(combo[0], values, vnArr[:first_num])
-                        valuesList.append(values)
-                        continue
-                    #inversion symmetry
-                    combo = np.where(np.all(dihedral[1:3][::-1]==dihArr[:first_num][:,1:3], axis=1))[0]
-                    if combo:
-                        values = store_dih_param(combo[0], values, vnArr[:first_num])
-                        valuesList.append(values)
-                        continue
-                values = np.array(valuesList)
-                self.vn = values[:,0]
-                self.gn = values[:,1]
-            
-            except IndexError:
-                self.vn, self.gn = [], []
+            #assign vn, gn parameters, once for each distinct quadruple of types
+            full, wild = params.torsions('dih', 'vn')
+            def lookup(key):
+                key = tuple(key)
+                #full definitions, then wildcards on the outer atoms, either way round
+                for table, k in ((full, key), (wild, key[1:3])):
+                    values = table.get(k, table.get(k[::-1]))
+                    if values is not None:
+                        return values
+                return None
+            self.vn, self.gn = _assign_torsions(idList[self.dihList], lookup)
                 
         if self.ff.imptors:
-            #assign, vni, gni parameters
-            try:
-                dihArr, vnArr = np.load(filename+'/dih.npy'), np.load(filename+'/vn.npy')
-                dihedrals = np.transpose([idList[self.dihList[:,0]], idList[self.dihList[:,1]],
-                                          idList[self.dihList[:,2]], idList[self.dihList[:,3]]])
-            
-                def store_dih_param(index, paramList, vnList):
-                    vns = vnList[index]
-                    paramList[0][abs(int(vns[2]))-1] = vns[0]
-                    paramList[1][abs(int(vns[2]))-1] = vns[1]
-                    if vns[2] >= 0.:
-                        return paramList
-                    else:
-                        store_dih_param(index+1, paramList, vnList)
-                        
-                valuesList = []
-                #find indices of wildcards in dihArr
-                first_num = np.nonzero(dihArr[:,0])[0][0]
-                for dihedral in dihedrals:
-                    #check full definitions
-                    values = np.zeros((2,4))
-                    combo = np.where(np.all(dihedral==dihArr[first_num:], axis=1))[0]
-                    if combo:
-                        #assign values
-                        values = store_dih_param(combo[0], values, vnArr[first_num:])
-                        valuesList.append(values)
-                        continue
-                    #consider inversion symmetry
-                    combo = np.where(np.all(dihedral[::-1]==dihArr[first_num:], axis=1))[0]
-                    if combo:
-                        values = store_dih_param(combo[0], values, vnArr[first_num:])
-                        valuesList.append(values)
-                        continue
-                    #check with wildcards
-                    combo = np.where(np.all(dihedral[1:3]==dihArr[:first_num][:,1:3], axis=1))[0]
-                    if combo:
-                        values = store_dih_param(combo[0], values, vnArr[:first_num])
-                        valuesList.append(values)
-                        continue
-                    #inversion symmetry
-                    combo = np.where(np.all(dihedral[1:3][::-1]==dihArr[:first_num][:,1:3], axis=1))[0]
-                    if combo:
-                        values = store_dih_param(combo[0], values, vnArr[:first_num])
-                        valuesList.append(values)
-                        continue
-                values = np.array(valuesList)
-                self.vn = values[:,0]
-                self.gn = values[:,1]
-            
-            except IndexError:
-                self.vni, self.gni = [], []
+            #assign vni, gni parameters; the center is third and the outer atoms are unordered
+            full, wild = params.torsions('imp', 'vni')
+            def lookup(key):
+                outer, center = sorted((key[0], key[1], key[3])), key[2]
+                values = full.get((center,) + tuple(outer))
+                #wildcards X-b-c-d, then X-X-c-d
+                for a, b in itertools.combinations(outer, 2):
+                    values = values if values is not None else wild.get((center, a, b))
+                for d in outer:
+                    values = values if values is not None else wild.get((center, d))
+                return values
+            self.vni, self.gni = _assign_torsions(idList[self.imptorsList], lookup)
                                 
         if self.ff.lj:
             #assign Van-dr-Waals parameters
-            rvdw0Arr, epvdwArr = np.load(filename+"/rvdw0.npy"), np.load(filename+"/epvdw.npy")
-            self.rvdw0 = rvdw0Arr[idList]
-            self.epvdw = epvdwArr[idList]
+            self.rvdw0 = params.table('rvdw0')[idList]
+            self.epvdw = params.table('epvdw')[idList]
+            
+    def _configure_charges(self):
+        """Assign partial charges to the atoms by Gasteiger-Marsili partial equalization of
+        orbital electronegativities: over six damped rounds, charge flows across every bond
+        toward its more electronegative atom."""
+        size = len(self)
+        params = []
+        for z, degree in zip(self.zList, self.degree()):
+            hybrids = gasteigerDict[z]
+            #the listed neighbor count closest to the atom's
+            params.append(hybrids[min(hybrids, key=lambda count: abs(count - degree))])
+        a, b, c = np.array(params).T
+        #electronegativity of the cations, hydrogen's is special
+        chiPlus = np.where(self.zList == 1, 20.02, a + b + c)
+        i, j = np.asarray(self.bondList, dtype=int).reshape(-1,2).T
+        charges = np.zeros(size)
+        damp = 1.
+        for _ in range(6):
+            damp *= .5
+            chi = a + (b + c*charges)*charges
+            donor = np.where(chi[i] < chi[j], i, j)
+            dq = damp*np.abs(chi[i] - chi[j])/chiPlus[donor]
+            charges += np.bincount(donor, dq, size) - np.bincount(i + j - donor, dq, size)
+        self.charges = charges
             
     def _configure_energy(self):
         return self.define_energy_routine(), self.define_gradient_routine_analytical()
@@ -423,6 +491,8 @@ class Molecule:
         self._check_neighbors()
         self._configure_mass()
         self._configure_topology_lists()
+        if self.ff.tersoff:
+            self._configure_bond_clusters()
         self._configure_nonbonded_neighbors()
         self._configure_ring_lists()
         self._configure_aromaticity()
@@ -430,105 +500,14 @@ class Molecule:
         self._configure_atomtypes()
         self._configure_imptors()
         self._configure_parameters()
+        if self.ff.es:
+            self._configure_charges()
         
     def define_energy_routine(self):
         """Return the function that would calculate the energy of the
-        molecule instance."""
-        
-        e_funcs = []
-        
-        if self.ff.lengths:
-            
-            ibonds,jbonds = self.bondList[:,0], self.bondList[:,1]
-            def e_lengths():
-                rij = self.posList[ibonds] - self.posList[jbonds]
-                rij = np.linalg.norm(rij, axis=1)
-                return np.sum(self.kb*(rij-self.b0)**2)
-                
-            e_funcs.append(e_lengths)
-            
-        if self.ff.angles:
-            
-            iangles,jangles,kangles = self.angleList[:,0], self.angleList[:,1], self.angleList[:,2]
-            def e_angles():
-                posij = self.posList[iangles] - self.posList[jangles]
-                poskj = self.posList[kangles] - self.posList[jangles]
-                rij = np.linalg.norm(posij,axis=1)
-                rkj = np.linalg.norm(poskj,axis=1)
-                cosTheta = np.einsum('ij,ij->i',posij,poskj)/rij/rkj
-                theta = np.rad2deg(np.arccos(cosTheta))
-                return np.sum(self.kt*(theta-self.t0)**2)
-                
-            e_funcs.append(e_angles)
-            
-        if self.ff.dihs:
-            
-            idih,jdih,kdih,ldih = self.dihList[:,0],self.dihList[:,1],self.dihList[:,2],self.dihList[:,3]
-            def e_dihs():
-                posji = self.posList[jdih] - self.posList[idih]
-                poskj = self.posList[kdih] - self.posList[jdih]
-                poslk = self.posList[ldih] - self.posList[kdih]
-                rkj = np.linalg.norm(poskj,axis=1)
-                cross12 = np.cross(posji, poskj)
-                cross23 = np.cross(poskj, poslk)
-                n1 = cross12/np.linalg.norm(cross12, axis=1)[:,None]
-                n2 = cross23/np.linalg.norm(cross23, axis=1)[:,None]
-                m1 = np.cross(n1, poskj/rkj[:,None])
-                x,y = np.einsum('ij,ij->i', n1, n2),  np.einsum('ij,ij->i', m1, n2)
-                omega = np.rad2deg(np.arctan2(y,x))
-                return np.sum(self.vn[:,0]*(1. + np.cos(np.radians(   omega - self.gn[:,0])))
-                            + self.vn[:,1]*(1. + np.cos(np.radians(2.*omega - self.gn[:,1])))
-                            + self.vn[:,2]*(1. + np.cos(np.radians(3.*omega - self.gn[:,2])))
-                            + self.vn[:,3]*(1. + np.cos(np.radians(4.*omega - self.gn[:,3]))))
-                
-            e_funcs.append(e_dihs)
-            
-        if self.ff.imptors:
-            
-            idih, jdih, kdih, ldih = self.imptorsList[:,0], self.imptorsList[:,1], self.imptorsList[:,2], self.imptorsList[:,3]
-            def e_imptors():
-                posji = self.posList[jdih] - self.posList[idih]
-                poskj = self.posList[kdih] - self.posList[jdih]
-                poslk = self.posList[ldih] - self.posList[kdih]
-                rkj = np.linalg.norm(poskj,axis=1)
-                cross12 = np.cross(posji, poskj)
-                cross23 = np.cross(poskj, poslk)
-                n1 = cross12/np.linalg.norm(cross12, axis=1)[:,None]
-                n2 = cross23/np.linalg.norm(cross23, axis=1)[:,None]
-                m1 = np.cross(n1, poskj/rkj[:,None])
-                x,y = np.einsum('ij,ij->i', n1, n2),  np.einsum('ij,ij->i', m1, n2)
-                omega = np.rad2deg(np.arctan2(y,x))
-                return np.sum(self.vn[:,0]*(1. + np.cos(np.radians(   omega - self.gn[:,0])))
-                            + self.vn[:,1]*(1. + np.cos(np.radians(2.*omega - self.gn[:,1])))
-                            + self.vn[:,2]*(1. + np.cos(np.radians(3.*omega - self.gn[:,2])))
-                            + self.vn[:,3]*(1. + np.cos(np.radians(4.*omega - self.gn[:,3]))))
-                
-            e_funcs.append(e_imptors)
-            
-        #non-bonded interactions
-            
-        if self.ff.lj:
-            
-            ipairs, jpairs = self.nbnList[:,0], self.nbnList[:,1]
-            def e_lj():
-                posij = self.posList[ipairs] - self.posList[jpairs]
-                rij = np.linalg.norm(posij, axis=1)
-                rTerm = ((self.rvdw0[ipairs] + self.rvdw0[jpairs])/rij)**6
-                return np.sum(np.sqrt(self.epvdw[ipairs]*self.epvdw[jpairs])*(rTerm**2 - 2*(rTerm)))
-            
-            e_funcs.append(e_lj)
-            
-        if self.ff.tersoff:
-            #tersoff interaction here
-            pass
-            
-        def calculate_e():
-            e = 0.0 #base energy level
-            for e_func in e_funcs:
-                e += e_func()
-            return e
-                
-        return calculate_e    
+        molecule instance, or of a K x N x 3 stack of its configurations
+        at once; see ForceFieldKernel."""
+        return ForceFieldKernel(self).energy
         
     def define_gradient_routine_numerical(self):
         """Return the function that would calculate the gradients (negative forces)
@@ -544,20 +523,22 @@ class Molecule:
             
             for i in range(len(self)):
                 ipos = self.posList[i]
+                #displace from and restore the exact original position, so no drift accumulates
+                orig = ipos.copy()
             
-                ipos += vdx
+                ipos[:] = orig + vdx
                 vPlusX = calculate_e()
-                ipos += -2.0*vdx
+                ipos[:] = orig - vdx
                 vMinusX = calculate_e()
-                ipos += vdx+vdy
+                ipos[:] = orig + vdy
                 vPlusY = calculate_e()
-                ipos += -2.0*vdy
+                ipos[:] = orig - vdy
                 vMinusY = calculate_e()
-                ipos += vdy+vdz
+                ipos[:] = orig + vdz
                 vPlusZ = calculate_e()
-                ipos += -2.0*vdz
+                ipos[:] = orig - vdz
                 vMinusZ = calculate_e()
-                ipos += vdz
+                ipos[:] = orig
                 
                 xGrad = (vPlusX - vMinusX)/dx/2.0
                 yGrad = (vPlusY - vMinusY)/dy/2.0
@@ -572,53 +553,73 @@ class Molecule:
             
         return calculate_grad
         
-    def define_gradient_routine_analytical(self):
-        """Return the function that would calculate the gradients (negative forces)
-        of the atoms; calculated analytically"""
+    def _define_gradient_terms(self):
+        """Return a list of (interaction list, gradient function) pairs, one for each
+        of the forcefield's terms.  Each gradient function adds its contribution to the
+        given gradient array, for only the interactions at the selected rows if given,
+        and returns the energy of those interactions from the same geometry."""
+        
+        grad_terms = []
         
-        grad_funcs = []
+        def define_scatter(name):
+            #full evaluations accumulate through a sparse incidence operator, built once per
+            #interaction list (the pair list is replaced on every nonbonded rebuild)
+            plan = [None, None]
+            def scatter(grad, sel, contributions):
+                interactions = getattr(self, name)
+                if isinstance(sel, slice) and sel == slice(None):
+                    if plan[0] is not interactions or plan[1].shape[0] != len(grad):
+                        plan[:] = interactions, scatter_operator(interactions, len(grad))
+                    grad += plan[1] @ np.concatenate(contributions)
+                else:
+                    for atoms, contribution in zip(interactions[sel].T, contributions):
+                        np.add.at(grad, atoms, contribution)
+            return scatter
         
         if self.ff.lengths:
             
-            ibonds,jbonds = self.bondList[:,0], self.bondList[:,1]
-            def grad_lengths(grad):
-                posij = self.posList[ibonds] - self.posList[jbonds]
+            scatter_lengths = define_scatter('bondList')
+            def grad_lengths(grad, sel=slice(None)):
+                ibonds,jbonds = self.bondList[sel,0], self.bondList[sel,1]
+                posij = self._separation(ibonds, jbonds)
                 rij = np.linalg.norm(posij, axis=1)
-                lengthTerm = 2.*(self.kb*(rij-self.b0)/rij)[:,None]*posij
-                np.add.at(grad, ibonds, lengthTerm)
-                np.add.at(grad, jbonds, -lengthTerm)
+                lengthTerm = 2.*(self.kb[sel]*(rij-self.b0[sel])/rij)[:,None]*posij
+                scatter_lengths(grad, sel, (lengthTerm, -lengthTerm))
+                return np.sum(self.kb[sel]*(rij-self.b0[sel])**2)
                 
-            grad_funcs.append(grad_lengths)
+            grad_terms.append((self.bondList, grad_lengths))
                 
         if self.ff.angles:
             
-            iangles,jangles,kangles = self.angleList[:,0], self.angleList[:,1], self.angleList[:,2]
-            def grad_angles(grad):
-                posij = self.posList[iangles] - self.posList[jangles]
-                poskj = self.posList[kangles] - self.posList[jangles]
+            scatter_angles = define_scatter('angleList')
+            def grad_angles(grad, sel=slice(None)):
+                iangles,jangles,kangles = self.angleList[sel,0], self.angleList[sel,1], self.angleList[sel,2]
+                posij = self._separation(iangles, jangles)
+                poskj = self._separation(kangles, jangles)
                 rij, rkj = np.linalg.norm(posij,axis=1), np.linalg.norm(poskj,axis=1)
                 cosTheta = np.einsum('ij,ij->i',posij,poskj)/(rij*rkj)
                 sqrtCos = np.sqrt(np.ones(len(cosTheta), dtype=float)-(cosTheta**2))
                 dtdri = (posij*(cosTheta/rij)[:,None] - poskj/(rkj[:,None]))/((rij*sqrtCos)[:,None])
                 dtdrk = (poskj*(cosTheta/rkj)[:,None] - posij/(rij[:,None]))/((rkj*sqrtCos)[:,None])
                 theta = np.rad2deg(np.arccos(cosTheta))
-                uTerm = (360./np.pi)*(self.kt*(theta - self.t0))
+                uTerm = (360./np.pi)*(self.kt[sel]*(theta - self.t0[sel]))
                 dudri =  uTerm[:,None]*dtdri
                 dudrj = -uTerm[:,None]*(dtdri + dtdrk)
                 dudrk =  uTerm[:,None]*dtdrk
-                np.add.at(grad, iangles, dudri)
-                np.add.at(grad, jangles, dudrj)
-                np.add.at(grad, kangles, dudrk)
+                scatter_angles(grad, sel, (dudri, dudrj, dudrk))
+                return np.sum(self.kt[sel]*(theta - self.t0[sel])**2)
                 
-            grad_funcs.append(grad_angles)
+            grad_terms.append((self.angleList, grad_angles))
                 
         if self.ff.dihs:
             
-            idih,jdih,kdih,ldih = self.dihList[:,0],self.dihList[:,1],self.dihList[:,2],self.dihList[:,3]
-            def grad_dihs(grad):
-                posij = self.posList[idih] - self.posList[jdih]
-                poskj = self.posList[kdih] - self.posList[jdih]
-                poskl = self.posList[kdih] - self.posList[ldih]
+            scatter_dihs = define_scatter('dihList')
+            def grad_dihs(grad, sel=slice(None)):
+                idih,jdih,kdih,ldih = self.dihList[sel].T
+                vn, gn = self.vn[sel], self.gn[sel]
+                posij = self._separation(idih, jdih)
+                poskj = self._separation(kdih, jdih)
+                poskl = self._separation(kdih, ldih)
                 rkj = np.linalg.norm(poskj, axis=1)
                 cross12 = np.cross(-posij, poskj)
                 cross23 = np.cross(poskj, -poskl)
@@ -633,29 +634,31 @@ class Molecule:
                 dwdrl = -cross23*(-rkj/(np.linalg.norm(cross23, axis=1)**2))[:,None]
                 dwdrj = (dotijkj - np.ones(len(rkj)))[:,None]*dwdri - dotklkj[:,None]*dwdrl
                 dwdrk = (dotklkj - np.ones(len(rkj)))[:,None]*dwdrl - dotijkj[:,None]*dwdri
-                uTerm = (    self.vn[:,0]*np.sin(np.radians(   omega - self.gn[:,0]))
-                        + 2.*self.vn[:,1]*np.sin(np.radians(2.*omega - self.gn[:,1]))
-                        + 3.*self.vn[:,2]*np.sin(np.radians(3.*omega - self.gn[:,2]))
-                        + 4.*self.vn[:,3]*np.sin(np.radians(4.*omega - self.gn[:,3])))
+                uTerm = (    vn[:,0]*np.sin(np.radians(   omega - gn[:,0]))
+                        + 2.*vn[:,1]*np.sin(np.radians(2.*omega - gn[:,1]))
+                        + 3.*vn[:,2]*np.sin(np.radians(3.*omega - gn[:,2]))
+                        + 4.*vn[:,3]*np.sin(np.radians(4.*omega - gn[:,3])))
                 dudri = uTerm[:,None]*dwdri
                 dudrj = uTerm[:,None]*dwdrj
                 dudrk = uTerm[:,None]*dwdrk
                 dudrl = uTerm[:,None]*dwdrl
-                np.add.at(grad, idih, dudri)
-                np.add.at(grad, jdih, dudrj)
-                np.add.at(grad, kdih, dudrk)
-                np.add.at(grad, ldih, dudrl)
+                scatter_dihs(grad, sel, (dudri, dudrj, dudrk, dudrl))
+                return np.sum(vn[:,0]*(1. + np.cos(np.radians(   omega - gn[:,0])))
+                            + vn[:,1]*(1. + np.cos(np.radians(2.*omega - gn[:,1])))
+                            + vn[:,2]*(1. + np.cos(np.radians(3.*omega - gn[:,2])))
+                            + vn[:,3]*(1. + np.cos(np.radians(4.*omega - gn[:,3]))))
                 
-            grad_funcs.append(grad_dihs)
+            grad_terms.append((self.dihList, grad_dihs))
             
         if self.ff.imptors:
             
-            idih,jdih,kdih,ldih = self.imptorsList[:,0], self.imptorsList[:,1], self.imptorsList[:,2], self.imptorsList[:,3]
-            
-            def grad_imptors(grad):
-                posij = self.posList[idih] - self.posList[jdih]
-                poskj = self.posList[kdih] - self.posList[jdih]
-                poskl = self.posList[kdih] - self.posList[ldih]
+            scatter_imptors = define_scatter('imptorsList')
+            def grad_imptors(grad, sel=slice(None)):
+                idih,jdih,kdih,ldih = self.imptorsList[sel].T
+                vn, gn = self.vni[sel], self.gni[sel]
+                posij = self._separation(idih, jdih)
+                poskj = self._separation(kdih, jdih)
+                poskl = self._separation(kdih, ldih)
                 rkj = np.linalg.norm(poskj, axis=1)
                 cross12 = np.cross(-posij, poskj)
                 cross23 = np.cross(poskj, -poskl)
@@ -664,45 +667,115 @@ class Molecule:
                 m1 = np.cross(n1, poskj/rkj[:,None])
                 x,y = np.einsum('ij,ij->i', n1, n2),  np.einsum('ij,ij->i', m1, n2)
                 omega = np.rad2deg(np.arctan2(y,x))
-                print(omega)
                 dotijkj = np.einsum('ij,ij->i',posij,poskj)/(rkj**2)
                 dotklkj = np.einsum('ij,ij->i',poskl,poskj)/(rkj**2)
                 dwdri = -cross12*(rkj/(np.linalg.norm(cross12, axis=1)**2))[:,None]
                 dwdrl = -cross23*(-rkj/(np.linalg.norm(cross23, axis=1)**2))[:,None]
                 dwdrj = (dotijkj - np.ones(len(rkj)))[:,None]*dwdri - dotklkj[:,None]*dwdrl
                 dwdrk = (dotklkj - np.ones(len(rkj)))[:,None]*dwdrl - dotijkj[:,None]*dwdri
-                uTerm = (    self.vn[:,0]*np.sin(np.radians(omega - self.gn[:,0]))
-                        + 2.*self.vn[:,1]*np.sin(np.radians(2.*omega - self.gn[:,1]))
-                        + 3.*self.vn[:,2]*np.sin(np.radians(3.*omega - self.gn[:,2]))
-                        + 4.*self.vn[:,3]*np.sin(np.radians(4.*omega - self.gn[:,3])))
+                uTerm = (    vn[:,0]*np.sin(np.radians(omega - gn[:,0]))
+                        + 2.*vn[:,1]*np.sin(np.radians(2.*omega - gn[:,1]))
+                        + 3.*vn[:,2]*np.sin(np.radians(3.*omega - gn[:,2]))
+                        + 4.*vn[:,3]*np.sin(np.radians(4.*omega - gn[:,3])))
                 dudri = uTerm[:,None]*dwdri
                 dudrj = uTerm[:,None]*dwdrj
                 dudrk = uTerm[:,None]*dwdrk
                 dudrl = uTerm[:,None]*dwdrl
-                np.add.at(grad, idih, dudri)
-                np.add.at(grad, jdih, dudrj)
-                np.add.at(grad, kdih, dudrk)
-                np.add.at(grad, ldih, dudrl)
+                scatter_imptors(grad, sel, (dudri, dudrj, dudrk, dudrl))
+                return np.sum(vn[:,0]*(1. + np.cos(np.radians(   omega - gn[:,0])))
+                            + vn[:,1]*(1. + np.cos(np.radians(2.*omega - gn[:,1])))
+                            + vn[:,2]*(1. + np.cos(np.radians(3.*omega - gn[:,2])))
+                            + vn[:,3]*(1. + np.cos(np.radians(4.*omega - gn[:,3]))))
                 
-            grad_funcs.append(grad_imptors)
+            grad_terms.append((self.imptorsList, grad_imptors))
             
         if self.ff.lj:
             
-            ipairs, jpairs = self.nbnList[:,0], self.nbnList[:,1]
-            def grad_lj(grad):
-                posij = self.posList[ipairs] - self.posList[jpairs]
-                rij = np.linalg.norm(posij, axis=1)
-                rTerm = ((self.rvdw0[ipairs] + self.rvdw0[jpairs])/rij)**6
-                ljTerm = (12.*np.sqrt(self.epvdw[ipairs]*self.epvdw[jpairs])*(rTerm - rTerm**2)/rij/rij)[:,None]*posij
-                np.add.at(grad, ipairs, ljTerm)
-                np.add.at(grad, jpairs, -ljTerm)
+            scatter_lj = define_scatter('nbnList')
+            lj = LennardJones(self)
+            def grad_lj(grad, sel=slice(None)):
+                ipairs, jpairs = self.nbnList[sel,0], self.nbnList[sel,1]
+                posij = self._separation(ipairs, jpairs)
+                u, du = lj.derivatives(np.einsum('ij,ij->i', posij, posij), lj.pair_types(ipairs, jpairs))
+                ljTerm = du[:,None]*posij
+                scatter_lj(grad, sel, (ljTerm, -ljTerm))
+                return np.sum(u)
                 
-            grad_funcs.append(grad_lj)
+            grad_terms.append((self.nbnList, grad_lj))
+            
+        if self.ff.es:
+            
+            scatter_es = define_scatter('nbnList')
+            es = Electrostatics(self)
+            def grad_es(grad, sel=slice(None)):
+                ipairs, jpairs = self.nbnList[sel,0], self.nbnList[sel,1]
+                posij = self._separation(ipairs, jpairs)
+                s, qq = np.einsum('ij,ij->i', posij, posij), es.pair_types(ipairs, jpairs)
+                u, du = es.derivatives(s, qq)
+                esTerm = du[:,None]*posij
+                scatter_es(grad, sel, (esTerm, -esTerm))
+                return np.sum(u)
+                
+            grad_terms.append((self.nbnList, grad_es))
+            
+        if self.ff.tersoff:
+            
+            scatter_tersoff = define_scatter('tersoffList')
+            mask = (self.tersoffList[:,2:] != self.tersoffList[:,:1]).astype(float)
+            def grad_tersoff(grad, sel=slice(None)):
+                clusters = self.tersoffList[sel]
+                #cluster atoms at their nearest images to the first
+                first = self.posList[clusters[:,0]]
+                pos = first[:,None,:] + self._separation(clusters.T, clusters[:,0]).transpose(1,0,2)
+                e, clusterGrad = cluster_gradient(pos, mask[sel])
+                scatter_tersoff(grad, sel, tuple(clusterGrad.transpose(1,0,2)))
+                return np.sum(e)
+                
+            grad_terms.append((self.tersoffList, grad_tersoff))
+                
+        return grad_terms
+        
+    def define_gradient_routine_analytical(self):
+        """Return the function that would calculate the gradients (negative forces)
+        of the atoms; calculated analytically"""
+        
+        kernel = ForceFieldKernel(self)
                 
         def calculate_grad():
+            grad = kernel.energy_gradient()[1]
+            return grad, np.amax(np.abs(grad)), np.linalg.norm(grad)
+            
+        return calculate_grad
+        
+    def define_energy_gradient_routine(self):
+        """Return the function that would calculate both the energy and the analytical
+        gradients of the atoms, sharing one pass over the geometry of each term."""
+        
+        kernel = ForceFieldKernel(self)
+        
+        def calculate_egrad():
+            e, grad = kernel.energy_gradient()
+            return e, grad, np.amax(np.abs(grad)), np.linalg.norm(grad)
+            
+        return calculate_egrad
+        
+    def define_gradient_routine_local(self):
+        """Return the function that would calculate the analytical gradients of the atoms
+        due to only the interactions that involve a given atom (its local stencil).
+        The per-atom incidence of every interaction list is indexed once, here."""
+        
+        if self.ff.es and getattr(self.ff, 'esmethod', 'dsf') == 'mesh':
+            #the mesh's long-range part reaches every pair, past any stencil
+            raise ValueError("The particle-mesh electrostatics have no local stencil, "
+                             "use esmethod='dsf' or local=False")
+        stencils = []
+        for interactions, grad_func in self._define_gradient_terms():
+            stencils.append((_incidence(interactions, len(self)), grad_func))
+            
+        def calculate_grad(index):
             grad = np.zeros((len(self),3))
-            for grad_func in grad_funcs:
-                grad_func(grad)
+            for (indptr, rows), grad_func in stencils:
+                grad_func(grad, rows[indptr[index]:indptr[index+1]])
             magList = np.sqrt(np.hstack(grad)*np.hstack(grad))
             maxForce = np.amax(magList)
             totalMag = np.linalg.norm(magList)
@@ -748,7 +821,7 @@ class Molecule:
         """
         Return r_{ij} for each of the defined bonds.
         """
-        rij = self.posList[self.bondList[:,0]] - self.posList[self.bondList[:,1]]
+        rij = self._separation(self.bondList[:,0], self.bondList[:,1])
         return np.linalg.norm(rij, axis=1)
     
     @property
@@ -756,9 +829,9 @@ class Molecule:
         """
         Return \theta_{ijk} for each of the defined angles, indexed like angleList
         """
-        posij = self.posList[self.angleList[:,0]] - self.posList[self.angleList[:,1]]
+        posij = self._separation(self.angleList[:,0], self.angleList[:,1])
         rij = np.linalg.norm(posij, axis=1)
-        poskj = self.posList[self.angleList[:,2]] - self.posList[self.angleList[:,1]]
+        poskj = self._separation(self.angleList[:,2], self.angleList[:,1])
         rkj = np.linalg.norm(poskj, axis=1)
         cos_theta = np.einsum('ij,ij->i',posij,poskj)/rij/rkj
         return np.rad2deg(np.arccos(cos_theta))
@@ -769,9 +842,9 @@ class Molecule:
         Return \omega_{ijkl} (the dihedral angles) for each of the defined angles,
         indexed like dihList.
         """
-        posji = self.posList[self.dihList[:,1]] - self.posList[self.dihList[:,0]]
-        poskj = self.posList[self.dihList[:,2]] - self.posList[self.dihList[:,1]]
-        poslk = self.posList[self.dihList[:,3]] - self.posList[self.dihList[:,2]]
+        posji = self._separation(self.dihList[:,1], self.dihList[:,0])
+        poskj = self._separation(self.dihList[:,2], self.dihList[:,1])
+        poslk = self._separation(self.dihList[:,3], self.dihList[:,2])
         rkj = np.linalg.norm(poskj,axis=1)
         cross12 = np.cross(posji, poskj)
         cross23 = np.cross(poskj, poslk)
@@ -836,6 +909,145 @@ class Interface():
         self.attached = np.array([], dtype=int)
         mol.faces.append(self)
         
+def _incidence(interactions, size):
+    """Return the (indptr, rows) index of which interactions each atom takes part in;
+    the interactions of atom i are rows[indptr[i]:indptr[i+1]], as in a CSR matrix.
+    An interaction that lists an atom more than once (padding) is indexed once.
+    
+    Args:
+        interactions (ndarray): M by k array of atom indices, like bondList or dihList.
+        size (int): Number of atoms in the molecule."""
+        
+    interactions = np.asarray(interactions, dtype=int)
+    if interactions.size == 0:
+        return np.zeros(size+1, dtype=int), np.array([], dtype=int)
+    m = interactions.shape[0]
+    rows = np.repeat(np.arange(m), interactions.shape[1])
+    #sorted by atom, then by interaction
+    keys = np.unique(interactions.ravel()*m + rows)
+    atoms = keys//m
+    indptr = np.concatenate(([0], np.cumsum(np.bincount(atoms, minlength=size))))
+    return indptr, keys % m
+    
+def _csr_adjacency(nList):
+    """Return the (indptr, indices) int32 CSR arrays of a list of lists of neighbors."""
+    indptr = np.zeros(len(nList)+1, dtype=np.int32)
+    np.cumsum([len(x) for x in nList], out=indptr[1:])
+    indices = np.fromiter(itertools.chain.from_iterable(nList), dtype=np.int32, count=indptr[-1])
+    return indptr, indices
+    
+def _assign_torsions(types, lookup):
+    """Return the (vn, gn) parameter arrays of torsions from their M by 4 type indices,
+    looking up each distinct row once; torsions without a definition get zeros."""
+    keys, inverse = np.unique(np.asarray(types, dtype=int).reshape(-1,4), axis=0, return_inverse=True)
+    values = np.zeros((len(keys),2,4))
+    for count, key in enumerate(keys):
+        found = lookup(key)
+        if found is not None:
+            values[count] = found
+    values = values[inverse.reshape(-1)]
+    return values[:,0], values[:,1]
+    
+def _relevant_rings(indptr, indices, maxSize):
+    """Return the sorted atom lists of the relevant cycles of up to maxSize atoms of a CSR
+    adjacency, ordered by size and then by atoms.
+    
+    Candidates are the cycles closed by shortest paths from each atom taken as the lowest
+    of its ring (Vismara's construction), which is polynomial in the number of atoms; a
+    candidate is kept if, as a set of bonds, it is independent of the smaller ones (GF(2)
+    elimination on bitmasks)."""
+    size = len(indptr) - 1
+    rows = np.repeat(np.arange(size), np.diff(indptr))
+    upper = indices > rows
+    bondIndex = {bond:count for count, bond in enumerate(zip(rows[upper].tolist(), indices[upper].tolist()))}
+    nList = [row.tolist() for row in np.split(indices, indptr[1:-1])]
+    
+    def path(parent, vertex):
+        vertices = [vertex]
+        while parent[vertex] != vertex:
+            vertex = parent[vertex]
+            vertices.append(vertex)
+        return vertices
+    
+    candidates = {}
+    depth = maxSize//2
+    for root in range(size):
+        #breadth-first shortest path tree over the atoms above root
+        dist, parent, branch = {root:0}, {root:root}, {root:root}
+        shells = [[root]]
+        for k in range(1, depth+1):
+            shell = []
+            for x in shells[-1]:
+                for y in nList[x]:
+                    if y > root and y not in dist:
+                        dist[y], parent[y], branch[y] = k, x, (y if k == 1 else branch[x])
+                        shell.append(y)
+            shells.append(shell)
+        #close cycles with two paths that only share the root
+        for k in range(1, depth+1):
+            for z in shells[k]:
+                #odd cycles through the bond (z,y) at equal depths
+                if 2*k + 1 <= maxSize:
+                    for y in nList[z]:
+                        if y > z and dist.get(y) == k and branch[y] != branch[z]:
+                            ring = path(parent, z) + path(parent, y)[-2::-1]
+                            candidates.setdefault(frozenset(ring), ring)
+                #even cycles through z with two predecessors x,y
+                if 2*k <= maxSize:
+                    preds = [x for x in nList[z] if dist.get(x) == k-1]
+                    for a, x in enumerate(preds):
+                        for y in preds[a+1:]:
+                            if branch[x] != branch[y]:
+                                ring = [z] + path(parent, x) + path(parent, y)[-2::-1]
+                                candidates.setdefault(frozenset(ring), ring)
+    
+    def bitmask(ring):
+        mask = 0
+        for a, b in zip(ring, ring[1:] + ring[:1]):
+            mask |= 1 << bondIndex[(a,b) if a < b else (b,a)]
+        return mask
+    
+    def reduce(mask):
+        while mask and (mask.bit_length() - 1) in basis:
+            mask ^= basis[mask.bit_length() - 1]
+        return mask
+    
+    ringList = sorted(((sorted(ring), bitmask(ring)) for ring in candidates.values()),
+                      key=lambda x: (len(x[0]), x[0]))
+    #keep the rings independent of all smaller rings, adding each size to the basis after it
+    basis = {}
+    relevantList = []
+    for length, group in itertools.groupby(ringList, key=lambda x: len(x[0])):
+        reduced = []
+        for ring, mask in group:
+            mask = reduce(mask)
+            if mask:
+                relevantList.append(ring)
+                reduced.append(mask)
+        for mask in reduced:
+            mask = reduce(mask)
+            if mask:
+                basis[mask.bit_length() - 1] = mask
+    return relevantList
+    
+def _expand(indptr, indices, centers):
+    """Return, for every neighbor of every given center atom, the position of its center in
+    centers and the neighbor's index, in order of center and then of the CSR adjacency."""
+    degree = (indptr[1:] - indptr[:-1])[centers]
+    owner = np.repeat(np.arange(len(centers)), degree)
+    #position of each entry within its center's row
+    offset = np.arange(len(owner)) - np.repeat(np.cumsum(degree) - degree, degree)
+    return owner, indices[indptr[centers][owner] + offset].astype(int)
+    
+def _interleave(owners, blocks, width):
+    """Return the rows of the blocks merged in order of their owners, and of the blocks
+    for rows of the same owner (each block being in owner order already)."""
+    if not any(len(block) for block in blocks):
+        return np.zeros((0,width), dtype=int)
+    owner = np.concatenate(owners)
+    order = np.argsort(owner, kind='stable')
+    return np.concatenate(blocks)[order]
+    
 def _combine(mol1, mol2, index1, index2, copy=True):
     """Return a single molecule which is the combination of input molecules.  If nextIndex1 is not
     None, also return the next index1 in the chain process in a tuple.
@@ -904,24 +1116,19 @@ def _combine(mol1, mol2, index1, index2, copy=True):
     mol2.translate(pos1[index1] - mol2.posList[index2])
     
     #adjust molecule neighbors
-    for neighbor in mol2.nList[index2]:
-        if neighbor > index2:
-            mol1.nList[index1].append(neighbor + size1 - 1)
-        elif neighbor < index2:
-            mol1.nList[index1].append(neighbor + size1)
-        else:
-            raise ValueError("An atom can't neighbor itself")
-    for index, nList in enumerate(mol2.nList):
-        if index != index2:
-            newNList = []
-            for neighbor in nList:
-                if neighbor == index2:
-                    newNList.append(index1)
-                elif neighbor > index2:
-                    newNList.append(neighbor + size1 - 1)
-                else:
-                    newNList.append(neighbor + size1)
-            mol2.nList[index] = newNList
+    #new indices of mol2's atoms, its merging atom becomes index1
+    remap = np.arange(size1, size1+size2)
+    remap[index2+1:] -= 1
+    remap[index2] = index1
+    if np.any(mol2.neighbors(index2) == index2):
+        raise ValueError("An atom can't neighbor itself")
+    #mol2's merging atom's neighbors join index1's, then mol2's other atoms follow mol1's
+    degree1, degree2 = mol1.degree(), mol2.degree()
+    extra = remap[mol2.neighbors(index2)]
+    degree1[index1] += len(extra)
+    indices1 = np.insert(mol1.nIndices, mol1.nIndptr[index1+1], extra)
+    indices2 = remap[mol2.nIndices[np.repeat(np.arange(size2) != index2, degree2)]]
+    degrees = np.concatenate((degree1, np.delete(degree2, index2)))
             
     #adjust face attached lists
     mol1.faces[face1].attached = np.concatenate((mol1.faces[face1].attached, np.arange(size1, size1+size2-1, dtype=int)))
@@ -958,11 +1165,11 @@ def _combine(mol1, mol2, index1, index2, copy=True):
     #delete the merging atom of mol2
     pos2 = np.delete(mol2.posList, index2, 0)
     z2 = np.delete(z2, index2, 0)
-    del mol2.nList[index2]
     #add atoms to mol1
     mol1.posList = np.concatenate((pos1,pos2), axis=0)
     mol1.zList = np.concatenate((z1,z2), axis=0)
-    mol1.nList.extend(mol2.nList)
+    mol1.nIndptr = np.concatenate(([0], np.cumsum(degrees))).astype(np.int32)
+    mol1.nIndices = np.concatenate((indices1, indices2)).astype(np.int32)
     
     return mol1
     
@@ -1039,16 +1246,38 @@ def build_graphene(ff, name="", radius=3):
 
     return graphene
         
-def build_cnt_armchair(ff, name="", radius=2, length=15):
+def build_graphene_periodic(ff, name="", width=3, length=3):
+    
+    from .lattice.graphene import main_periodic as lattice
+    posList,nList,cell = lattice(width, length)
+    size = len(posList)
+    if not name:
+        name = 'graphene_periodic_w{0}_l{1}'.format(str(width),str(length))
+    posList = np.array(posList)
+    zList = np.full(size, 6, dtype=int)  #full of carbons
+    
+    #periodic in-plane, so no interfaces
+    return Molecule(ff, name, posList, nList, zList, cbase=True, cell=cell)
+        
+def build_cnt_armchair(ff, name="", radius=2, length=15, periodic=False):
     
-    from .lattice.cntarm import main as lattice
-    posList,nList,faceList = lattice(radius,length)
+    if periodic:
+        from .lattice.cntarm import main_periodic as lattice
+        posList,nList,cell = lattice(radius,length)
+    else:
+        from .lattice.cntarm import main as lattice
+        posList,nList,faceList = lattice(radius,length)
+        cell = None
     size = len(posList)
     if not name:
         name = 'cnt_r{0}_l{1}'.format(str(radius),str(length))
     posList = np.array(posList)
     zList = np.full(size, 6, dtype=int) #full of carbons
-    cnt = Molecule( ff, name, posList, nList, zList, cbase=True)
+    cnt = Molecule( ff, name, posList, nList, zList, cbase=True, cell=cell)
+    
+    if periodic:
+        #periodic along its axis, so no interfaces
+        return cnt
     
     #add faces
     Interface(faceList[0], np.array([0.,1.,0.]), cnt)
@@ -1428,6 +1657,7 @@ def build_cc(ff, name="CC"):
     return cc
             
 _latticeDict = {"graphene":build_graphene, "cnt":build_cnt_armchair, "amine":build_amine, 
+                "graphene_periodic":build_graphene_periodic,
                 "imine":build_imine, "imine_chain":build_imine_chain, "pmma":build_pmma,
                 "pan":build_pan, 
                 "polyeth":build_polyeth, "pvf":build_pvf, "teflon":build_teflon,
@@ -1532,6 +1762,8 @@ def build(ff, lattice, bondtype_kwargs={}, **kwargs):
     mol = _latticeDict[lattice](ff, **kwargs)
     mol._configure(bondtype_kwargs)
     mol.posList *= mol.ff.lunits
+    if mol.cell is not None:
+        mol.cell *= mol.ff.lunits
     return mol
         
         
@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+"""
+Define the non-bonded engines shared by the energy, gradient and Hessian routines:
+Lennard-Jones, with per-type-pair coefficients, a smoothly switched cutoff and an optional
+tabulated mode, and point-charge electrostatics, summed in real space or on a particle mesh.
+"""
+
+import itertools
+
+import numpy as np
+from scipy.special import erfc
+
+from .forcefield import global_cutoff, global_switch
+
+#closest separation (angstroms) covered by the tables, and their number of points
+table_rmin = 0.5
+table_size = 2**13
+
+coulomb = 332.0637   #kcal/mol angstroms/e^2, Coulomb's constant
+dsf_alpha = 0.2      #1/angstroms, default damping of the damped shifted force sum
+mesh_split = 3.12    #default alpha*cutoff of the particle mesh, erfc(3.12) ~ 1e-5
+mesh_spacing = 1.0   #angstroms, default particle-mesh grid spacing
+mesh_order = 4       #order of the B-splines that spread the charges onto the mesh
+
+class LennardJones:
+    """Lennard-Jones interaction of a configured molecule, written per pair as
+    U = a/r^12 - b/r^6 with a = ep*r0^12, b = 2*ep*r0^6 taken from small tables over the
+    distinct (rvdw0, epvdw) atom types.  With the forcefield's switch set, U is smoothly
+    switched off between the switch and cutoff distances (CHARMM's energy switch), so
+    energies don't jump as pairs enter and leave the neighbor lists.
+
+    Args:
+        molecule (Molecule): Molecule with configured rvdw0 and epvdw arrays."""
+
+    __slots__ = ('types', 'ntypes', 'a', 'b', 'ron', 'rc', 'table')
+
+    def __init__(self, molecule):
+        ff = molecule.ff
+        atoms = np.column_stack((molecule.rvdw0, molecule.epvdw))
+        params, self.types = np.unique(atoms, axis=0, return_inverse=True)
+        self.types = self.types.ravel()
+        self.ntypes = len(params)
+        r0 = params[:,0][:,None] + params[:,0][None,:]
+        ep = np.sqrt(params[:,1][:,None]*params[:,1][None,:])
+        self.a = (ep*r0**12).ravel()
+        self.b = (2.*ep*r0**6).ravel()
+        switch = getattr(ff, 'switch', global_switch)
+        if switch is None:
+            self.ron = self.rc = None
+        else:
+            self.rc = getattr(ff, 'cutoff', global_cutoff)*ff.lunits
+            self.ron = min(switch*ff.lunits, self.rc)
+        self.table = None
+        if getattr(ff, 'ljtable', False):
+            if self.rc is None:
+                #the plain potential has no cutoff to tabulate up to
+                raise ValueError("Tabulated Lennard-Jones (ljtable) needs a switch distance")
+            self.table = _tabulate(self.a, self.b, self.ron, self.rc)
+
+    def pair_types(self, i, j):
+        """Return the index into the coefficient tables of each pair (i,j)."""
+        return self.types[i]*self.ntypes + self.types[j]
+
+    def coefficients(self, types):
+        """Return the a and b coefficients of pairs of the given pair types."""
+        return self.a[types], self.b[types]
+
+    def energy(self, s, types):
+        """Return the energies of pairs at squared separations s (any shape ending in the pairs)."""
+        if self.table is not None:
+            return _lookup(self.table, s, types)[0]
+        return lj_radial(s, self.a[types], self.b[types], self.ron, self.rc)[0]
+
+    def derivatives(self, s, types):
+        """Return the energies u and the radial derivatives du = U'(r)/r of pairs
+        at squared separations s, so that the gradient on i is du*(ri - rj)."""
+        if self.table is not None:
+            return _lookup(self.table, s, types)
+        return lj_radial(s, self.a[types], self.b[types], self.ron, self.rc, order=1)[:2]
+
+def lj_radial(s, a, b, ron=None, rc=None, order=0):
+    """Return the Lennard-Jones energy U = a/r^12 - b/r^6 of pairs at squared separations s,
+    switched off between ron and rc if given; with order 1 also U'(r)/r, and with order 2
+    also U''(r).  Returned as a tuple of arrays like s."""
+
+    inv = 1./s
+    inv3 = inv*inv*inv
+    u = (a*inv3 - b)*inv3
+    if order > 0:
+        #derivatives with respect to s = r^2
+        du = (3.*b - 6.*a*inv3)*inv3*inv
+        if order > 1:
+            d2u = (42.*a*inv3 - 12.*b)*inv3*inv*inv
+    if rc is not None:
+        rc2, ron2 = rc*rc, ron*ron
+        inside = (s >= ron2) & (s < rc2)
+        denom = max((rc2 - ron2)**3, np.finfo(float).tiny)
+        t = np.where(inside, s, ron2)
+        sw = np.where(inside, (rc2 - t)**2*(rc2 + 2.*t - 3.*ron2)/denom, (s < ron2).astype(float))
+        if order > 0:
+            dsw = np.where(inside, 6.*(rc2 - t)*(ron2 - t)/denom, 0.)
+            if order > 1:
+                d2sw = np.where(inside, 6.*(2.*t - ron2 - rc2)/denom, 0.)
+                d2u = d2u*sw + 2.*du*dsw + u*d2sw
+            du = du*sw + u*dsw
+        u = u*sw
+    if order == 0:
+        return (u,)
+    #radial derivatives from the s derivatives: U'(r)/r = 2 dU/ds, U''(r) = 2 dU/ds + 4 s d2U/ds2
+    if order == 1:
+        return u, 2.*du
+    return u, 2.*du, 2.*du + 4.*s*d2u
+
+def _tabulate(a, b, ron, rc):
+    """Return the (s0, 1/ds, energies, derivatives) tables of every pair type, on a grid uniform in s."""
+    s = np.linspace(table_rmin**2, rc*rc, table_size)
+    u, du = lj_radial(s[None,:], a[:,None], b[:,None], ron, rc, order=1)
+    #one extra zero point past the cutoff
+    u = np.hstack((u, np.zeros((len(a),1))))
+    du = np.hstack((du, np.zeros((len(a),1))))
+    return s[0], 1./(s[1] - s[0]), u, du
+
+def _lookup(table, s, types):
+    """Linearly interpolate the tabulated energies and derivatives."""
+    s0, ids, u, du = table
+    x = np.clip((s - s0)*ids, 0., table_size - 1.)
+    index = x.astype(np.intp)
+    frac = x - index
+    flat = types*u.shape[1] + index
+    ut, dut = u.ravel(), du.ravel()
+    energy = ut[flat] + frac*(ut[flat+1] - ut[flat])
+    deriv = dut[flat] + frac*(dut[flat+1] - dut[flat])
+    return energy, deriv
+
+class Electrostatics:
+    """Point-charge electrostatics of a configured molecule, k qi qj/r over its non-bonded pairs,
+    evaluated one of two ways (the forcefield's esmethod):
+    
+    'dsf': the damped shifted force sum of Fennell and Gezelter (2006), a real-space pair sum
+        of k qi qj erfc(alpha r)/r shifted so energy and force both vanish at the cutoff,
+        cheap and smooth, and usable with periodic cells.
+    'mesh': an Ewald-like split into the screened pairs k qi qj erfc(alpha r)/r within the
+        cutoff and the smooth remainder k qi qj erf(alpha r)/r of every pair, found in
+        O(N log N) by spreading the charges onto a grid with B-splines and convolving them
+        with the remainder by FFT on a zero-padded grid, for isolated (non-periodic) molecules.
+    
+    The pair parts follow the Lennard-Jones engine's interface; `remainder' adds the rest.
+    
+    Args:
+        molecule (Molecule): Molecule with configured charges and bondList."""
+        
+    __slots__ = ('charges', 'method', 'alpha', 'rc', 'spacing', 'exclusions', 'green')
+    
+    def __init__(self, molecule):
+        ff = molecule.ff
+        self.charges = np.asarray(molecule.charges, dtype=float)
+        self.method = getattr(ff, 'esmethod', 'dsf')
+        self.rc = getattr(ff, 'cutoff', global_cutoff)*ff.lunits
+        self.alpha = getattr(ff, 'esalpha', None)
+        self.spacing = mesh_spacing*ff.lunits
+        self.exclusions = self.green = None
+        if self.method == 'dsf':
+            if self.alpha is None:
+                self.alpha = dsf_alpha/ff.lunits
+        elif self.method == 'mesh':
+            if getattr(molecule, 'cell', None) is not None:
+                raise ValueError("The particle mesh is for isolated molecules, use esmethod='dsf' with a cell")
+            if self.alpha is None:
+                self.alpha = mesh_split/self.rc
+            #the bonded pairs are excluded from the pair list, but not from the mesh
+            bonds = np.asarray(molecule.bondList, dtype=int).reshape(-1,2)
+            self.exclusions = (bonds[:,0], bonds[:,1], self.pair_types(bonds[:,0], bonds[:,1]))
+        else:
+            raise ValueError("Unknown electrostatics method '{0}'".format(self.method))
+            
+    @property
+    def kind(self):
+        """The es_radial kind of the pair part."""
+        return 'dsf' if self.method == 'dsf' else 'short'
+        
+    def pair_types(self, i, j):
+        """Return the charge products k qi qj of each pair (i,j)."""
+        return coulomb*self.charges[i]*self.charges[j]
+        
+    def energy(self, s, qq):
+        """Return the pair-part energies of pairs at squared separations s."""
+        return es_radial(s, qq, self.alpha, self.rc, self.kind)[0]
+        
+    def derivatives(self, s, qq):
+        """Return the pair-part energies u and radial derivatives du = U'(r)/r of pairs
+        at squared separations s."""
+        return es_radial(s, qq, self.alpha, self.rc, self.kind, order=1)
+        
+    def remainder(self, pos, grad=None):
+        """Return the energy that isn't in the pair part, adding its gradient to grad if
+        given: the self energy of the charges, and for the mesh its long-range part."""
+        q2 = coulomb*np.dot(self.charges, self.charges)
+        if self.method == 'dsf':
+            erfcc = erfc(self.alpha*self.rc)/self.rc
+            return -(.5*erfcc + self.alpha/np.sqrt(np.pi))*q2
+        e = self._mesh(pos, grad) - self.alpha/np.sqrt(np.pi)*q2
+        #remove the bonded pairs from the mesh
+        i, j, qq = self.exclusions
+        posij = pos[i] - pos[j]
+        u, du = es_radial(np.einsum('ij,ij->i', posij, posij), qq, self.alpha, kind='long', order=1)
+        if grad is not None:
+            term = du[:,None]*posij
+            np.add.at(grad, i, -term)
+            np.add.at(grad, j, term)
+        return e - np.sum(u)
+        
+    def _mesh(self, pos, grad):
+        """Return half the sum over all atom pairs, each atom with itself included, of
+        k qi qj erf(alpha r)/r, from the charges spread onto the grid."""
+        h, n = self.spacing, mesh_order
+        #the grid is anchored to multiples of the spacing, so it doesn't follow the atoms
+        u = pos/h - (np.floor(np.amin(pos, axis=0)/h) - n)
+        base = np.floor(u).astype(np.intp)
+        #weights of the grid points base - (0,...,n-1) in each direction
+        x = (u - base)[:,:,None] + np.arange(n)
+        w, dw = _bspline(x, n), _bspline(x, n-1) - _bspline(x - 1., n-1)
+        shape = tuple(np.amax(base, axis=0) + 1)
+        padded = tuple(2*m for m in shape)
+        green = self._green_function(shape)
+        
+        #all n^3 grid points about each atom
+        offsets = np.array(list(itertools.product(range(n), repeat=3)))
+        points = base[:,None,:] - offsets
+        flat = np.ravel_multi_index(tuple(points.transpose(2,0,1)), padded)
+        axes = np.arange(3)
+        weights = w[:,axes,offsets]
+        spread = np.prod(weights, axis=2)
+        rho = np.bincount(flat.ravel(), (self.charges[:,None]*spread).ravel(), minlength=np.prod(padded))
+        phi = np.fft.irfftn(np.fft.rfftn(rho.reshape(padded))*green, padded).ravel()[flat]
+        qphi = coulomb*self.charges[:,None]*phi
+        if grad is not None:
+            dweights = dw[:,axes,offsets]
+            for d in range(3):
+                dspread = np.prod(np.where(axes == d, dweights, weights), axis=2)
+                grad[:,d] += np.sum(qphi*dspread, axis=1)/h
+        return .5*np.sum(qphi*spread)
+        
+    def _green_function(self, shape):
+        """Return the transformed erf(alpha r)/r of the zero-padded grid, divided by the
+        squared transforms of the B-splines that spread and gather the charges."""
+        if self.green is not None and self.green[0] == shape:
+            return self.green[1]
+        h, n = self.spacing, mesh_order
+        padded = [2*m for m in shape]
+        axes = [h*np.minimum(np.arange(m), m - np.arange(m)) for m in padded]
+        s = sum(np.square(a) for a in np.ix_(*axes))
+        g = es_radial(np.where(s > 0., s, 1.), 1., self.alpha, kind='long')[0]
+        g = np.where(s > 0., g, 2.*self.alpha/np.sqrt(np.pi))
+        green = np.fft.rfftn(g)
+        for d, m in enumerate(padded):
+            bhat = np.fft.fft(_bspline(np.arange(1., n), n), m)
+            if d == 2:
+                bhat = bhat[:m//2 + 1]
+            green /= np.abs(bhat[(slice(None),) + (None,)*(2-d)])**2
+        self.green = (shape, green)
+        return green
+        
+def es_radial(s, qq, alpha, rc=None, kind='dsf', order=0):
+    """Return the energies of point-charge pairs with charge products qq (including
+    Coulomb's constant) at squared separations s; with order 1 also U'(r)/r, and with
+    order 2 also U''(r).  The kind is 'dsf', the damped shifted force qq (erfc(alpha r)/r
+    shifted to vanish with its slope at rc), 'short', the screened qq erfc(alpha r)/r cut
+    at rc, or 'long', its smooth complement qq erf(alpha r)/r."""
+    
+    r = np.sqrt(s)
+    gauss = 2.*alpha/np.sqrt(np.pi)*np.exp(-alpha*alpha*s)
+    f = erfc(alpha*r)/r
+    #r derivatives of erfc(alpha r)/r
+    df = -(f + gauss)/r
+    d2f = 2.*(f + gauss)/s + 2.*alpha*alpha*gauss
+    if kind == 'long':
+        inv = 1./r
+        f, df, d2f = inv - f, -inv*inv - df, 2.*inv*inv*inv - d2f
+    else:
+        if kind == 'dsf':
+            fc = erfc(alpha*rc)/rc
+            dfc = -(fc + 2.*alpha/np.sqrt(np.pi)*np.exp(-alpha*alpha*rc*rc))/rc
+            f = f - fc - dfc*(r - rc)
+            df = df - dfc
+        inside = s < rc*rc
+        f, df, d2f = np.where(inside, f, 0.), np.where(inside, df, 0.), np.where(inside, d2f, 0.)
+    if order == 0:
+        return (qq*f,)
+    if order == 1:
+        return qq*f, qq*df/r
+    return qq*f, qq*df/r, qq*d2f
+    
+def _bspline(x, n):
+    """Return the cardinal B-spline of order n, nonzero on 0 < x < n, at x."""
+    if n == 1:
+        return ((x >= 0.) & (x < 1.)).astype(float)
+    return (x*_bspline(x, n-1) + (n - x)*_bspline(x - 1., n-1))/(n - 1.)
@@ -9,10 +9,24 @@ Define a set of operations for use on Molecule objects that we don't want being
 
 import os
 import errno
+import hashlib
+import tempfile
+import concurrent.futures
 from copy import deepcopy
+from functools import partial
 import pickle
+import warnings
 
 import numpy as np
+import scipy.linalg
+import scipy.sparse
+import scipy.sparse.linalg
+import scipy.spatial
+
+from .forcefield import global_cutoff
+from .kernel import minimum_image
+from .nonbonded import Electrostatics, LennardJones, es_radial, lj_radial
+from .tersoff import cluster_gradient
 
 #change in position for the finite difference equations
 ds = 1e-5
@@ -25,6 +39,7 @@ vdy = np.array([0.0,dy,0.0])
 vdz = np.array([0.0,0.0,dz])
            
 save_dir = "./kappa_save/"
+hessian_cache_size = 2*1024**3  #bytes, total allowed size of the cached Hessians
 
 def _path_exists(path):
     """Make a path if it doesn't exist"""
@@ -48,43 +63,104 @@ def load(name):
     """Load a pickled molecule given a name"""
     return pickle.load(open(save_dir+name+"/mol.p", "rb"))
     
-def _calculate_hessian(molecule, stapled_index, numgrad=False, onsite=None):
-    """Return the Hessian matrix for the given molecule after calculation."""
+def _hessian_rows(molecule, calculate_grad, indices, local=False):
+    """Return the rows of the finite difference Hessian belonging to the given atom indices.
+    Each atom is displaced in molecule.posList and restored exactly afterwards, so the rows
+    don't depend on which atoms were displaced before them.  If local is True, calculate_grad
+    takes the displaced atom's index and evaluates only the interactions involving it."""
     
-    N = len(molecule)
+    rows = np.zeros([3*len(indices), 3*len(molecule)])
     
-    H = np.zeros([3*N,3*N])
-    
-    if numgrad:
-        calculate_grad = molecule.define_gradient_routine_numerical()
-    else:
-        calculate_grad = molecule.define_gradient_routine_analytical()
-    
-    for i in range(N):
+    for count, i in enumerate(indices):
+        
+        if local:
+            calculate_igrad = partial(calculate_grad, i)
+        else:
+            calculate_igrad = calculate_grad
         
         ipos = molecule.posList[i]
+        orig = ipos.copy()
         
-        ipos += vdx
-        plusXTestGrad,_,_ = calculate_grad()
-        ipos += -2.0*vdx
-        minusXTestGrad,_,_ = calculate_grad()
-        ipos += vdx + vdy
-        plusYTestGrad,_,_ = calculate_grad()
-        ipos += -2.0*vdy
-        minusYTestGrad,_,_ = calculate_grad()
-        ipos += vdy + vdz
-        plusZTestGrad,_,_ = calculate_grad()
-        ipos += -2.0*vdz
-        minusZTestGrad,_,_ = calculate_grad()
-        ipos += vdz
+        ipos[:] = orig + vdx
+        plusXTestGrad,_,_ = calculate_igrad()
+        ipos[:] = orig - vdx
+        minusXTestGrad,_,_ = calculate_igrad()
+        ipos[:] = orig + vdy
+        plusYTestGrad,_,_ = calculate_igrad()
+        ipos[:] = orig - vdy
+        minusYTestGrad,_,_ = calculate_igrad()
+        ipos[:] = orig + vdz
+        plusZTestGrad,_,_ = calculate_igrad()
+        ipos[:] = orig - vdz
+        minusZTestGrad,_,_ = calculate_igrad()
+        ipos[:] = orig
         
         xiRow = (plusXTestGrad - minusXTestGrad)/2.0/dx
         yiRow = (plusYTestGrad - minusYTestGrad)/2.0/dy
         ziRow = (plusZTestGrad - minusZTestGrad)/2.0/dz
         
-        H[3*i    ] = np.hstack(xiRow)
-        H[3*i + 1] = np.hstack(yiRow)
-        H[3*i + 2] = np.hstack(ziRow)
+        rows[3*count    ] = np.hstack(xiRow)
+        rows[3*count + 1] = np.hstack(yiRow)
+        rows[3*count + 2] = np.hstack(ziRow)
+        
+    return rows
+    
+def _define_hessian_gradient(molecule, numgrad, local):
+    """Return the gradient routine used to difference the Hessian."""
+    if local:
+        if numgrad:
+            raise ValueError("Local interaction stencils require the analytical gradient")
+        return molecule.define_gradient_routine_local()
+    elif numgrad:
+        return molecule.define_gradient_routine_numerical()
+    else:
+        return molecule.define_gradient_routine_analytical()
+    
+def _hessian_worker(molecule, indices, numgrad, local):
+    """Return the finite difference Hessian rows of the given atom indices; 
+    the molecule is the worker's own copy so its positions can be displaced freely."""
+    
+    calculate_grad = _define_hessian_gradient(molecule, numgrad, local)
+        
+    return _hessian_rows(molecule, calculate_grad, indices, local=local)
+    
+def _calculate_hessian(molecule, stapled_index, numgrad=False, onsite=None, 
+                       workers=None, executor="process", local=False):
+    """Return the Hessian matrix for the given molecule after calculation.
+    
+    Keywords:
+        workers (int): Number of workers the atoms are split across; if None the
+            atoms are displaced serially.  The result is identical either way.
+        executor (str): Either 'process' or 'thread', the kind of pool the workers run in.
+        local (bool): If True, each displacement re-evaluates only the interactions
+            involving the displaced atom, found from a per-atom incidence index."""
+    
+    N = len(molecule)
+    
+    H = np.zeros([3*N,3*N])
+    
+    if workers is None:
+        
+        calculate_grad = _define_hessian_gradient(molecule, numgrad, local)
+            
+        H[:] = _hessian_rows(molecule, calculate_grad, range(N), local=local)
+        
+    else:
+        
+        if executor == "process":
+            Pool = concurrent.futures.ProcessPoolExecutor
+        elif executor == "thread":
+            Pool = concurrent.futures.ThreadPoolExecutor
+        else:
+            raise ValueError("executor must be either 'process' or 'thread'")
+        
+        chunks = [chunk for chunk in np.array_split(np.arange(N), workers) if len(chunk)]
+        with Pool(max_workers=workers) as pool:
+            #every worker displaces atoms in its own copy of the positions
+            futures = [pool.submit(_hessian_worker, deepcopy(molecule), chunk, numgrad, local)
+                       for chunk in chunks]
+            for chunk, future in zip(chunks, futures):
+                H[3*chunk[0]:3*(chunk[-1]+1)] = future.result()
         
     if stapled_index is not None:
         dk = 1.
@@ -97,33 +173,54 @@ def _calculate_hessian(molecule, stapled_index, numgrad=False, onsite=None):
        
     return H
 
-def hess_bond_stretching(pos, i, j, kb, b0):
+def _dense_hessian(size, rows, cols, blocks):
     """
-    Return the analytical Hessian matrix of the bond stretch energy.
+    Return the dense Hessian matrix composed of the 3x3 blocks placed at
+    the given block rows and columns.
     """
     # create stack of 3x3 blocks that will compose the hessian
-    hess = np.zeros((pos.shape[0]**2,3,3))
+    hess = np.zeros((size**2,3,3))
+    np.add.at(hess, size*rows + cols, blocks)
+    return np.hstack(np.hstack(hess.reshape(size,size,3,3)))
+
+def _sparse_hessian(size, rows, cols, blocks):
+    """
+    Return the sparse (BSR) Hessian matrix composed of the 3x3 blocks placed at
+    the given block rows and columns; blocks sharing a position are summed.
+    """
+    # expand each block into its 9 elements
+    sub = np.arange(3)
+    erows = np.broadcast_to(3*rows[:,None,None] + sub[None,:,None], blocks.shape)
+    ecols = np.broadcast_to(3*cols[:,None,None] + sub[None,None,:], blocks.shape)
+    hess = scipy.sparse.coo_matrix((blocks.ravel(), (erows.ravel(), ecols.ravel())),
+                                   shape=(3*size,3*size))
+    return hess.tobsr(blocksize=(3,3))
+
+def _bond_stretching_blocks(pos, i, j, kb, b0):
+    """
+    Return the block rows, block columns, and 3x3 blocks of the bond stretch Hessian.
+    """
     posij = pos[i] - pos[j]
     rij = np.linalg.norm(posij, axis=1)
     # create stack of subblocks where each layer is the outerproduct of pos diffs
     block  = b0[:,None,None]*np.einsum('ki,kj->kij', posij, posij)/rij[:,None,None]**3
     block += (1. - b0/rij)[:,None,None]*np.tile(np.eye(3), (i.shape[0],1,1))
     block  = 2.*kb[:,None,None]*block
-    # add subblocks to the hessian
-    # first add positives at the unraveled diagonal
-    np.add.at(hess, (pos.shape[0]+1)*i, block)
-    np.add.at(hess, (pos.shape[0]+1)*j, block)
-    # now add off diagonal blocks
-    np.add.at(hess, pos.shape[0]*i + j, -block)
-    np.add.at(hess, pos.shape[0]*j + i, -block)
-    return np.hstack(np.hstack(hess.reshape(pos.shape[0],pos.shape[0],3,3)))
+    # positives at the diagonal, negatives off the diagonal
+    rows = np.concatenate((i, j, i, j))
+    cols = np.concatenate((i, j, j, i))
+    return rows, cols, np.concatenate((block, block, -block, -block))
 
-def hess_bond_bending(pos, i, j, k, kt, t0):
+def hess_bond_stretching(pos, i, j, kb, b0):
     """
-    Return the Hessian of the bond bend energy
+    Return the analytical Hessian matrix of the bond stretch energy.
+    """
+    return _dense_hessian(pos.shape[0], *_bond_stretching_blocks(pos, i, j, kb, b0))
+
+def _bond_bending_blocks(pos, i, j, k, kt, t0):
+    """
+    Return the block rows, block columns, and 3x3 blocks of the bond bend Hessian.
     """
-    # create stack of 3x3 blocks that will compose the hessian
-    hess = np.zeros((pos.shape[0]**2,3,3))
     posij = pos[i] - pos[j]
     poskj = pos[k] - pos[j]
     rij, rkj = np.linalg.norm(posij, axis=1), np.linalg.norm(poskj, axis=1)
@@ -155,25 +252,26 @@ def hess_bond_bending(pos, i, j, k, kt, t0):
     d2udrkdri *=  ((theta-t0)/(rij*sin_t))[:,None,None]*180./np.pi
     d2udrkdri += np.einsum('ki,kj->kij', dtdrk, dtdri)*(180.*180./np.pi/np.pi)
     d2udrkdri *= 2.*kt[:,None,None]
-    # add subblocks to hessian
-    np.add.at(hess, (pos.shape[0]+1)*i, d2udri2)
-    np.add.at(hess, (pos.shape[0]+1)*k, d2udrk2)
-    np.add.at(hess, (pos.shape[0]+1)*j, d2udri2 + d2udrk2 + d2udrkdri + np.transpose(d2udrkdri, (0, 2, 1)))
-    # add off-diagonal blocks
-    np.add.at(hess, pos.shape[0]*i + k, np.transpose(d2udrkdri, (0, 2, 1)))
-    np.add.at(hess, pos.shape[0]*k + i, d2udrkdri)
-    np.add.at(hess, pos.shape[0]*i + j, -d2udri2 - np.transpose(d2udrkdri, (0, 2, 1)))
-    np.add.at(hess, pos.shape[0]*j + i, -d2udri2 - d2udrkdri)
-    np.add.at(hess, pos.shape[0]*k + j, -d2udrk2 - d2udrkdri)
-    np.add.at(hess, pos.shape[0]*j + k, -d2udrk2 - np.transpose(d2udrkdri, (0, 2, 1)))
-    return np.hstack(np.hstack(hess.reshape(pos.shape[0],pos.shape[0],3,3)))
+    d2udridrk = np.transpose(d2udrkdri, (0, 2, 1))
+    # diagonal blocks first, then the off-diagonal blocks
+    rows = np.concatenate((i, k, j, i, k, i, j, k, j))
+    cols = np.concatenate((i, k, j, k, i, j, i, j, k))
+    blocks = np.concatenate((d2udri2, d2udrk2, d2udri2 + d2udrk2 + d2udrkdri + d2udridrk,
+                             d2udridrk, d2udrkdri,
+                             -d2udri2 - d2udridrk, -d2udri2 - d2udrkdri,
+                             -d2udrk2 - d2udrkdri, -d2udrk2 - d2udridrk))
+    return rows, cols, blocks
 
-def hess_dihedral(pos, i, j, k, l, vn, gn):
+def hess_bond_bending(pos, i, j, k, kt, t0):
     """
-    Return the Hessian of the dihedral interaction.
+    Return the Hessian of the bond bend energy
+    """
+    return _dense_hessian(pos.shape[0], *_bond_bending_blocks(pos, i, j, k, kt, t0))
+
+def _dihedral_blocks(pos, i, j, k, l, vn, gn):
+    """
+    Return the block rows, block columns, and 3x3 blocks of the dihedral Hessian.
     """
-    # create stack of 3x3 blocks that will compose the hessian
-    hess = np.zeros((pos.shape[0]**2,3,3))
     posij = pos[i] - pos[j]
     poskj = pos[k] - pos[j]
     poslk = pos[l] - pos[k]
@@ -289,71 +387,590 @@ def hess_dihedral(pos, i, j, k, l, vn, gn):
     jl = u2[:,None,None]*jl + u1[:,None,None]*np.einsum('ki,kj->kij', dwdrj, dwdrl)
     jj = u2[:,None,None]*jj + u1[:,None,None]*np.einsum('ki,kj->kij', dwdrj, dwdrj)
     
+    # diagonal blocks first, then the off-diagonal blocks
+    rows = np.concatenate((i, j, k, l, j, k, l, k, j, i, i, i, l, l, j, k))
+    cols = np.concatenate((i, j, k, l, i, i, i, l, l, j, k, l, k, j, k, j))
+    blocks = np.concatenate((ii, jj, -ki - kl + np.transpose(ji+jl, (0, 2, 1)) + jj, ll,
+                             ji, ki, li, kl, jl,
+                             np.transpose(ji, (0, 2, 1)), np.transpose(ki, (0, 2, 1)),
+                             np.transpose(li, (0, 2, 1)), np.transpose(kl, (0, 2, 1)),
+                             np.transpose(jl, (0, 2, 1)),
+                             -ji - jj - jl, -np.transpose(ji + jl, (0, 2, 1)) - jj))
+    return rows, cols, blocks
+
+def hess_dihedral(pos, i, j, k, l, vn, gn):
+    """
+    Return the Hessian of the dihedral interaction.
+    """
+    return _dense_hessian(pos.shape[0], *_dihedral_blocks(pos, i, j, k, l, vn, gn))
+
+def _radial_blocks(pos, i, j, radial):
+    """
+    Return the block rows, block columns, and 3x3 blocks of the Hessian of a radial pair
+    potential of each pair, where radial(s) returns U'(r)/r and U''(r) at squared separations s.
+    """
+    posij = pos[i] - pos[j]
+    s = np.einsum('ij,ij->i', posij, posij)
+    du, d2u = radial(s)
+    # radial pair potential: U'' along the separation, U'/r across it
+    block  = ((d2u - du)/s)[:,None,None]*np.einsum('ki,kj->kij', posij, posij)
+    block += du[:,None,None]*np.eye(3)
+    # positives at the diagonal, negatives off the diagonal
+    rows = np.concatenate((i, j, i, j))
+    cols = np.concatenate((i, j, j, i))
+    return rows, cols, np.concatenate((block, block, -block, -block))
+
+def _lennard_jones_blocks(pos, i, j, a, b, ron=None, rc=None):
+    """
+    Return the Hessian blocks of the pair potential a/r^12 - b/r^6 of each pair, switched
+    off between ron and rc if given (see nonbonded).
+    """
+    return _radial_blocks(pos, i, j, lambda s: lj_radial(s, a, b, ron, rc, order=2)[1:])
     
-    np.add.at(hess, (pos.shape[0]+1)*i, ii)
-    np.add.at(hess, (pos.shape[0]+1)*j, jj)
-    np.add.at(hess, (pos.shape[0]+1)*k, -ki - kl + np.transpose(ji+jl, (0, 2, 1)) + jj)
-    np.add.at(hess, (pos.shape[0]+1)*l, ll)
-    
-    # add off-diagonal blocks
-    np.add.at(hess, pos.shape[0]*j + i, ji)
-    np.add.at(hess, pos.shape[0]*k + i, ki)
-    np.add.at(hess, pos.shape[0]*l + i, li)
-    np.add.at(hess, pos.shape[0]*k + l, kl)
-    np.add.at(hess, pos.shape[0]*j + l, jl)
-    np.add.at(hess, pos.shape[0]*i + j, np.transpose(ji, (0, 2, 1)))
-    np.add.at(hess, pos.shape[0]*i + k, np.transpose(ki, (0, 2, 1)))
-    np.add.at(hess, pos.shape[0]*i + l, np.transpose(li, (0, 2, 1)))
-    np.add.at(hess, pos.shape[0]*l + k, np.transpose(kl, (0, 2, 1)))
-    np.add.at(hess, pos.shape[0]*l + j, np.transpose(jl, (0, 2, 1)))
-    ###
-    np.add.at(hess, pos.shape[0]*j + k, -ji - jj -jl)
-    np.add.at(hess, pos.shape[0]*k + j, -np.transpose(ji + jl, (0, 2, 1)) - jj)
-    
-    return np.hstack(np.hstack(hess.reshape(pos.shape[0],pos.shape[0],3,3)))
+def _electrostatic_blocks(pos, i, j, qq, alpha, rc):
+    """
+    Return the Hessian blocks of the damped shifted force point-charge pairs with
+    charge products qq (see nonbonded).
+    """
+    return _radial_blocks(pos, i, j, lambda s: es_radial(s, qq, alpha, rc, 'dsf', order=2)[1:])
+
+def _tersoff_blocks(pos, *args):
+    """
+    Return the block rows, block columns, and 3x3 blocks of the Hessian of the Tersoff bond
+    clusters, args being the W cluster index arrays and then the M by W-2 neighbor mask;
+    central differences of the analytical cluster gradients.
+    """
+    columns, mask = args[:-1], args[-1]
+    m, w = len(columns[0]), len(columns)
+    clusterPos = np.stack([pos[c] for c in columns], axis=1)
+    #all 3W displacements of the clusters at once
+    disp = np.zeros((3*w,1,w,3))
+    disp[np.arange(3*w),0,np.arange(3*w)//3,np.arange(3*w)%3] = ds
+    grad = lambda x: cluster_gradient(x, mask)[1]
+    hess = (grad(clusterPos + disp) - grad(clusterPos - disp))/(2.*ds)
+    # per-cluster 3W x 3W matrices, symmetrized
+    hess = hess.reshape(3*w,m,3*w).transpose(1,2,0)
+    hess = .5*(hess + hess.transpose(0,2,1))
+    blocks = hess.reshape(m,w,3,w,3).transpose(1,3,0,2,4).reshape(w*w*m,3,3)
+    rows = np.concatenate([np.repeat(c[None], w, axis=0).ravel() for c in columns])
+    cols = np.tile(np.concatenate(columns), w)
+    return rows, cols, blocks
 
 def hess_lennard_jones(pos, i, j, rvdw0, epvdw):
     """
-    Return the Hessian of the Lennard-Jones interaction.
+    Return the Hessian of the (unswitched) Lennard-Jones interaction.
     """
-    # create stack of 3x3 blocks that will compose the hessian
-    hess = np.zeros((pos.shape[0]**2,3,3))
-    posij = pos[i] - pos[j]
-    rij = np.linalg.norm(posij, axis=1)
     ep = np.sqrt(epvdw[i]*epvdw[j])
     r0 = rvdw0[i] + rvdw0[j]
-    # create stack of subblocks where each layer is the outerproduct of pos diffs
-    block  = (24.*ep*(r0**6/rij**10))[:,None,None]*np.einsum('ki,kj->kij', posij, posij)
-    block  = (4. - 7.*(r0**6/rij**6))[:,None,None]*block
-    block += -(12.*ep*(r0**6/rij**8)*(1. - (r0**6/rij**6)))[:,None,None]*np.tile(np.eye(3), (i.shape[0],1,1))
-    # add subblocks to the hessian
-    np.add.at(hess, (pos.shape[0]+1)*i, -block)
-    np.add.at(hess, (pos.shape[0]+1)*j, -block)
-    # now add off diagonal blocks
-    np.add.at(hess, pos.shape[0]*i + j,  block)
-    np.add.at(hess, pos.shape[0]*j + i,  block)
-    return np.hstack(np.hstack(hess.reshape(pos.shape[0],pos.shape[0],3,3)))
-    
-    
-def hessian(molecule):
-    """Return the Hessian for a molecule; if it doesn't exist calculate it otherwise load it
-    from the numpy format."""
-    path = save_dir + molecule.name
-    #check if path exists
-    _path_exists(path)
+    return _dense_hessian(pos.shape[0], *_lennard_jones_blocks(pos, i, j, ep*r0**12, 2.*ep*r0**6))
+
+def _periodic(block_func, cell, nindex):
+    """Return block_func evaluated with every interaction's atoms placed at their nearest
+    periodic images to its first atom.  The first nindex arguments after the positions are
+    the atom index arrays."""
+    if cell is None:
+        return block_func
+    icell = np.linalg.pinv(cell)
+    
+    def periodic_blocks(pos, *args):
+        indices, params = args[:nindex], args[nindex:]
+        m = len(indices[0])
+        atoms = np.concatenate(indices)
+        first = np.tile(pos[indices[0]], (nindex,1))
+        local = first + minimum_image(pos[atoms] - first, cell, icell)
+        rows, cols, blocks = block_func(local, *[np.arange(q*m, (q+1)*m) for q in range(nindex)], *params)
+        return atoms[rows], atoms[cols], blocks
+        
+    return periodic_blocks
+
+def _hessian_terms(molecule):
+    """Return a list of (interactions, params, blocks) for each of the molecule's enabled
+    forcefield terms.  params holds the forcefield parameters of each interaction, indexed
+    like interactions, and blocks(pos, sel) returns the Hessian blocks of the selected
+    interactions at the given positions (their nearest images, for periodic molecules)."""
+    
+    ff = molecule.ff
+    terms = []
+    cell = getattr(molecule, 'cell', None)
+    stretching_blocks = _periodic(_bond_stretching_blocks, cell, 2)
+    bending_blocks = _periodic(_bond_bending_blocks, cell, 3)
+    dihedral_blocks = _periodic(_dihedral_blocks, cell, 4)
+    lennard_jones_blocks = _periodic(_lennard_jones_blocks, cell, 2)
+    electrostatic_blocks = _periodic(_electrostatic_blocks, cell, 2)
+    
+    if ff.lengths:
+        bondList, kb, b0 = molecule.bondList, np.asarray(molecule.kb), np.asarray(molecule.b0)
+        def bond_blocks(pos, sel):
+            return stretching_blocks(pos, bondList[sel,0], bondList[sel,1], kb[sel], b0[sel])
+        terms.append((bondList, np.column_stack((kb, b0)), bond_blocks))
+        
+    if ff.angles:
+        angleList, kt, t0 = molecule.angleList, np.asarray(molecule.kt), np.asarray(molecule.t0)
+        def angle_blocks(pos, sel):
+            i,j,k = angleList[sel,0], angleList[sel,1], angleList[sel,2]
+            return bending_blocks(pos, i, j, k, kt[sel], t0[sel])
+        terms.append((angleList, np.column_stack((kt, t0)), angle_blocks))
+        
+    if ff.dihs:
+        dihList, vn, gn = molecule.dihList, np.asarray(molecule.vn), np.asarray(molecule.gn)
+        def dih_blocks(pos, sel):
+            i,j,k,l = dihList[sel].T
+            return dihedral_blocks(pos, i, j, k, l, vn[sel], gn[sel])
+        terms.append((dihList, np.hstack((vn, gn)), dih_blocks))
+        
+    if ff.imptors:
+        #impropers share the dihedral functional form
+        imptorsList, vni, gni = molecule.imptorsList, np.asarray(molecule.vni), np.asarray(molecule.gni)
+        def imptors_blocks(pos, sel):
+            i,j,k,l = imptorsList[sel].T
+            return dihedral_blocks(pos, i, j, k, l, vni[sel], gni[sel])
+        terms.append((imptorsList, np.hstack((vni, gni)), imptors_blocks))
+        
+    if ff.lj:
+        nbnList, rvdw0, epvdw = molecule.nbnList, molecule.rvdw0, molecule.epvdw
+        lj = LennardJones(molecule)
+        def lj_blocks(pos, sel):
+            i, j = nbnList[sel,0], nbnList[sel,1]
+            a, b = lj.coefficients(lj.pair_types(i, j))
+            return lennard_jones_blocks(pos, i, j, a, b, lj.ron, lj.rc)
+        ipairs, jpairs = nbnList[:,0], nbnList[:,1]
+        params = np.column_stack((rvdw0[ipairs], rvdw0[jpairs], epvdw[ipairs], epvdw[jpairs]))
+        terms.append((nbnList, params, lj_blocks))
+        
+    if ff.es:
+        es = Electrostatics(molecule)
+        if es.method == 'mesh':
+            #the mesh's long-range part couples every pair, it has no sparse Hessian
+            raise ValueError("The particle-mesh electrostatics have no analytical Hessian, "
+                             "use esmethod='dsf' or the finite difference Hessian")
+        pairs = molecule.nbnList
+        def es_blocks(pos, sel):
+            i, j = pairs[sel,0], pairs[sel,1]
+            return electrostatic_blocks(pos, i, j, es.pair_types(i, j), es.alpha, es.rc)
+        charges = np.asarray(molecule.charges)
+        terms.append((pairs, np.column_stack((charges[pairs[:,0]], charges[pairs[:,1]])), es_blocks))
+        
+    if ff.tersoff:
+        clusters = molecule.tersoffList
+        tersoff_blocks = _periodic(_tersoff_blocks, cell, clusters.shape[1])
+        mask = (clusters[:,2:] != clusters[:,:1]).astype(float)
+        def cluster_blocks(pos, sel):
+            return tersoff_blocks(pos, *clusters[sel].T, mask[sel])
+        #no parameters beyond the clusters' atoms
+        terms.append((clusters, np.zeros((len(clusters),0)), cluster_blocks))
+        
+    return terms
+    
+def _spring_blocks(size, stapled_index, onsite):
+    """Return the Hessian blocks of the stapling spring and on-site springs, if any."""
+    
+    blockList = []
+        
+    if stapled_index is not None:
+        dk = 1.
+        blockList.append((np.array([stapled_index]), np.array([stapled_index]), dk*np.eye(3)[None]))
+        
+    if onsite is not None:
+        diag = np.arange(size)
+        blockList.append((diag, diag, onsite*np.tile(np.eye(3), (size,1,1))))
+        
+    return blockList
+    
+def _assemble(size, blockList):
+    """Return the sparse Hessian summed from a list of (rows, cols, blocks)."""
+    if not blockList:
+        return scipy.sparse.bsr_matrix((3*size,3*size), blocksize=(3,3))
+    rows, cols, blocks = [np.concatenate(x) for x in zip(*blockList)]
+    return _sparse_hessian(size, rows, cols, blocks)
+
+def analytical_hessian(molecule, stapled_index=None, onsite=None):
+    """Return the Hessian matrix of the molecule's enabled forcefield terms as a sparse
+    block (BSR) matrix of 3x3 blocks.  Each term contributes blocks only for the atoms it
+    couples, so the assembly scales with the number of interactions rather than the
+    square of the number of atoms.
+    
+    Args:
+        molecule (Molecule): Configured molecule whose Hessian is calculated.
+    Keywords:
+        stapled_index (int): Index of an atom tethered in place by an extra unit spring.
+        onsite (float): On-site spring constant added to every diagonal element."""
+        
+    N = len(molecule)
+    pos = molecule.posList
+    
+    blockList = [blocks(pos, slice(None)) for _, _, blocks in _hessian_terms(molecule)]
+    blockList.extend(_spring_blocks(N, stapled_index, onsite))
+    
+    return _assemble(N, blockList)
+    
+def _interaction_keys(*interactionLists):
+    """Return the integer keys of the rows of each interaction list, equal for equal rows
+    across the lists.  The keys rank the rows, so they can't overflow like a raveled index."""
+    lists = [np.asarray(interactions, dtype=np.int64) for interactions in interactionLists]
+    rows = np.concatenate(lists)
+    order = np.lexsort(rows.T[::-1])
+    ranked = rows[order]
+    new = np.ones(len(rows), dtype=bool)
+    new[1:] = np.any(ranked[1:] != ranked[:-1], axis=1)
+    keys = np.empty(len(rows), dtype=np.int64)
+    keys[order] = np.cumsum(new) - 1
+    return np.split(keys, np.cumsum([len(interactions) for interactions in lists])[:-1])
+    
+def attachment_region(trial, nbase, sites, depth=3):
+    """Return the boolean mask of the trial atoms near the chains attached to a base of
+    nbase atoms: the attached atoms, the base atoms within `depth' bonds of them and,
+    with non-bonded terms, the base atoms within the cutoff of an attached atom.
+    
+    Args:
+        trial (Molecule): Configured trial molecule, its first nbase atoms the base's.
+        nbase (int): Number of atoms of the base.
+        sites (list): Indices of the base atoms the chains were attached to.
+    Keywords:
+        depth (int): Number of bonds the region reaches into the base."""
+    
+    N = len(trial)
+    near = np.zeros(N, dtype=bool)
+    near[nbase:] = True
+    near[np.asarray(sites, dtype=int)] = True
+    adjacency = scipy.sparse.csr_matrix((np.ones(len(trial.nIndices)), trial.nIndices, trial.nIndptr),
+                                        shape=(N,N))
+    for _ in range(depth):
+        near |= adjacency @ near > 0
+    ff = trial.ff
+    if (ff.lj or ff.es) and N > nbase:
+        cutoff = getattr(ff, 'cutoff', global_cutoff)*ff.lunits
+        tree = scipy.spatial.cKDTree(trial.posList[:nbase])
+        found = tree.query_ball_point(trial.posList[nbase:], cutoff)
+        near[np.concatenate([np.asarray(atoms, dtype=int) for atoms in found])] = True
+    return near
+    
+def incremental_hessian(base, base_hessian, trial, sites, stapled_index=None, onsite=None, depth=3):
+    """Return the sparse Hessian of a trial molecule built from `base' by attaching chains
+    at the base atoms `sites' (so the first len(base) atoms are the base's atoms), reusing
+    the base's Hessian.
+    
+    Only the interactions that are new, whose parameters changed, or that involve an
+    atom of the attachment_region are evaluated; their blocks replace the base's stale
+    blocks of the same interactions.  The blocks of the rest of the base are kept as they
+    were at the base's geometry, so after the trial is minimized the result differs from
+    analytical_hessian(trial) by how much that relaxation changed them far from the chains.
+    On a CNT base with a polyethylene chain, every atom displaced by ~0.01 angstroms, that
+    is a relative (Frobenius) error of ~5e-3 in the Hessian and ~1e-4 in its eigenvalues.
+    
+    Args:
+        base (Molecule): The base molecule the trial was built from.
+        base_hessian (sparse matrix): analytical_hessian of the base, without any springs.
+        trial (Molecule): Configured trial molecule.
+        sites (list): Indices of the base atoms the chains were attached to.
+    Keywords:
+        stapled_index (int): Index of an atom tethered in place by an extra unit spring.
+        onsite (float): On-site spring constant added to every diagonal element.
+        depth (int): Number of bonds the recalculated region reaches into the base."""
+    
+    nbase, N = len(base), len(trial)
+    
+    #base atoms far from the attached chains
+    fixed = ~attachment_region(trial, nbase, sites, depth)
+    
+    blockList = []
+    reused = 0
+    for (tList, tParams, tBlocks), (bList, bParams, bBlocks) in zip(_hessian_terms(trial),
+                                                                     _hessian_terms(base)):
+        reuse_t = np.zeros(len(tList), dtype=bool)
+        reuse_b = np.zeros(len(bList), dtype=bool)
+        if len(tList) and len(bList):
+            tKeys, bKeys = _interaction_keys(tList, bList)
+            #only match interaction lists without repeats
+            if np.unique(tKeys).size == tKeys.size and np.unique(bKeys).size == bKeys.size:
+                _, tMatch, bMatch = np.intersect1d(tKeys, bKeys, assume_unique=True,
+                                                   return_indices=True)
+                same = (np.all(tParams[tMatch] == bParams[bMatch], axis=1)
+                        & np.all(fixed[tList[tMatch]], axis=1))
+                reuse_t[tMatch[same]] = True
+                reuse_b[bMatch[same]] = True
+                reused += np.count_nonzero(same)
+        #remove the stale base contributions, add the trial's
+        rows, cols, blocks = bBlocks(base.posList, ~reuse_b)
+        blockList.append((rows, cols, -blocks))
+        blockList.append(tBlocks(trial.posList, ~reuse_t))
+    if not reused:
+        warnings.warn("No interaction of the base Hessian could be reused, the whole trial "
+                      "was recalculated; analytical_hessian is cheaper", stacklevel=2)
+        
+    blockList.extend(_spring_blocks(N, stapled_index, onsite))
+    
+    #extend the base Hessian with empty block rows for the attached atoms
+    base_hessian = scipy.sparse.bsr_matrix(base_hessian, blocksize=(3,3))
+    indptr = np.concatenate((base_hessian.indptr, 
+                             np.full(N-nbase, base_hessian.indptr[-1], dtype=base_hessian.indptr.dtype)))
+    H = scipy.sparse.bsr_matrix((base_hessian.data, base_hessian.indices, indptr), shape=(3*N,3*N))
+    
+    return (H + _assemble(N, blockList)).tobsr(blocksize=(3,3))
+    
+def hessian_operator(molecule, stapled_index=None, onsite=None, chunk=2**14):
+    """Return the Hessian of the molecule as a scipy LinearOperator that computes H.v
+    from the analytical second derivatives without ever forming H.  The blocks of at most
+    `chunk' interactions exist at a time, so memory stays O(N); positions are read from
+    molecule.posList whenever a product is taken.
+    
+    Args:
+        molecule (Molecule): Configured molecule whose Hessian is applied.
+    Keywords:
+        stapled_index (int): Index of an atom tethered in place by an extra unit spring.
+        onsite (float): On-site spring constant added to every diagonal element.
+        chunk (int): Number of interactions whose blocks are evaluated together."""
+    
+    N = len(molecule)
+    terms = _hessian_terms(molecule)
+    
+    def matvec(v):
+        v = np.asarray(v, dtype=float).reshape(N,3)
+        pos = molecule.posList
+        hv = np.zeros((N,3))
+        for interactions, _, blocks in terms:
+            for start in range(0, len(interactions), chunk):
+                rows, cols, hblocks = blocks(pos, slice(start, start+chunk))
+                prod = np.einsum('kij,kj->ki', hblocks, v[cols])
+                for dim in range(3):
+                    hv[:,dim] += np.bincount(rows, weights=prod[:,dim], minlength=N)
+        if stapled_index is not None:
+            dk = 1.
+            hv[stapled_index] += dk*v[stapled_index]
+        if onsite is not None:
+            hv += onsite*v
+        return hv.ravel()
+        
+    def block_diagonal():
+        """Return the N by 3 by 3 stack of the Hessian's diagonal blocks."""
+        pos = molecule.posList
+        diag = np.zeros((N,3,3))
+        for interactions, _, blocks in terms:
+            for start in range(0, len(interactions), chunk):
+                rows, cols, hblocks = blocks(pos, slice(start, start+chunk))
+                onDiag = np.where(rows == cols)[0]
+                for q in range(3):
+                    for p in range(3):
+                        diag[:,q,p] += np.bincount(rows[onDiag], weights=hblocks[onDiag,q,p], minlength=N)
+        for rows, _, hblocks in _spring_blocks(N, stapled_index, onsite):
+            diag[rows] += hblocks
+        return diag
+        
+    operator = scipy.sparse.linalg.LinearOperator((3*N,3*N), matvec=matvec, rmatvec=matvec, dtype=float)
+    #exposed for preconditioning, see normal_modes
+    operator.block_diagonal = block_diagonal
+    return operator
+    
+#molecule attributes that enter the Hessian cache key
+_hessian_key_attrs = ("posList", "bondList", "angleList", "dihList", "imptorsList", "nbnList",
+                      "kb", "b0", "kt", "t0", "vn", "gn", "vni", "gni", "rvdw0", "epvdw", "charges",
+                      "tersoffList", "cell")
+
+def _hessian_key(molecule, stapled_index, onsite):
+    """Return a digest of everything the Hessian of the molecule depends on:
+    positions, topology, forcefield parameters and flags, and the added springs."""
+    ff = molecule.ff
+    digest = hashlib.sha1()
+    flags = (ff.name, ff.eunits, ff.lunits, ff.lengths, ff.angles, ff.dihs, ff.imptors,
+             ff.lj, ff.es, ff.tersoff, stapled_index, onsite,
+             getattr(ff, 'cutoff', None), getattr(ff, 'switch', None),
+             getattr(ff, 'esmethod', None), getattr(ff, 'esalpha', None))
+    digest.update(repr(flags).encode())
+    for attr in _hessian_key_attrs:
+        arr = getattr(molecule, attr, None)
+        arr = np.ascontiguousarray([] if arr is None else arr)
+        digest.update("{0}{1}{2}".format(attr, arr.shape, arr.dtype.str).encode())
+        digest.update(arr.tobytes())
+    return digest.hexdigest()
+    
+def _evict(cache_dir, max_size):
+    """Delete the least recently used cached matrices until the cache fits in max_size bytes."""
+    entries = []
+    for filename in os.listdir(cache_dir):
+        if filename.endswith(".npy"):
+            path = os.path.join(cache_dir, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in entries:
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+    
+def hessian(molecule, stapled_index=None, onsite=None, max_size=None):
+    """Return the Hessian for a molecule; if it isn't cached calculate it, otherwise load it
+    (memory-mapped, read-only) from the numpy format.
+    
+    The cache is keyed on a digest of what the Hessian depends on (see _hessian_key), so
+    renamed molecules still hit it and altered ones never load a stale matrix.
+    
+    Keywords:
+        stapled_index (int): Index of an atom tethered in place by an extra unit spring.
+        onsite (float): On-site spring constant added to every diagonal element.
+        max_size (int): Total size in bytes the cache is allowed to occupy; least recently
+            used matrices are evicted past it.  Default is hessian_cache_size."""
+    if max_size is None:
+        max_size = hessian_cache_size
+    cache_dir = save_dir + "hessians"
+    _path_exists(cache_dir)
+    path = os.path.join(cache_dir, _hessian_key(molecule, stapled_index, onsite) + ".npy")
     #if Hessian file exists then load it; otherwise calculate it and save it
-    if _file_exists(path + "/hessian.npy"):
+    if _file_exists(path):
         print("Loading Hessian matrix from file...")
-        return np.load(path + "/hessian.npy")
-    else:
-        print("Calculating the Hessian matrix for " + molecule.name + "...")
-        H = _calculate_hessian(molecule)
-        print("Done!")
-        np.save(path + "/hessian.npy", H)
-        return H
+        try:
+            H = np.load(path, mmap_mode='r')
+            #mark as recently used
+            os.utime(path, None)
+            return H
+        except (OSError, ValueError):
+            #evicted by another process in the meantime
+            pass
+    print("Calculating the Hessian matrix for " + molecule.name + "...")
+    H = analytical_hessian(molecule, stapled_index, onsite=onsite).toarray()
+    print("Done!")
+    if H.nbytes <= max_size:
+        #write to a temporary file first so that readers never see a partial matrix
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=cache_dir)
+        try:
+            with os.fdopen(fd, "wb") as file_:
+                np.save(file_, H)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        _evict(cache_dir, max_size)
+    return H
     
 def evecs(hessian):
-    """Return the eigenvalues and eigenvectors associated with a given Hessian matrix."""
-    w,vr = np.linalg.eig(hessian)
+    """Return the eigenvalues and eigenvectors associated with a given (symmetric) Hessian matrix."""
+    if scipy.sparse.issparse(hessian):
+        hessian = hessian.toarray()
+    w,vr = np.linalg.eigh(hessian)
     return w,vr
-        
\ No newline at end of file
+    
+def dynamical_matrix(molecule, hessian):
+    """Return the mass-weighted dynamical matrix M^(-1/2) H M^(-1/2) of a molecule's Hessian,
+    sparse if the Hessian is sparse and matrix-free if it is a LinearOperator."""
+    minv = 1./np.sqrt(np.repeat(molecule.mass, 3))
+    if isinstance(hessian, scipy.sparse.linalg.LinearOperator):
+        def matvec(v):
+            return minv*hessian.matvec(minv*np.ravel(v))
+        return scipy.sparse.linalg.LinearOperator(hessian.shape, matvec=matvec, rmatvec=matvec,
+                                                  dtype=float)
+    if scipy.sparse.issparse(hessian):
+        minv = scipy.sparse.diags(minv)
+        dmat = minv @ hessian @ minv
+        return (.5*(dmat + dmat.T)).tocsr()
+    dmat = minv[:,None]*np.asarray(hessian)*minv[None,:]
+    return .5*(dmat + dmat.T)
+    
+def normal_modes(molecule, hessian, count=None, window=None, sigma=None):
+    """Return the squared angular frequencies (ascending) and the eigenvectors of the
+    molecule's dynamical matrix, using a symmetric eigensolver.  Dense Hessians are
+    diagonalized with eigh, sparse ones with shift-invert Lanczos (eigsh), so only the
+    requested part of the spectrum is computed.
+    
+    Hessians given as a LinearOperator (see hessian_operator) are never formed; the
+    lowest `count' modes are found by LOBPCG iteration on the products alone, unless
+    there are too many of them for its block, over a fifth of the size.
+    
+    Args:
+        molecule (Molecule): Molecule whose mass array weights the Hessian.
+        hessian (ndarray, sparse matrix or LinearOperator): The 3N by 3N Hessian of the molecule.
+    Keywords:
+        count (int): Number of modes to return, those lowest in frequency
+            (or closest to sigma for sparse Hessians).  Default is all of them.
+        window (tuple): (low, high) angular frequencies bounding the returned modes.
+        sigma (float): Squared frequency the sparse solver shifts about; defaults to just below
+            zero for a mode count and to the middle of the window otherwise."""
+    
+    dmat = dynamical_matrix(molecule, hessian)
+    size = dmat.shape[0]
+    
+    if isinstance(dmat, scipy.sparse.linalg.LinearOperator):
+        if count is None or window is not None:
+            raise ValueError("Matrix-free Hessians need a mode count and no window")
+        #LOBPCG converges to the low end of a stiff spectrum far faster than plain Lanczos;
+        #a few extra guard vectors help the last requested modes converge
+        block = min(count + 4, size)
+        if 5*block > size:
+            #too many modes for the size, LOBPCG needs its block well under it; form the matrix
+            dense = dmat.matmat(np.eye(size))
+            val, vec = scipy.linalg.eigh(.5*(dense + dense.T), subset_by_index=[0, min(count, size)-1])
+            return val, vec
+        guess = np.random.RandomState(0).randn(size, block)
+        precon = None
+        if hasattr(hessian, 'block_diagonal'):
+            #block Jacobi preconditioner from the mass-weighted diagonal blocks
+            minv = 1./np.sqrt(molecule.mass)
+            dblocks = np.linalg.pinv(minv[:,None,None]*hessian.block_diagonal()*minv[:,None,None])
+            def apply_precon(x):
+                x = np.asarray(x).reshape(len(molecule), 3, -1)
+                return np.einsum('kij,kjl->kil', dblocks, x).reshape(size, -1)
+            precon = scipy.sparse.linalg.LinearOperator((size,size), matvec=apply_precon,
+                                                        matmat=apply_precon, dtype=float)
+        val, vec = scipy.sparse.linalg.lobpcg(dmat, guess, M=precon, largest=False, tol=1e-8, maxiter=5000)
+        order = np.argsort(val)[:count]
+        return val[order], vec[:,order]
+    
+    if window is not None:
+        low, high = window
+        bounds = (np.sign(low)*low*low, np.sign(high)*high*high)
+    
+    if not scipy.sparse.issparse(dmat):
+        if window is not None:
+            val, vec = scipy.linalg.eigh(dmat, subset_by_value=bounds)
+        elif count is not None:
+            val, vec = scipy.linalg.eigh(dmat, subset_by_index=[0, min(count, size)-1])
+        else:
+            val, vec = scipy.linalg.eigh(dmat)
+        if window is not None and count is not None:
+            val, vec = val[:count], vec[:,:count]
+        return val, vec
+    
+    if window is None:
+        if count is None:
+            #the whole spectrum was asked for
+            return normal_modes(molecule, hessian.toarray())
+        lowest = sigma is None
+        if lowest:
+            #shift below the (nearly zero) acoustic modes so the shifted matrix is invertible
+            sigma = -1e-8*np.abs(dmat.diagonal()).max()
+        val, vec = scipy.sparse.linalg.eigsh(dmat, k=min(count, size-1), sigma=sigma, which='LM')
+        #unstable (negative) modes can lie below the shift, move it under them and retry
+        while lowest and val.min() < sigma:
+            sigma = 2.*val.min()
+            val, vec = scipy.sparse.linalg.eigsh(dmat, k=min(count, size-1), sigma=sigma, which='LM')
+    else:
+        #the spectrum lies within the Gershgorin discs, the window needn't reach past them
+        diag = dmat.diagonal()
+        radius = np.asarray(abs(dmat).sum(axis=1)).ravel() - np.abs(diag)
+        low, high = max(bounds[0], np.amin(diag - radius)), min(bounds[1], np.amax(diag + radius))
+        if sigma is None:
+            sigma = .5*(low + high)
+        reach = max(sigma - low, high - sigma)
+        #grow the number of Lanczos modes until the whole window is spanned; the k modes
+        #nearest sigma hold every mode closer than the farthest of them
+        k = count or 6
+        while True:
+            if 2*k >= size:
+                #most of the spectrum, diagonalize it whole
+                return normal_modes(molecule, hessian.toarray(), count=count, window=window)
+            val, vec = scipy.sparse.linalg.eigsh(dmat, k=k, sigma=sigma, which='LM')
+            if np.amax(np.abs(val - sigma)) >= reach:
+                break
+            k *= 2
+        inside = np.where((val > bounds[0]) & (val <= bounds[1]))[0]
+        val, vec = val[inside], vec[:,inside]
+        
+    order = np.argsort(val)
+    if count is not None:
+        order = order[:count]
+    return val[order], vec[:,order]
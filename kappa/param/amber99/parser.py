@@ -8,6 +8,17 @@ import csv
 
 import numpy as np
 
+def save_compact(name, dim, types, params):
+    """Save the sorted keys of the type tuples, in both orientations and in base dim,
+    and their rows of parameters; the later of repeated definitions wins."""
+    types = np.concatenate((types, types[:,::-1]))
+    params = np.concatenate((params, params))
+    keys = np.ravel_multi_index(tuple(types.T), (dim,)*types.shape[1])
+    #last occurrence of each key
+    keys, last = np.unique(keys[::-1], return_index=True)
+    np.save(name+"_keys", keys)
+    np.save(name+"_params", params[::-1][last])
+
 def parse():
     
     file_ = './parm99.dat'
@@ -40,12 +51,7 @@ def parse():
         b0.append(float(line[15:22]))
     bond_types = np.array([(a_types.index(a), a_types.index(b))
                             for a,b in bond_types])
-    kbArr = np.zeros((dim,dim,2))
-    kbArr[bond_types[:,0], bond_types[:,1],0] = np.array(kb)
-    kbArr[bond_types[:,1], bond_types[:,0],0] = np.array(kb)
-    kbArr[bond_types[:,0], bond_types[:,1],1] = np.array(b0)
-    kbArr[bond_types[:,1], bond_types[:,0],1] = np.array(b0)
-    np.save("blengths", kbArr)
+    save_compact("bond", dim, bond_types, np.column_stack((kb, b0)))
       
     #angles
     angle_types = []
@@ -59,12 +65,7 @@ def parse():
         t0.append(float(line[21:28]))
     angle_types = np.array([(a_types.index(a), a_types.index(b), a_types.index(c))
                             for a,b,c in angle_types])
-    ktArr = np.zeros((dim,dim,dim,2))
-    ktArr[angle_types[:,0], angle_types[:,1], angle_types[:,2],0] = np.array(kt)
-    ktArr[angle_types[:,2], angle_types[:,1], angle_types[:,0],0] = np.array(kt)
-    ktArr[angle_types[:,0], angle_types[:,1], angle_types[:,2],1] = np.array(t0)
-    ktArr[angle_types[:,2], angle_types[:,1], angle_types[:,0],1] = np.array(t0)
-    np.save("bangles", ktArr)
+    save_compact("angle", dim, angle_types, np.column_stack((kt, t0)))
     
     #dihedrals
     #dihedrals are different because we must handle wildcard atoms
@@ -83,6 +84,20 @@ def parse():
     np.save("dih", dihArr)
     np.save("vn", vns)
     
+    #impropers, the third atom is the center and only the first two may be wildcards
+    imp_types = []
+    vnis = []
+    
+    for line in lines[section[3]+1:section[4]]:
+        line=line[0]
+        a,b,c,d = map(str.rstrip, [line[:2],line[3:5],line[6:8],line[9:11]])
+        imp_types.append([a,b,c,d])
+        vnis.append([float(x) for x in line[11:].split()[:3]])
+        
+    impArr = [[None if i == wc else a_types.index(i) for i in imp_type] for imp_type in imp_types]
+    np.save("imp", impArr)
+    np.save("vni", vnis)
+    
     # lennard-jones terms
     eps = np.zeros(dim)
     rvdw0 = np.zeros(dim)
@@ -288,9 +288,9 @@ def participation(mol):
     
     fig = plt.figure()
     
-    from .operation import hessian, evecs
+    from .operation import hessian, normal_modes
     hess = hessian(mol)
-    val, vec = evecs(hess)
+    val, vec = normal_modes(mol, hess)
     
     num = np.sum((vec**2), axis=0)**2
     den = len(vec)*np.sum(vec**4, axis=0)
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Define the Tersoff many-body potential of carbon, vectorized over the bond clusters
+(a directed bond and the other neighbors of its first atom) of a molecule.
+"""
+
+import numpy as np
+
+#carbon parameters of Tersoff, Phys. Rev. B 37, 6991 (1988)
+A = 1.3936e3                 #eV
+B = 3.467e2                  #eV
+LAMBDA1 = 3.4879             #angstrom^-1
+LAMBDA2 = 2.2119             #angstrom^-1
+BETA = 1.5724e-7
+N = 0.72751
+C = 3.8049e4
+D = 4.3484
+H = -5.7058e-1
+R = 1.8                      #angstroms, start of the cutoff function
+S = 2.1                      #angstroms, end of the cutoff function
+
+#values for calculating g(theta) terms
+c2 = C*C
+d2 = D*D
+g1 = 1. + c2/d2
+
+def bond_clusters(bondList, size):
+    """Return the M by W array of bond clusters of a molecule, one for each directed bond
+    (i,j): the atoms i, j and then the other neighbors of i, padded with i itself up to the
+    largest coordination (padding columns are those equal to the first).
+
+    Args:
+        bondList (ndarray): Array of the unique bonds, see Molecule.bondList.
+        size (int): Number of atoms in the molecule."""
+
+    bonds = np.asarray(bondList, dtype=int).reshape(-1,2)
+    directed = np.concatenate((bonds, bonds[:,::-1]))
+    directed = directed[np.lexsort((directed[:,1], directed[:,0]))]
+    i, j = directed.T
+    degree = np.bincount(i, minlength=size)
+    width = np.amax(degree, initial=1)
+    #table of each atom's neighbors, padded with the atom itself
+    neighbors = np.tile(np.arange(size)[:,None], (1,width))
+    neighbors[i, np.arange(len(i)) - (np.cumsum(degree) - degree)[i]] = j
+    rows = neighbors[i]
+    others = rows[rows != j[:,None]].reshape(len(i), width-1)
+    return np.column_stack((i, j, others))
+
+def cutoff(r, order=0):
+    """Return the Tersoff cutoff function at separations r, and with order 1 its derivative."""
+    t = np.clip((r - R)/(S - R), 0., 1.)
+    fc = .5 + .5*np.cos(np.pi*t)
+    if order == 0:
+        return fc
+    dfc = np.where((r > R) & (r < S), -.5*np.pi/(S - R)*np.sin(np.pi*t), 0.)
+    return fc, dfc
+
+def bond_energies(vij, vik, mask, order=0):
+    """Return the Tersoff energies of the bond clusters, half of fc(rij)(fR(rij) - bij fA(rij))
+    for each directed bond so the two directions make up the bond's energy; with order 1 also
+    their gradients with respect to vij and vik.
+
+    Args:
+        vij (ndarray): ... by M by 3 array of the bond vectors rj - ri.
+        vik (ndarray): ... by M by K by 3 array of the vectors rk - ri to the other neighbors of i.
+        mask (ndarray): M by K array, 1 for the neighbors that exist and 0 for padding."""
+
+    rij = np.sqrt(np.einsum('...i,...i->...', vij, vij))
+    rik = np.sqrt(np.einsum('...i,...i->...', vik, vik))
+    rik = np.where(mask > 0., rik, 1.)
+    fcij, dfcij = cutoff(rij, order=1)
+    fcik, dfcik = cutoff(rik, order=1)
+    fcik = fcik*mask
+    fR = A*np.exp(-LAMBDA1*rij)
+    fA = B*np.exp(-LAMBDA2*rij)
+    cosTheta = np.einsum('...ki,...i->...k', vik, vij)/(rik*rij[...,None])
+    hcos = H - cosTheta
+    g = g1 - c2/(d2 + hcos*hcos)
+    zeta = np.sum(fcik*g, axis=-1)
+    bz = np.power(BETA*zeta, N)
+    bij = np.power(1. + bz, -.5/N)
+    e = .5*fcij*(fR - bij*fA)
+    if order == 0:
+        return e
+    #db/dzeta, zero without any neighbors in range
+    dbdz = np.where(zeta > 0., -.5*bij*bz/((1. + bz)*np.where(zeta > 0., zeta, 1.)), 0.)
+    dedz = -.5*fcij*fA*dbdz
+    dedr = .5*(dfcij*(fR - bij*fA) + fcij*(bij*LAMBDA2*fA - LAMBDA1*fR))
+    dgdcos = -2.*c2*hcos/(d2 + hcos*hcos)**2
+    #dcos/dvij and dcos/dvik
+    rijik = (rij[...,None]*rik)[...,None]
+    dcdvij = vik/rijik - (cosTheta/(rij*rij)[...,None])[...,None]*vij[...,None,:]
+    dcdvik = vij[...,None,:]/rijik - (cosTheta/(rik*rik))[...,None]*vik
+    weight = (dedz[...,None]*fcik*dgdcos)[...,None]
+    gij = (dedr/rij)[...,None]*vij + np.sum(weight*dcdvij, axis=-2)
+    gik = weight*dcdvik + (dedz[...,None]*dfcik*g*mask/rik)[...,None]*vik
+    return e, gij, gik
+
+def cluster_gradient(pos, mask):
+    """Return the energies of bond clusters and their gradients with respect to the
+    positions of the clusters' atoms.
+
+    Args:
+        pos (ndarray): ... by M by W by 3 array of each cluster's atom positions (nearest images).
+        mask (ndarray): M by W-2 array, 1 for the neighbors that exist and 0 for padding."""
+    e, gij, gik = bond_energies(pos[...,1,:] - pos[...,0,:], pos[...,2:,:] - pos[...,:1,:], mask, order=1)
+    grad = np.concatenate((-(gij + np.sum(gik, axis=-2))[...,None,:], gij[...,None,:], gik), axis=-2)
+    return e, grad